@@ -7,11 +7,14 @@
 
 ### Prerequisites:
 # - FSL: Required for brain extraction, image realignment, etc. in this script.
+# - Python (NumPy, Nibabel, Scipy): realignment of the PET frames (src/python/realign.py) unless TQ_REALIGN=flirt.
+# - Python (NumPy, Nibabel): Dice coefficients and rotation angles of the registrations (src/python/reg_qc.py).
 
 ### Usage:
 # 1. Ensure input files (${ID}_t1w.nii and ${ID}_pmpbb3_dyn.nii) are in the directory.
 #    (The first character of ID must be capital.)
-# 2. Run the script: tq_10_realign.sh
+# 2. Run the script: tq_10_realign.sh [ID ...]
+#    If IDs are given, only these subjects are processed and their rows of the QC files are replaced.
 
 ### Main Outputs:
 # ${ID}_t1w_r.nii: t1w image in MNI space
@@ -35,25 +38,30 @@ TAMEQDIR=$(cd $(dirname "$(realpath "$0")") ; cd ../.. ; pwd)
 source ${TAMEQDIR}/config.env
 
 # Create a basis for coregistration QC
+# The header and the row of each subject are written by src/python/reg_qc.py under a lock.
+# When IDs are given (e.g. by tq_scheduler.py), the rows of these subjects are replaced.
 QCT1W=./coregistration_results_t1w.csv
-echo "ID,Rx,Ry,Rz,Dice" > ${QCT1W}
-
 QCPET=./coregistration_results_pet.csv
-echo "ID,Rmax_frame,Rx_mean,Ry_mean,Rz_mean,Dice" > ${QCPET}
-
-# Define util function
-function calc_dice() {
-  overlap=$(fslstats $1 -k $2 -V | awk -F ' ' '{print $1}')
-  union=$(echo "$(fslstats $1 -V | awk -F ' ' '{print $1}') + $(fslstats $2 -V | awk -F ' ' '{print $1}')" | bc)
-  echo "scale=3;$overlap*2/$union" | bc
-}
+if [[ $# -eq 0 ]]; then
+  rm -f ${QCT1W} ${QCPET}
+fi
+
+if [[ $# -gt 0 ]]; then
+  pets=()
+  for ID in "$@"; do
+    g=$(find . -maxdepth 1 -name "${ID}_pmpbb3_dyn.nii*" | head -n 1)
+    [[ -n ${g} ]] && pets+=("${g#./}")
+  done
+else
+  pets=([A-Z]*_pmpbb3_dyn.nii*)
+fi
 
-for f in [A-Z]*_pmpbb3_dyn.nii*
+for f in ${pets[@]}
 do
   pet=$(imglob $f) # PET filename
   t1w=${pet/pmpbb3_dyn/t1w} # T1 filename
   ref=${FSLDIR}/data/standard/MNI152_T1_1mm_brain # Template path
-  pad=MNI152_T1_1mm_pad # padded images
+  pad=${t1w%_t1w}_MNI152_T1_1mm_pad # padded images (per subject so that subjects can run concurrently)
 
   echo "Process: ${t1w%_t1w}"
   
@@ -85,79 +93,84 @@ do
   
   # Evaluation for T1 x MNI coregistratioin
   mri_synthstrip -i ${pad}.nii -m ${t1w%_t1w}_mnipad_stripmask.nii.gz
-  DICE_T1W=$(calc_dice ${t1w}_brain_mask_r.nii ${t1w%_t1w}_mnipad_stripmask.nii.gz)
-  R_T1W=$(avscale --allparams ${t1w}2MNI.mat | grep 'Rotation Angles' | awk -F '= ' '{print $2}' | sed 's/ /,/g')
-  echo "${t1w%_t1w},${R_T1W%,},$DICE_T1W" >> ${QCT1W}
-
-  ## Split PET frames as ${pet}_f????.nii
-  echo "Split PET frames"
-  fslsplit ${pet} ${pet}_f
-  for frame in ${pet}_f*.nii; do
-    fslreorient2std $frame $frame
-  done  
+  # Dice and rotation angles are computed by src/python/reg_qc.py
+  python ${TAMEQDIR}/src/python/reg_qc.py t1w -o ${QCT1W} ${t1w%_t1w} ${t1w}2MNI.mat ${t1w}_brain_mask_r.nii ${t1w%_t1w}_mnipad_stripmask.nii.gz
+
+  # The frames are realigned by src/python/realign.py in memory, or by fslsplit and flirt for each frame with TQ_REALIGN=flirt
+  if [[ "${TQ_REALIGN:-python}" = "python" ]]; then
+    petref=${pet}_f0000
+    echo -e "Realign each PET frame to target image\nTarget: ${petref}"
+    # Rmax_frame is NA (and the QC is CHECK) when the realignment fails
+    if Rmaxf=$(python ${TAMEQDIR}/src/python/realign.py "${f}" "${pet}") && [[ -n "${Rmaxf}" ]]; then
+      RMAXOPT=(--rmax "${Rmaxf}")
+    else
+      echo "Realignment of ${pet} failed"
+      RMAXOPT=(--rmax NA)
+    fi
+  else
+    ## Split PET frames as ${pet}_f????.nii
+    echo "Split PET frames"
+    fslsplit ${pet} ${pet}_f
+    for frame in ${pet}_f*.nii; do
+      fslreorient2std $frame $frame
+    done  
   
-  # Calculate a mean image from first two images of PET
-  #echo "Calculate a mean image of PET as target"
-  #if [[ $(ls | grep ${pet}_f) >2 ]]; then
-  #  fslroi ${pet} ${pet}_two 0 2 
-  #  fslmaths ${pet}_two -Tmean ${pet}_ref  
-  #  petref=${pet}_ref
-  #else
-  #  petref=${pet}_f0000
-  #fi
-  petref=${pet}_f0000
-
-  ## PET frames are realigned, averaged, and coregistered to T1W
-  echo -e "Realign each PET frame to target image\nTarget: ${petref}"
+    # Calculate a mean image from first two images of PET
+    #echo "Calculate a mean image of PET as target"
+    #if [[ $(ls | grep ${pet}_f) >2 ]]; then
+    #  fslroi ${pet} ${pet}_two 0 2 
+    #  fslmaths ${pet}_two -Tmean ${pet}_ref  
+    #  petref=${pet}_ref
+    #else
+    #  petref=${pet}_f0000
+    #fi
+    petref=${pet}_f0000
+
+    ## PET frames are realigned, averaged, and coregistered to T1W
+    echo -e "Realign each PET frame to target image\nTarget: ${petref}"
   
-  # Set MAXRUNNING
-  CPU_LIMIT=$(( $(nproc) - 1 ))
-  if [[ "$CPU_LIMIT" -lt 1 ]]; then CPU_LIMIT=1; fi
-
-  TOTAL_MEM_MB=$(free -m | awk '/^Mem:/{print $2}')
-  RAM_LIMIT=$(( TOTAL_MEM_MB / 2048 ))
-  if [ "$RAM_LIMIT" -lt 1 ]; then RAM_LIMIT=1; fi
-
-  if [[ "$CPU_LIMIT" -le "$RAM_LIMIT" ]]; then
-    MAX_JOBS=$CPU_LIMIT
-  else
-    MAX_JOBS=$RAM_LIMIT
-  fi
-
-  for t in ${pet}_f*[0-9].nii
-  do
-    if [[ "$t" = "${pet}_f0000.nii" ]]; then
-      cp ${pet}_f0000.nii ${pet}_f0000_align.nii
-      continue
+    # Set MAXRUNNING
+    # TQ_NCPUS is set by tq_scheduler.py to the number of cores assigned to this subject
+    CPU_LIMIT=${TQ_NCPUS:-$(( $(nproc) - 1 ))}
+    if [[ "$CPU_LIMIT" -lt 1 ]]; then CPU_LIMIT=1; fi
+
+    TOTAL_MEM_MB=$(free -m | awk '/^Mem:/{print $2}')
+    RAM_LIMIT=$(( TOTAL_MEM_MB / 2048 ))
+    if [ "$RAM_LIMIT" -lt 1 ]; then RAM_LIMIT=1; fi
+
+    if [[ "$CPU_LIMIT" -le "$RAM_LIMIT" ]]; then
+      MAX_JOBS=$CPU_LIMIT
+    else
+      MAX_JOBS=$RAM_LIMIT
     fi
 
-    while [[ "$(jobs -rp | wc -l)" -ge "$MAX_JOBS" ]]; do
-      sleep 10s
-    done
+    for t in ${pet}_f*[0-9].nii
+    do
+      if [[ "$t" = "${pet}_f0000.nii" ]]; then
+        cp ${pet}_f0000.nii ${pet}_f0000_align.nii
+        continue
+      fi
+
+      while [[ "$(jobs -rp | wc -l)" -ge "$MAX_JOBS" ]]; do
+        sleep 10s
+      done
     
-    flirt -dof 6 -in $t -ref ${petref} -cost normmi -searchcost normmi -omat ${t%.nii}_align.mat -out ${t%.nii}_align &  
-  done
+      flirt -dof 6 -in $t -ref ${petref} -cost normmi -searchcost normmi -omat ${t%.nii}_align.mat -out ${t%.nii}_align &  
+    done
 
-  wait
+    wait
   
-  #for t_align in ${pet}_f*_align.mat; do
-  #  Rf="${Rf} $(avscale --allparams ${t_align} | grep 'Rotation Angles' | awk -F '= ' '{print $2}')"
-  #done
-  Rf=""
-  for t_align in $(find . -maxdepth 1 -name "${pet}_f*_align.mat"); do
-    Rf="${Rf} $(avscale --allparams ${t_align} | grep 'Rotation Angles' | awk -F '= ' '{print $2}')"
-  done
-  
-  if [[ -n "$Rf" ]]; then
-    Rmaxf=$(for v in $Rf; do echo $v; done | sort -nr | head -n1)
-  else
-    Rmaxf=0
+    #for t_align in ${pet}_f*_align.mat; do
+    #  Rf="${Rf} $(avscale --allparams ${t_align} | grep 'Rotation Angles' | awk -F '= ' '{print $2}')"
+    #done
+    # The rotation angles of all frames are computed by src/python/reg_qc.py
+    RMAXOPT=(--frames "${pet}_f*_align.mat")
+
+    # Merge realigned frames and mean them
+    echo "Merge realigned frames"
+    fslmerge -t ${pet}_align ${pet}_f*_align.nii
+    fslmaths ${pet}_align -Tmean ${pet}_align_mean
   fi
-
-  # Merge realigned frames and mean them
-  echo "Merge realigned frames"
-  fslmerge -t ${pet}_align ${pet}_f*_align.nii
-  fslmaths ${pet}_align -Tmean ${pet}_align_mean
   #fslmaths ${pet}_align_mean -fmean ${pet}_align_mean_fmean
   #flirt -dof 6 -in ${pet}_align_mean -ref ${t1w}_r -cost normmi -searchcost normmi -omat ${t1w%_t1w}_PET2T1W.mat -out ${pet}_mean
   fslmaths ${pet}_align_mean -thr 0 -bin -fillh -ero ${pet}_align_headmask
@@ -176,14 +189,14 @@ do
   #fslmaths ${pet}_mean -div $voxsize -div 1000 ${pet}_mean
   
   mri_synthstrip -i ${pet}_mean.nii -m ${pet}_mean_stripmask.nii.gz
-  DICE_PET=$(calc_dice ${t1w}_brain_mask_r.nii ${pet}_mean_stripmask.nii.gz)
-  R_PET=$(avscale --allparams ${t1w%_t1w}_PET2MNI.mat | grep 'Rotation Angles' | awk -F '= ' '{print $2}' | sed 's/ /,/g')
-  echo "${t1w%_t1w},$Rmaxf,${R_PET%,},$DICE_PET" >> ${QCPET}
+  QC_PET=$(python ${TAMEQDIR}/src/python/reg_qc.py pet -o ${QCPET} "${RMAXOPT[@]}" ${t1w%_t1w} ${t1w%_t1w}_PET2MNI.mat ${t1w}_brain_mask_r.nii ${pet}_mean_stripmask.nii.gz)
+  echo "Registration QC of ${t1w%_t1w}: ${QC_PET}"
 
   # Create QA Report
-  fslmaths ${t1w}_brain_mask_r.nii -ero tmpmask
-  fslmaths ${t1w}_brain_mask_r.nii -sub tmpmask ${t1w}_brain_outline_r
-  rm tmpmask.nii
+  # Per-subject name, because several subjects may be processed in the same directory at once
+  fslmaths ${t1w}_brain_mask_r.nii -ero ${t1w}_tmpmask
+  fslmaths ${t1w}_brain_mask_r.nii -sub ${t1w}_tmpmask ${t1w}_brain_outline_r
+  rm ${t1w}_tmpmask.nii*
 
   convert_xfm -omat ${t1w%_t1w}_MNI2PET.mat -inverse ${t1w%_t1w}_PET2MNI.mat
   flirt -dof 6 -in ${t1w}_brain_outline_r -ref ${pet}_align_mean_head -interp nearestneighbour -applyxfm -init ${t1w%_t1w}_MNI2PET.mat -out ${t1w}_brain_outline4pet
@@ -196,7 +209,10 @@ do
   #fslmaths ${petref}_stripmask -sub tmpmask ${petref}_outline
   #rm tmpmask.nii
 
-  ${TAMEQDIR}/src/python/qa_view.py ${t1w%_t1w} ${t1w}_r.nii ${pet}_mean.nii ${pet}_align.nii ${petref}.nii
+  # With TQ_DEFER_FIGURES, the QA report is rendered later by src/python/tq_report.py
+  if [[ -z "${TQ_DEFER_FIGURES}" ]]; then
+    ${TAMEQDIR}/src/python/qa_view.py ${t1w%_t1w} ${t1w}_r.nii ${pet}_mean.nii ${pet}_align.nii ${petref}.nii
+  fi
 
   # Delete temporary files
   #rm -f ${t1w}_o.nii
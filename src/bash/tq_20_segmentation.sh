@@ -4,13 +4,23 @@
 ### Objectives:
 # This script generates probability maps for gray matter and white matter from T1-weighted images.
 
+# With -j K, the images are partitioned into K shards, and a batch of each shard is run by its own
+# SPM12 standalone (or MATLAB) instance concurrently. K is bounded by the number of images, the cores
+# (TQ_NCPUS when it is set) and the available memory (-m MB per instance). Each instance extracts the MCR
+# into its own cache (MCR_CACHE_ROOT). The outputs of each shard are checked after all shards are done.
+
 ### Prerequisites:
 # - FSL: Required for image processing.
 # - SPM12: Required for generating probability maps.
 
 ### Usage:
 # 1. Ensure that images (${ID}_t1w_r.nii) are in the directory.
-# 2. Run the script: tq_20_segmentation.sh
+# 2. Run the script: tq_20_segmentation.sh [-j shards] [-m memory (MB)] [-i ID] [ID ...]
+#    If IDs are given, only ${ID}_t1w_r.nii of these subjects are segmented (e.g. -i ID to segment one subject again).
+#    -j: number of concurrent instances (default: TQ_SEG_JOBS or 1)
+#    -m: memory used by one instance in MB (default: TQ_SEG_MEM or 4096)
+#    With -j, the log of a failed shard is kept as segmentation_[PID]_[shard].log, and the exit status is 1
+#    if any image of a shard has no c1 or c2 image.
 
 ### Main Outputs:
 # c1${ID}_t1w_r.nii: probability map of gray matter
@@ -36,31 +46,135 @@ if [[ "${TAMEQDIR}" = $PWD ]] ; then
   exit 1
 fi
 
+while getopts "j:m:i:" OPT; do
+  case $OPT in
+    j) JOBS=$OPTARG;;
+    m) JOBMEM=$OPTARG;;
+    i) SUBJECTS+=("$OPTARG");;
+    ?) exit 1;;
+  esac
+done
+shift $((OPTIND - 1))
+SUBJECTS+=("$@")
+JOBS=${JOBS:-${TQ_SEG_JOBS:-1}}
+JOBMEM=${JOBMEM:-${TQ_SEG_MEM:-4096}}
+
+# Write a .m file with the list of images (t1vols) of the subjects at the top
+function write_mfile() {
+  local mfile=$1
+  shift
+  echo "t1vols = {" > ${mfile}.m
+  for ID in "$@"; do
+    echo "  '${PWD}/${ID}_t1w_r.nii'" >> ${mfile}.m
+  done
+  echo "};" >> ${mfile}.m
+  cat ${TAMEQDIR}/src/matlab/segmentation.m >> ${mfile}.m
+}
+
+# Run a .m file with SPM12 standalone, or with MATLAB if the standalone does not work
+function run_batch() {
+  local mfile=$1
+  ${SPM12STANDALONEDIR}/run_spm12.sh ${MCRDIR}/${MCRVERSION} batch ./${mfile}.m
+
+  if [ $? -ne 0 ]; then
+    echo "SPM12 standalone does not work correctly."
+    echo "Switching to use MATLAB."
+
+    # Add 'run batch' to the .m file
+    echo '' >> ${mfile}.m
+    echo "spm_jobman('run',matlabbatch);" >> ${mfile}.m
+
+    #Run segmentation.m
+    matlab -nodesktop -nosplash -r "${mfile}; exit"
+  fi
+}
+
+# Largest number of instances for the cores (TQ_NCPUS when set by tq_scheduler.py) and the available memory
+function max_jobs() {
+  local n=${TQ_NCPUS:-$(nproc 2>/dev/null || echo 1)}
+  local mem=$(awk '/^MemAvailable:/ {print int($2/1024)}' /proc/meminfo 2>/dev/null)
+  if [[ -n "${mem}" ]] && [[ $((mem / JOBMEM)) -lt ${n} ]]; then
+    n=$((mem / JOBMEM))
+  fi
+  echo $((n > 1 ? n : 1))
+}
+
+if [[ ${JOBS} -gt 1 ]]; then
+  # Images of the subjects, or all images found by the filter of segmentation.m
+  if [[ ${#SUBJECTS[@]} -eq 0 ]]; then
+    for f in $(ls | grep -E '^[A-Z].*t1w_r\.nii$'); do
+      SUBJECTS+=(${f%_t1w_r.nii})
+    done
+  fi
+  if [[ ${#SUBJECTS[@]} -lt ${JOBS} ]]; then
+    JOBS=${#SUBJECTS[@]}
+  fi
+  if [[ $(max_jobs) -lt ${JOBS} ]]; then
+    JOBS=$(max_jobs)
+  fi
+fi
+
+if [[ ${JOBS} -gt 1 ]]; then
+  echo "Segmentation of ${#SUBJECTS[@]} images in ${JOBS} shards"
+  # Subjects are assigned to the shards in turn, and each shard is run in the background
+  pids=()
+  for ((k = 0; k < JOBS; k++)); do
+    shard=()
+    for ((i = k; i < ${#SUBJECTS[@]}; i += JOBS)); do
+      shard+=(${SUBJECTS[$i]})
+    done
+    mfile=segmentation_$$_${k}
+    write_mfile ${mfile} ${shard[@]}
+    # Each instance extracts the MCR into its own cache, so that instances starting at once do not race
+    (export MCR_CACHE_ROOT=${TMPDIR:-/tmp}/tq_mcr_cache_$$_${k}; run_batch ${mfile}; rm -rf ${MCR_CACHE_ROOT}) > ${mfile}.log 2>&1 &
+    pids+=($!)
+  done
+
+  # Collect the outputs of each shard
+  failed=0
+  for ((k = 0; k < JOBS; k++)); do
+    wait ${pids[$k]}
+    mfile=segmentation_$$_${k}
+    missing=()
+    for ((i = k; i < ${#SUBJECTS[@]}; i += JOBS)); do
+      ID=${SUBJECTS[$i]}
+      if [[ ! -e c1${ID}_t1w_r.nii ]] || [[ ! -e c2${ID}_t1w_r.nii ]]; then
+        missing+=(${ID})
+      fi
+    done
+    rm ${mfile}.m
+    if [[ ${#missing[@]} -gt 0 ]]; then
+      echo "Shard ${k}: segmentation failed for ${missing[@]} (see ${mfile}.log)"
+      failed=1
+    else
+      echo "Shard ${k}: done"
+      rm ${mfile}.log
+    fi
+  done
+  exit ${failed}
+fi
+
 # Copy .m file to pwd
-cp ${TAMEQDIR}/src/matlab/segmentation.m $PWD
+# When IDs are given, the list of images (t1vols) is written at the top of a .m file
+# with a unique name so that several segmentations can run in the same directory
+if [[ ${#SUBJECTS[@]} -gt 0 ]]; then
+  mfile=segmentation_$$
+  write_mfile ${mfile} ${SUBJECTS[@]}
+else
+  mfile=segmentation
+  cp ${TAMEQDIR}/src/matlab/segmentation.m $PWD
+fi
 
 # Get MCR version
 MCRVER=$(cat ${SPM12STANDALONEDIR}/readme.txt | grep run_spm12.sh | grep /mathworks/home/application | awk -F/ '{print $NF}')
 
 # Run segmentation.m
+run_batch ${mfile}
 #/usr/local/spm12_standalone/run_spm12.sh /usr/local/MATLAB/MCR/v99 batch ./segmentation.m
 #spm batch ./segmentation.m
-${SPM12STANDALONEDIR}/run_spm12.sh ${MCRDIR}/${MCRVERSION} batch ./segmentation.m
-
-if [ $? -ne 0 ]; then
-  echo "SPM12 standalone does not work correctly."
-  echo "Switching to use MATLAB."
-  
-  # Add 'run batch' to the .m file
-  echo '' >> segmentation.m
-  echo "spm_jobman('run',matlabbatch);" >> segmentation.m
-
-  #Run segmentation.m
-  matlab -nodesktop -nosplash -r 'segmentation; exit'
-fi
 
 # Delete .m file
-rm segmentation.m
+rm ${mfile}.m
 
 # Fill holes in c2 images, and mask out c1 from c2
 #for f in c1*_t1w_r.nii; do
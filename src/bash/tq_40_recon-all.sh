@@ -9,7 +9,9 @@
 ### Usage:
 # 1. Ensure the following file is present in the directory:
 #    - ${ID}_t1w_r.nii
-# 2. Run the script: tq_40_recon-all.sh
+# 2. Run the script: tq_40_recon-all.sh [ID ...]
+#    If IDs are given, recon-all of these subjects is run in the foreground one by one
+#    (parallelism is handled by the caller, e.g. tq_scheduler.py).
 
 ### Main Outputs:
 # subjects/${ID}: The output directory containing FreeSurfer results for each subject.
@@ -56,6 +58,13 @@ echo "set maxrunning=${maxrunning}"
 
 
 #copy fsaverage and {lr}h.EC_average to $SUBJECTS_DIR if they don't exsit
+# (mkdir is used as a lock because several instances may be started at once)
+until mkdir ${SUBJECTS_DIR}/.tq_40.lock 2> /dev/null; do
+  sleep 1
+done
+# Release the lock even if the copy fails or the script is killed
+trap 'rmdir ${SUBJECTS_DIR}/.tq_40.lock' EXIT
+
 find $SUBJECTS_DIR -maxdepth 1 | egrep fsaverage$ > /dev/null
 if [ $? -eq 1 ]; then
   cp -r $FREESURFER_HOME/subjects/fsaverage $SUBJECTS_DIR
@@ -66,6 +75,23 @@ if [ $? -eq 1 ]; then
   cp -r $FREESURFER_HOME/subjects/[lr]h.EC_average $SUBJECTS_DIR
 fi
 
+rmdir ${SUBJECTS_DIR}/.tq_40.lock
+trap - EXIT
+
+#recon-all of the given IDs
+if [[ $# -gt 0 ]]; then
+  for fsid in "$@"
+  do
+    f=$(find . -maxdepth 1 -name "${fsid}_t1w_r.nii*" | head -n 1)
+    if [ ! -e ${SUBJECTS_DIR}/${fsid}/mri/aseg.mgz ]; then
+      recon-all -i ${f#./} -s $fsid -all -qcache
+    else
+      echo "recon-all is already done."
+    fi
+  done
+  exit
+fi
+
 #recon-all
 for f in *_t1w_r.nii*
 do
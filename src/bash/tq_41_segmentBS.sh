@@ -11,7 +11,7 @@
 # 1. Ensure the following files and directories are present in the working directory:
 #    - ${ID}_t1w_r.nii
 #    - subjects/${ID} (the output directory from FreeSurfer's recon-all command)
-# 2. Run the script: tq_41_segmentBS.sh
+# 2. Run the script: tq_41_segmentBS.sh [ID ...]
 
 ### Main Outputs:
 # subjects/${ID}: The subject-specific output directory containing brainstem parcellation.
@@ -70,7 +70,17 @@ export SUBJECTS_DIR=$PWD/subjects
 #fi
 
 #segmentBS.sh
-for f in *_t1w_r.nii*
+if [[ $# -gt 0 ]]; then
+  t1ws=()
+  for ID in "$@"; do
+    g=$(find . -maxdepth 1 -name "${ID}_t1w_r.nii*" | head -n 1)
+    [[ -n ${g} ]] && t1ws+=("${g#./}")
+  done
+else
+  t1ws=(*_t1w_r.nii*)
+fi
+
+for f in ${t1ws[@]}
 do
 #  running=$(ps x | grep [b]in/segmentBS.sh | awk -F ' ' '{print $(NF-2)}' | sort | uniq | wc -l)
 #  while [ $running -gt $maxrunning ];
@@ -6,13 +6,13 @@
 
 ### Prerequisites:
 # - FSL: Required for image processing.
-# - FreeSurfer: Required for convertion from mgz to NIfTI.
+# - FreeSurfer: Required for the label volumes (resampled into the PET space by src/python/atlas_cache.py).
 
 ### Usage:
 # 1. Ensure the following files are present in the directory:
 #    - ${ID}_pmpbb3_dyn_mean.nii
 #    - subjects/${ID}/mri/wmparc.mgz
-# 2. Run the script: tq_42_suvr_cer.sh
+# 2. Run the script: tq_42_suvr_cer.sh [ID ...]
 
 ### Main Outputs:
 # ${ID}_pmpbb3_suvr_cer.nii.gz: SUVR PET image based on the cerebellum cortex signal intensity.
@@ -32,19 +32,20 @@ TAMEQDIR=$(cd $(dirname "$(realpath "$0")") ; cd ../.. ; pwd)
 source ${TAMEQDIR}/config.env
 export SUBJECTS_DIR=$PWD/subjects
 
-for f in *_pmpbb3_dyn_mean.nii
+if [[ $# -gt 0 ]]; then
+  pets=()
+  for ID in "$@"; do pets+=("${ID}_pmpbb3_dyn_mean.nii"); done
+else
+  pets=(*_pmpbb3_dyn_mean.nii)
+fi
+
+for f in ${pets[@]}
 do
   fsid=${f%_pmpbb3_dyn_mean.nii}
   wmparc=${fsid}_wmparc
   
-  # copy wmparc.mgz, add fsid, and convert to nii.gz
-  if [[ ! -e ${wmparc}_r.nii.gz ]]; then
-    echo "copy wmparc.mgz, add fsid, and convert to nii.gz"
-    find $PWD/subjects/${fsid} -name 'wmparc.mgz' -exec cp {} ${wmparc}.mgz \;
-    mri_label2vol --seg ${wmparc}.mgz --temp $f --o ${wmparc}_r.mgz --regheader ${wmparc}.mgz
-    mri_convert ${wmparc}_r.{mgz,nii.gz} --out_orientation $(mri_info $f | grep Orientation | awk '{ print $3 }')
-    rm *.mgz
-  fi
+  # wmparc.mgz resampled into the PET space once for all stages (see src/python/atlas_cache.py)
+  python ${TAMEQDIR}/src/python/atlas_cache.py resample -t ${f} ${fsid} wmparc
   
   # SUVR images within Cerebellum-Cortex Reference 
   if [[ ! -e ${fsid}_pmpbb3_suvr_cer.nii.gz ]]; then
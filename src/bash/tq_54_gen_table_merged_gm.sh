@@ -5,7 +5,6 @@
 # This script generates a table of SUVR values for each ROI in merged wmparc based on semi-quantification using the gray matter reference.
 
 ### Prerequisites:
-# - FSL: Required for image processing.
 # - FreeSurfer: Required for conversion from mgz to NIfTI format.
 
 ### Usage:
@@ -13,7 +12,13 @@
 #    - ${ID}_pmpbb3_suvr.nii.gz
 #    - ${ID}_merged_r.nii.gz
 #    - subjects/${ID}/mri/brainstemSsLabels.v??.FSvoxelSpace.mgz
-# 2. Run the script: tq_54_gen_table_merged_gm.sh
+# 2. Run the script: tq_54_gen_table_merged_gm.sh [-n|-t] [-a|-r gm|wm|cer] [ID ...]
+#    -n: only the tables of each subject are generated (used by tq_scheduler.py)
+#    -t: only the consolidated table is generated from the existing tables of each subject
+#    -a: the tables of the white matter and cerebellar references are also generated, with the merged of each subject
+#        loaded once for the three SUVR images
+#    -r: the tables of one reference only: gm (default), wm (tq_55_gen_table_merged_wm.sh) or cer (tq_56_gen_table_merged_cer.sh)
+#    If IDs are given, only these subjects are processed.
 
 ### Main Outputs:
 # - ${ID}_pmpbb3_suvr_merged_mean.tsv: A table of SUVR values for each ROI in merged wmparc, based on the gray matter reference for ${ID}.
@@ -33,182 +38,61 @@ TAMEQDIR=$(cd $(dirname "$(realpath "$0")") ; cd ../.. ; pwd)
 source ${TAMEQDIR}/config.env
 export SUBJECTS_DIR=$PWD/subjects
 
-for f in *_pmpbb3_suvr.nii.gz
+TABLE=1
+SUBJECT=1
+REFS=gm
+while getopts "ntar:" OPT; do
+  case $OPT in
+    n) TABLE=0;;
+    t) SUBJECT=0;;
+    a) REFS="gm wm cer";;
+    r) REFS=${OPTARG};;
+    ?) exit 1;;
+  esac
+done
+shift $((OPTIND - 1))
+
+# SUVR images of each reference and the names of their tables
+REFERENCES=()
+for ref in ${REFS}; do
+  case ${ref} in
+    gm) REFERENCES+=(-i _pmpbb3_suvr:suvr_merged_mean);;
+    wm) REFERENCES+=(-i _pmpbb3_suvr_wm:suvr_wm_merged_mean);;
+    cer) REFERENCES+=(-i _pmpbb3_suvr_cer:suvr_cer_merged_mean);;
+    *) echo "Unknown reference: ${ref}"; exit 1;;
+  esac
+done
+# Subjects are found by the SUVR image of the first reference
+suffix=${REFERENCES[1]%:*}.nii.gz
+
+if [[ ${SUBJECT} = 0 ]]; then
+  files=()
+elif [[ $# -gt 0 ]]; then
+  files=()
+  for ID in "$@"; do files+=("${ID}${suffix}"); done
+else
+  files=(*${suffix})
+fi
+
+IDs=()
+for f in ${files[@]}
 do
-  fsid=${f%_pmpbb3_suvr.nii.gz}
+  fsid=${f%${suffix}}
   merged=${fsid}_merged
   
   if [[ ! -e ${merged}_r.nii.gz ]]; then
     echo "Not found: ${merged}_r"
     continue
   fi
-
-  echo "extract mean SUVR within merged wmparc rois of ${fsid}"
-  echo "${fsid}" > ${fsid}_pmpbb3_suvr_merged_mean.tsv
-  
-  # divide merged.nii.gz into five subregions and calc mean for each region
-  # aseg and brainstem
-  fslmaths ${merged}_r.nii.gz -uthr 999.5 ${merged}_r_0000.nii.gz
-  fslstats -K ${merged}_r_0000.nii.gz $f -M > tmp_${fsid}_suvr_merged_mean_0000
-  cat tmp_${fsid}_suvr_merged_mean_0000 | sed -n '7,8p;10,13p;17,18p;26p;28p;46,47p;49,54p;58p;60p;173,175p;251,255p' >> ${fsid}_pmpbb3_suvr_merged_mean.tsv
-
-  # 1000: lt cortex; 2000: rt cotex 
-  # 3000: lt subcortical wm; 4000: rt subcortical wm
-  for num in 1000 2000 3000 4000
-  do
-    lthr=$((num - 1))
-    uthr=$((num + 999))
-    fslmaths ${merged}_r.nii.gz -thr ${lthr}.5 -uthr ${uthr}.5 -sub ${num} \
-      ${merged}_r_${num}.nii.gz
-    fslstats -K ${merged}_r_${num}.nii.gz $f -M >\
-        tmp_${fsid}_suvr_merged_mean_${num}
-    cat tmp_${fsid}_suvr_merged_mean_${num} |\
-        sed -n '1,3p;5,9p;11,13p;15,18p;21,22p;24,25p;28,31p;33,35p' >> ${fsid}_pmpbb3_suvr_merged_mean.tsv
-  done
-  
+  IDs+=("${fsid}")
 done
 
-# Header
-cat << EOS > colheader_merged.txt
-Region                        
-Lt-Cerebellum-White-Matter
-Lt-Cerebellum-Cortex
-Lt-Thalamus
-Lt-Caudate
-Lt-Putamen
-Lt-Pallidum
-Lt-Hippocampus
-Lt-Amygdala
-Lt-Accumbens-area
-Lt-VentralDC
-Rt-Cerebellum-White-Matter
-Rt-Cerebellum-Cortex
-Rt-Thalamus
-Rt-Caudate
-Rt-Putamen
-Rt-Pallidum
-Rt-Hippocampus
-Rt-Amygdala
-Rt-Accumbens-area
-Rt-VentralDC
-Midbrain
-Pons
-Medulla
-CC_Posterior
-CC_Mid_Posterior
-CC_Central
-CC_Mid_Anterior
-CC_Anterior
-Lt-bankssts
-Lt-cingulate
-Lt-middlefrontal
-Lt-cuneus
-Lt-entorhinal
-Lt-fusiform
-Lt-inferiorparietal
-Lt-inferiortemporal
-Lt-lateraloccipital
-Lt-orbitofrontal
-Lt-lingual
-Lt-middletemporal
-Lt-parahippocampal
-Lt-paracentral
-Lt-inferiorfrontal
-Lt-pericalcarine
-Lt-postcentral
-Lt-precentral
-Lt-precuneus
-Lt-superiorfrontal
-Lt-superiorparietal
-Lt-superiortemporal
-Lt-supramarginal
-Lt-temporalpole
-Lt-transversetemporal
-Lt-insula
-Rt-bankssts
-Rt-cingulate
-Rt-middlefrontal
-Rt-cuneus
-Rt-entorhinal
-Rt-fusiform
-Rt-inferiorparietal
-Rt-inferiortemporal
-Rt-lateraloccipital
-Rt-orbitofrontal
-Rt-lingual
-Rt-middletemporal
-Rt-parahippocampal
-Rt-paracentral
-Rt-inferiorfrontal
-Rt-pericalcarine
-Rt-postcentral
-Rt-precentral
-Rt-precuneus
-Rt-superiorfrontal
-Rt-superiorparietal
-Rt-superiortemporal
-Rt-supramarginal
-Rt-temporalpole
-Rt-transversetemporal
-Rt-insula
-Lt-wm-bankssts
-Lt-wm-cingulate
-Lt-wm-middlefrontal
-Lt-wm-cuneus
-Lt-wm-entorhinal
-Lt-wm-fusiform
-Lt-wm-inferiorparietal
-Lt-wm-inferiortemporal
-Lt-wm-lateraloccipital
-Lt-wm-orbitofrontal
-Lt-wm-lingual
-Lt-wm-middletemporal
-Lt-wm-parahippocampal
-Lt-wm-paracentral
-Lt-wm-inferiorfrontal
-Lt-wm-pericalcarine
-Lt-wm-postcentral
-Lt-wm-precentral
-Lt-wm-precuneus
-Lt-wm-superiorfrontal
-Lt-wm-superiorparietal
-Lt-wm-superiortemporal
-Lt-wm-supramarginal
-Lt-wm-temporalpole
-Lt-wm-transversetemporal
-Lt-wm-insula
-Rt-wm-bankssts
-Rt-wm-cingulate
-Rt-wm-middlefrontal
-Rt-wm-cuneus
-Rt-wm-entorhinal
-Rt-wm-fusiform
-Rt-wm-inferiorparietal
-Rt-wm-inferiortemporal
-Rt-wm-lateraloccipital
-Rt-wm-orbitofrontal
-Rt-wm-lingual
-Rt-wm-middletemporal
-Rt-wm-parahippocampal
-Rt-wm-paracentral
-Rt-wm-inferiorfrontal
-Rt-wm-pericalcarine
-Rt-wm-postcentral
-Rt-wm-precentral
-Rt-wm-precuneus
-Rt-wm-superiorfrontal
-Rt-wm-superiorparietal
-Rt-wm-superiortemporal
-Rt-wm-supramarginal
-Rt-wm-temporalpole
-Rt-wm-transversetemporal
-Rt-wm-insula
-EOS
-
-echo "generate table"
-timestamp=$(date +%Y%m%d_%H%M)
-paste colheader_merged.txt *_suvr_merged_mean.tsv > suvr_merged_mean_${timestamp}.tsv
-
-rm colheader_merged.txt tmp_*_suvr_merged_mean_?000 *_r_?000.nii.gz
-
-echo "Done. Please check suvr_merged_mean_${timestamp}.tsv"
+# Extract mean SUVR within merged rois of all subjects and generate table
+# The rois are defined by label ID in src/tables/merged_regions.tsv
+if [[ ${TABLE} = 1 ]]; then
+  echo "generate table"
+  timestamp=$(date +%Y%m%d_%H%M)
+  python ${TAMEQDIR}/src/python/roi_stats.py -t merged ${REFERENCES[@]} --timestamp ${timestamp} ${IDs[@]}
+elif [[ ${#IDs[@]} -gt 0 ]]; then
+  python ${TAMEQDIR}/src/python/roi_stats.py -t merged ${REFERENCES[@]} ${IDs[@]}
+fi
@@ -4,6 +4,8 @@
 
 # Usage: tau_6_overview.sh -i <ID>  -a [lower threshold] -b [upperthreshold]
 # If thresholds are omitted, thresholds are set to 0 and 6
+# With -n, only the affine transform is done and the figures are rendered later by src/python/tq_report.py
+# Both overviews of a subject can be rendered in one process by src/python/overview.py
 
 # K. Nakayama 18 Mar 2023
 
@@ -14,11 +16,12 @@
 TAMEQDIR=$(cd $(dirname "$(realpath "$0")") ; cd ../.. ; pwd)
 source ${TAMEQDIR}/config.env
 
-while getopts "i:a:b:" OPT; do
+while getopts "i:a:b:n" OPT; do
   case $OPT in
     i) ID=$OPTARG;;
     a) THR=$OPTARG;;
     b) UTHR=$OPTARG;;
+    n) NO_FIGURE=1;;
     ?) exit 1;;
   esac
 done
@@ -31,24 +34,12 @@ if [ -z "$UTHR" ]; then
   UTHR=2
 fi
 
-t1w=${ID}_t1w_r.nii
-t1w_l=${t1w%.nii}_l.nii.gz
-pet=${ID}_pmpbb3_suvr.nii.gz
-pet_l=${pet%.nii.gz}_l.nii.gz
-ref=${FSLDIR}/data/standard/MNI152_T1_1mm.nii.gz
-mat=tmp_affine.mat
-
-if [[ ! -e ${pet_l} ]]; then
-  echo "Affine transform of $ID"
-  flirt -dof 9 -in ${t1w} -ref ${ref} -omat ${mat} -out ${t1w_l}
-  flirt -dof 9 -in ${pet} -ref ${ref} -applyxfm -init ${mat} -out ${pet_l}
-  rm ${mat} 
+# The affine transform and the figures are done by overview.py in one process
+# (per-process temporary names, so that tq_60 and tq_61 can run concurrently for the same subject)
+if [[ -n "${NO_FIGURE}" ]]; then
+  python ${TAMEQDIR}/src/python/overview.py -n ${ID}
 else
-  echo "Affine transform of $ID is already done"
+  python ${TAMEQDIR}/src/python/overview.py -a ${THR} -b ${UTHR} --views cor ${ID}
 fi
- 
-echo "Overlay SUVR image onto T1w image"
-python ${TAMEQDIR}/src/python/overlay_view_cor.py ${ID} ${t1w_l} ${pet_l} ${THR} ${UTHR} ${ID}_overview_cor_t1.png ${ID}_overview_cor_${THR}_${UTHR}.png
-# rm ${t1w_l} ${pet_l}
 
 exit
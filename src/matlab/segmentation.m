@@ -11,8 +11,11 @@ volfil='^[A-Z].*t1w_r.nii';
 
 %% Select Image files
 % please change the filter
-imglist=spm_select('FPList',pwd,volfil);
-t1vols = cellstr(imglist);
+% t1vols can be defined before this script (e.g. by tq_20_segmentation.sh with IDs)
+if ~exist('t1vols','var')
+    imglist=spm_select('FPList',pwd,volfil);
+    t1vols = cellstr(imglist);
+end
 
 %% Step 1
 %% Initialize batch
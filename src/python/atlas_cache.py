@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q atlas_cache.py
+### Objectives:
+# This script resamples the FreeSurfer label volumes of a subject (wmparc.mgz and brainstemSsLabels*.FSvoxelSpace.mgz)
+# into the PET space once, instead of mri_label2vol and mri_convert in each of tq_42 and tq_50 to tq_52.
+# Each voxel of the PET image takes the label of the nearest voxel of the label volume, mapped through the
+# vox2ras matrices of both headers (as mri_label2vol --regheader). The output has the grid and orientation of
+# the PET image, so that no reorientation is needed, and the labels are stored as int16 (int32 if they do not fit).
+# The resampled volumes are kept in a cache keyed by the hash of the label volume and the grid (shape and affine)
+# of the PET image, so that the stages resampling to the same grid share one entry.
+# ${ID}_[atlas]_r.nii.gz is a copy of the entry, so that writing to an output in place (e.g. fslmaths) changes
+# neither the cache nor the outputs of other stages, and the outputs made from each entry are recorded in
+# [key].outputs. Entries are built under a lock of their key and written and copied with atomic renames,
+# so that stages running concurrently for the same subject neither build an entry twice nor read a partial file.
+
+### Usage:
+# python atlas_cache.py resample [-t template] [-d subjects directory] ID atlas [atlas ...]
+#   atlas: wmparc or bsseg
+#   -t: image defining the PET space (default: ${ID}_pmpbb3_dyn_mean.nii)
+#   -d: directory of the FreeSurfer subjects (default: $SUBJECTS_DIR or subjects)
+# python atlas_cache.py list             # list the entries (key, size and number of existing outputs)
+# python atlas_cache.py clean            # remove the entries whose outputs were all removed
+# The cache is kept in the directory set by TQ_ATLAS_CACHE (default: .tq_atlas in the working directory; none to disable it).
+
+### Main Outputs:
+# - ${ID}_wmparc_r.nii.gz, ${ID}_bsseg_r.nii.gz: label volumes in the PET space
+# - [cache directory]/[key].nii.gz: resampled label volumes
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, glob, json, fcntl, shutil, hashlib, argparse, threading
+import numpy as np
+import nibabel as nib
+
+from tq_cache import hash_file
+
+CACHEDIR='.tq_atlas'
+# Changed when the resampling changes, so that entries of earlier versions are not used
+VERSION=1
+
+# File names of each atlas in the directory of the subject, in the order of preference
+ATLASES={
+  'wmparc': ['wmparc.mgz'],
+  'bsseg': ['brainstemSsLabels.v??.FSvoxelSpace.mgz', 'brainstemSsLabels.FSvoxelSpace.mgz'],
+}
+
+def get_cache_dir():
+  cachedir=os.environ.get('TQ_ATLAS_CACHE', CACHEDIR)
+  if cachedir.strip().lower() in ['', 'none', 'off', '0']:
+    return None
+  return cachedir
+
+def get_subjects_dir():
+  return os.environ.get('SUBJECTS_DIR', 'subjects')
+
+def get_output_name(ID, atlas):
+  return ID+'_'+atlas+'_r.nii.gz'
+
+def find_source(ID, atlas, subjects_dir=None):
+  # Label volume of the atlas found under the directory of the subject (as find subjects/${ID} -name ...)
+  subjects_dir=get_subjects_dir() if subjects_dir is None else subjects_dir
+  for pattern in ATLASES[atlas]:
+    found=sorted(glob.glob(os.path.join(subjects_dir, ID, '**', pattern), recursive=True))
+    if found:
+      return found[0]
+  return None
+
+def compact_dtype(labels):
+  if labels.size==0 or (labels.min()>=np.iinfo(np.int16).min and labels.max()<=np.iinfo(np.int16).max):
+    return np.int16
+  return np.int32
+
+def resample_labels(labels, src_affine, shape, affine):
+  # Nearest neighbour of each voxel of the grid (shape, affine) in labels; voxels outside the label volume are 0.
+  # The coordinates are rounded to 1e-6 voxel before the nearest voxel is taken, so that voxels exactly between
+  # two voxels of the label volume (e.g. 2mm PET and 1mm conformed space) always take the upper one.
+  labels=np.asarray(labels)
+  M=np.linalg.solve(src_affine, affine)
+  out=np.zeros(shape[:3], dtype=labels.dtype)
+  i, j=np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+  for k in range(shape[2]):
+    coords=[np.floor(np.round(M[a, 0]*i+M[a, 1]*j+M[a, 2]*k+M[a, 3], 6)+0.5).astype(np.int64) for a in range(3)]
+    inside=np.ones(i.shape, dtype=bool)
+    for a in range(3):
+      inside&=(coords[a]>=0) & (coords[a]<labels.shape[a])
+    out[:, :, k][inside]=labels[coords[0][inside], coords[1][inside], coords[2][inside]]
+  return out
+
+def load_labels(path):
+  # Labels of a label volume as integers
+  img=nib.load(path)
+  return np.rint(np.asanyarray(img.dataobj)).astype(np.int32), img.affine
+
+def build(source, template):
+  # Resampled label volume with the header of the template
+  labels, src_affine=load_labels(source)
+  data=resample_labels(labels, src_affine, template.shape[:3], template.affine)
+  data=data.astype(compact_dtype(data))
+  img=nib.Nifti1Image(data, template.affine, header=template.header.copy())
+  img.set_data_dtype(data.dtype)
+  img.header.set_slope_inter(1, 0)
+  return img
+
+def get_key(atlas, source_hash, template):
+  spec=[VERSION, atlas, source_hash, [int(n) for n in template.shape[:3]], np.asarray(template.affine, dtype=np.float64).tolist()]
+  return hashlib.blake2b(json.dumps(spec).encode('UTF-8'), digest_size=20).hexdigest()
+
+def get_tmp_name(fname, suffix=''):
+  # Temporary file in the same directory, unique to the process and thread
+  d, name=os.path.split(fname)
+  return os.path.join(d, '.'+name+'.'+str(os.getpid())+'_'+str(threading.get_ident())+'.tmp'+suffix)
+
+def save_atomic(img, fname):
+  # Written to a temporary file in the same directory and renamed
+  tmp=get_tmp_name(fname, '.nii.gz' if fname.endswith('.gz') else '.nii')
+  nib.save(img, tmp)
+  os.replace(tmp, fname)
+  return fname
+
+def get_outputs_file(entry):
+  return entry[:-len('.nii.gz')]+'.outputs'
+
+def read_outputs(entry):
+  # Absolute paths of the outputs copied from the entry
+  fname=get_outputs_file(entry)
+  if not os.path.exists(fname):
+    return []
+  with open(fname, encoding='UTF-8') as f:
+    return sorted(set(f.read().splitlines()))
+
+def copy(entry, output):
+  # Copy of the entry replacing the output atomically, recorded in the outputs of the entry
+  tmp=get_tmp_name(output)
+  shutil.copyfile(entry, tmp)
+  os.replace(tmp, output)
+  with open(get_outputs_file(entry), 'a', encoding='UTF-8') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    f.write(os.path.abspath(output)+'\n')
+  return output
+
+def get_entry(key, make, cachedir):
+  # Path of the entry, built by make() under the lock of the key unless it exists
+  os.makedirs(cachedir, exist_ok=True)
+  entry=os.path.join(cachedir, key+'.nii.gz')
+  if os.path.exists(entry):
+    return entry
+  with open(os.path.join(cachedir, key+'.lock'), 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    if not os.path.exists(entry):
+      save_atomic(make(), entry)
+  return entry
+
+def resample_atlas(ID, atlas, template=None, output=None, subjects_dir=None, cachedir=None):
+  # Returns the path of ${ID}_[atlas]_r.nii.gz, or None when the label volume is not found.
+  # An existing output is kept when the label volume is not found (e.g. made by an earlier version).
+  template=ID+'_pmpbb3_dyn_mean.nii' if template is None else template
+  output=get_output_name(ID, atlas) if output is None else output
+  cachedir=get_cache_dir() if cachedir is None else cachedir
+  source=find_source(ID, atlas, subjects_dir)
+  if source is None:
+    return output if os.path.exists(output) else None
+  template_img=nib.load(template)
+  if cachedir is None:
+    return save_atomic(build(source, template_img), output)
+  entry=get_entry(get_key(atlas, hash_file(source), template_img), lambda: build(source, template_img), cachedir)
+  return copy(entry, output)
+
+def count_outputs(entry):
+  return len([output for output in read_outputs(entry) if os.path.exists(output)])
+
+def list_entries(cachedir=None):
+  # [(key, size in bytes, number of existing outputs)]
+  cachedir=get_cache_dir() if cachedir is None else cachedir
+  entries=[]
+  if cachedir is None:
+    return entries
+  for entry in sorted(glob.glob(os.path.join(cachedir, '*.nii.gz'))):
+    entries.append((os.path.basename(entry)[:-len('.nii.gz')], os.stat(entry).st_size, count_outputs(entry)))
+  return entries
+
+def clean(cachedir=None):
+  # Remove the entries whose outputs were all removed; returns the removed keys
+  cachedir=get_cache_dir() if cachedir is None else cachedir
+  removed=[]
+  for key, size, noutputs in list_entries(cachedir):
+    with open(os.path.join(cachedir, key+'.lock'), 'w') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      entry=os.path.join(cachedir, key+'.nii.gz')
+      if os.path.exists(entry) and count_outputs(entry)==0:
+        os.remove(entry)
+        if os.path.exists(get_outputs_file(entry)):
+          os.remove(get_outputs_file(entry))
+        removed.append(key)
+  return removed
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Resample the FreeSurfer label volumes into the PET space with a shared cache.')
+  parser.add_argument('command', choices=['resample', 'list', 'clean'])
+  parser.add_argument('-t', dest='template', default=None)
+  parser.add_argument('-d', dest='subjects_dir', default=None)
+  parser.add_argument('args', nargs='*')
+  args=parser.parse_args()
+
+  if args.command=='resample':
+    if len(args.args)<2 or any([atlas not in ATLASES for atlas in args.args[1:]]):
+      parser.error('ID and atlases ('+', '.join(ATLASES)+') are required')
+    ID=args.args[0]
+    failed=False
+    for atlas in args.args[1:]:
+      output=resample_atlas(ID, atlas, args.template, subjects_dir=args.subjects_dir)
+      if output is None:
+        sys.stderr.write('atlas_cache.py: '+' or '.join(ATLASES[atlas])+' of '+ID+' is not found\n')
+        failed=True
+    exit(1 if failed else 0)
+  elif args.command=='list':
+    for key, size, noutputs in list_entries():
+      print('\t'.join([key, str(size), str(noutputs)]))
+  else:
+    print('removed '+str(len(clean()))+' entries')
+  exit()
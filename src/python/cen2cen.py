@@ -1,36 +1,127 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys, os
+### TAME-Q cen2cen.py
+### Objectives:
+# This script moves an image so that the centroid of its non-zero voxels coincides with that of a target image.
+# The centroids are computed from the marginal counts of non-zero voxels along each axis, on the data in their
+# stored data type. Only the affine of the header changes: the data block is copied from the input without
+# being decoded and encoded again, so the output keeps the data type and scaling of the input.
+# In the batch form, many inputs are moved to one target, whose centroid is computed once.
+
+### Usage:
+# python cen2cen.py [input] [target] [output]
+# python cen2cen.py -t [target] [-s suffix] [input ...]
+#   -s: suffix added to the name of each input for the output (default: _cen, e.g. ID_t1w.nii -> ID_t1w_cen.nii)
+
+### Main Outputs:
+# - output (or [input][suffix].nii[.gz]): the input image with the translated affine
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import sys, os, shutil, argparse
 import numpy as np
 import nibabel as nib
+from nibabel.openers import Opener
+
+from tq_dtype import load_fdata
+
+def get_nonzero(img):
+    # Non-zero voxels, without conversion to floating point unless the scaling can move values to or from 0
+    dataobj=img.dataobj
+    if nib.is_proxy(dataobj) and hasattr(dataobj, 'get_unscaled'):
+        slope, inter=float(dataobj.slope), float(dataobj.inter)
+        if inter==0 and slope!=0 and np.isfinite(slope):
+            return dataobj.get_unscaled()!=0
+    return load_fdata(img)!=0
 
 def compute_centroid(img):
-    data=img.get_fdata()
-    coords=np.array(np.nonzero(data))
-    centroid_voxel=coords.mean(axis=1)
+    # Mean index of the non-zero voxels along each axis from the marginal counts
+    nonzero=get_nonzero(img)
+    counts_xy=nonzero.sum(axis=tuple(range(2, nonzero.ndim)))
+    counts=[counts_xy.sum(axis=1), counts_xy.sum(axis=0), nonzero.sum(axis=(0, 1)+tuple(range(3, nonzero.ndim)))]
+    n=counts_xy.sum()
+    centroid_voxel=np.array([np.dot(np.arange(len(c)), c)/n for c in counts])
     centroid=nib.affines.apply_affine(img.affine, centroid_voxel)
     return centroid
 
-input=sys.argv[1]
-target=sys.argv[2]
-output=sys.argv[3]
+def set_affine(hdr, affine):
+    # As set by nibabel when an image is saved with a new affine
+    if not np.allclose(affine, hdr.get_best_affine()):
+        hdr.set_sform(affine, code='aligned')
+        hdr.set_qform(affine, code='unknown')
+    return hdr
+
+def save_with_affine(img, affine, output):
+    # Write the header with the new affine, followed by the extensions and the data block of the input as they are
+    path=img.get_filename()
+    if not isinstance(img, nib.Nifti1Image) or path is None or not path.endswith(('.nii', '.nii.gz')):
+        nib.save(img.__class__(img.dataobj, affine, header=img.header), output)
+        return
+    with Opener(path, 'rb') as fin:
+        # The header as stored (img.header has no data offset and scaling)
+        block=set_affine(img.header_class.from_fileobj(fin), affine).binaryblock
+        if not (path.endswith('.nii') and output.endswith('.nii')):
+            fin.seek(len(block))
+            extra=fin.read(img.dataobj.offset-len(block))
+            tmp=output+'.tmp'+('.gz' if output.endswith('.gz') else '')
+            with Opener(tmp, 'wb') as fout:
+                fout.write(block)
+                fout.write(extra)
+                for chunk in iter(lambda: fin.read(1<<24), b''):
+                    fout.write(chunk)
+    if path.endswith('.nii') and output.endswith('.nii'):
+        # Uncompressed: copy the file and overwrite the header
+        if os.path.abspath(path)!=os.path.abspath(output):
+            shutil.copyfile(path, output)
+        with open(output, 'r+b') as f:
+            f.write(block)
+    else:
+        os.replace(tmp, output)
+    return
 
-# Load images
-target_img=nib.load(target)
-input_img=nib.load(input)
+def align(input_img, target_centroid, output):
+    # Calculate vector
+    translation=target_centroid-compute_centroid(input_img)
+    affine=input_img.affine.copy()
+    affine[:3, 3]+=translation
+    save_with_affine(input_img, affine, output)
+    return translation
 
-# Calculate centroid
-target_centroid=compute_centroid(target_img)
-input_centroid=compute_centroid(input_img)
+def get_output_name(path, suffix):
+    for ext in ['.nii.gz', '.nii']:
+        if path.endswith(ext):
+            return path[:-len(ext)]+suffix+ext
+    return path+suffix
 
-# Calculate vector
-translation=target_centroid-input_centroid
-affine = input_img.affine.copy()
-affine[:3, 3] += translation
+def run_batch(inputs, target, suffix='_cen'):
+    # The centroid of the target is computed once; returns the translations (None when an input failed)
+    target_centroid=compute_centroid(nib.load(target))
+    translations=[]
+    for path in inputs:
+        try:
+            translations.append(align(nib.load(path), target_centroid, get_output_name(path, suffix)))
+        except Exception as e:
+            sys.stderr.write('cen2cen.py: '+path+': '+repr(e)+'\n')
+            translations.append(None)
+    return translations
 
-# Output
-output_img = nib.Nifti1Image(input_img.get_fdata(), affine, header=input_img.header)
-nib.save(output_img, output)
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Move images so that their centroid coincides with that of a target image.')
+    parser.add_argument('-t', dest='target', default=None)
+    parser.add_argument('-s', dest='suffix', default='_cen')
+    parser.add_argument('files', nargs='+')
+    args=parser.parse_args()
 
-exit()
\ No newline at end of file
+    if args.target is None:
+        if len(args.files)!=3:
+            parser.error('input, target and output are required without -t')
+        input, target, output=args.files
+        align(nib.load(input), compute_centroid(nib.load(target)), output)
+    else:
+        translations=run_batch(args.files, args.target, args.suffix)
+        if any([translation is None for translation in translations]):
+            exit(1)
+    exit()
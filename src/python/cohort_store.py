@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q cohort_store.py
+### Objectives:
+# This script keeps the regional values of all subjects for each table of roi_stats.py (e.g. suvr_wmparc_mean)
+# in a columnar store, so that the consolidated tables are exported without pasting the tables of all subjects again.
+# Each table is stored as an .npz file with one row per subject and one column per region
+# (with the region name, atlas and label of each column), and the source table of each subject.
+# roi_stats.py upserts the values of each subject when its table is written. Before an export, the store is
+# synchronized with the tables of the subjects in the working directory: only new or modified tables
+# (identified by size, modification time and hash) are read, and subjects whose table was removed are dropped.
+# The exported wide table is the same as paste colheader.txt ${ID}_pmpbb3_[table name].tsv.
+
+### Usage:
+# python cohort_store.py sync -t [region table] -n [table name] [-s stat]
+# python cohort_store.py export -t [region table] -n [table name] [-s stat] [--long] [-o output]
+#   -t: name of a table in src/tables (wmparc or merged) or path to a region table (see roi_stats.py)
+#   -n: table name, e.g. suvr_wmparc_mean or suvr_wmparc_count
+#   -s: statistic of the table (mean, count, sd or median; default: mean), used for the format of the values
+#   --long: one row per (subject, region) with the columns ID, table, Region, atlas, label and value
+# The store is kept in the directory set by TQ_TABLE_STORE (default: .tq_tables in the working directory).
+
+### Main Outputs:
+# - [store directory]/[table name].npz: values of the subjects
+# - output (standard output unless -o is given): wide table (as roi_stats.py --timestamp) or long table
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, glob, fcntl, argparse
+import numpy as np
+
+from tq_cache import hash_file
+
+STOREDIR='.tq_tables'
+
+def get_store_dir():
+  return os.environ.get('TQ_TABLE_STORE', STOREDIR)
+
+# Value of a label which is not in the label volume
+MISSING=-np.inf
+
+def fslstats_label(label):
+  # Label printed by fslstats -K in tq_50 and tq_54, which was run for each range of 1000 labels
+  # with the start of the range subtracted (e.g. 1035 as 35)
+  return int(label)%1000
+
+def format_value(value, stat, label=None):
+  # Fixed 6 decimals as fslstats -M (and get_suvr.py), and "missing label: N" as fslstats -K
+  # for a label which is not in the label volume
+  if value==MISSING:
+    return 'missing label: '+str(fslstats_label(label))
+  if stat=='count':
+    return str(int(value))
+  return '{:.6f}'.format(value)
+
+def parse_value(text):
+  if text.startswith('missing label'):
+    return MISSING
+  return float(text) if text.strip()!='' else np.nan
+
+def subject_file(ID, name):
+  return ID+'_pmpbb3_'+name+'.tsv'
+
+def empty_store(regions):
+  return {
+    'region': np.array([region[0] for region in regions], dtype=str),
+    'atlas': np.array([region[1] for region in regions], dtype=str),
+    'label': np.array([region[2] for region in regions], dtype=np.int64),
+    # One row per subject: file name and first line (ID) of the table of the subject, number of values
+    'source': np.array([], dtype=str),
+    'ID': np.array([], dtype=str),
+    'count': np.array([], dtype=np.int64),
+    'values': np.zeros((0, len(regions))),
+    # size, modification time and hash of the table of the subject
+    'size': np.array([], dtype=np.int64),
+    'mtime_ns': np.array([], dtype=np.int64),
+    'hash': np.array([], dtype=str),
+  }
+
+def same_regions(store, regions):
+  return store['region'].tolist()==[region[0] for region in regions] and \
+         store['atlas'].tolist()==[region[1] for region in regions] and \
+         store['label'].tolist()==[region[2] for region in regions]
+
+def load_store(name, regions, storedir=None):
+  # A store of other regions (e.g. after an update of the region table) is discarded
+  fname=os.path.join(get_store_dir() if storedir is None else storedir, name+'.npz')
+  if not os.path.exists(fname):
+    return empty_store(regions)
+  with np.load(fname, allow_pickle=False) as f:
+    store={key: f[key] for key in f.files}
+  if not same_regions(store, regions):
+    return empty_store(regions)
+  return store
+
+def save_store(store, name, storedir=None):
+  fname=os.path.join(get_store_dir() if storedir is None else storedir, name+'.npz')
+  with open(fname+'.tmp', 'wb') as f:
+    np.savez(f, **store)
+  os.replace(fname+'.tmp', fname)
+  return
+
+def update_store(name, regions, func, storedir=None):
+  # Read-modify-write under a lock for the subjects processed in parallel
+  storedir=get_store_dir() if storedir is None else storedir
+  os.makedirs(storedir, exist_ok=True)
+  with open(os.path.join(storedir, name+'.lock'), 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    store=load_store(name, regions, storedir)
+    result=func(store)
+    save_store(store, name, storedir)
+  return result
+
+def get_source(path):
+  st=os.stat(path)
+  return st.st_size, st.st_mtime_ns, hash_file(path)
+
+def remove_rows(store, files):
+  keep=~np.isin(store['source'], list(files))
+  for key in ['source', 'ID', 'count', 'values', 'size', 'mtime_ns', 'hash']:
+    store[key]=store[key][keep]
+  return
+
+def upsert(store, fname, ID, values, source):
+  # values: values of the subject in the order of the regions (fewer values are padded with NaN)
+  # source: (size, mtime_ns, hash) of the table of the subject
+  remove_rows(store, [fname])
+  row=np.full(len(store['region']), np.nan)
+  count=min(len(values), len(row))
+  row[:count]=values[:count]
+  size, mtime_ns, digest=source
+  for key, value in [('source', fname), ('ID', ID), ('count', count), ('size', size), ('mtime_ns', mtime_ns), ('hash', digest)]:
+    store[key]=np.append(store[key], value)
+  store['values']=np.vstack([store['values'], row[np.newaxis]])
+  return
+
+def read_subject_table(path):
+  # ID and values of a table of roi_stats.py
+  with open(path, encoding='UTF-8') as f:
+    lines=f.read().splitlines()
+  if len(lines)==0:
+    return '', []
+  return lines[0], [parse_value(line) for line in lines[1:]]
+
+def upsert_subject(name, regions, path, values=None, storedir=None):
+  # Upsert the table of a subject just written (values: the values written, otherwise read from the table)
+  source=get_source(path)
+  ID, read_values=read_subject_table(path)
+  values=read_values if values is None else values
+  return update_store(name, regions, lambda store: upsert(store, os.path.basename(path), ID, values, source), storedir)
+
+def sync(name, regions, directory='.', storedir=None):
+  # Synchronize the store with the tables ${ID}_pmpbb3_[name].tsv in directory; returns the updated file names
+  paths={os.path.basename(path): path for path in glob.glob(os.path.join(directory, subject_file('*', name)))}
+
+  def func(store):
+    removed=[fname for fname in store['source'] if fname not in paths]
+    remove_rows(store, removed)
+    known={fname: i for i, fname in enumerate(store['source'])}
+    updated=[]
+    for fname, path in sorted(paths.items()):
+      st=os.stat(path)
+      if fname in known:
+        i=known[fname]
+        if [store['size'][i], store['mtime_ns'][i]]==[st.st_size, st.st_mtime_ns]:
+          continue
+        if store['hash'][i]==hash_file(path) and store['size'][i]==st.st_size:
+          # Touched but not modified
+          store['mtime_ns'][i]=st.st_mtime_ns
+          continue
+      updated.append(fname)
+    for fname in updated:
+      ID, values=read_subject_table(paths[fname])
+      upsert(store, fname, ID, values, get_source(paths[fname]))
+    return updated
+  return update_store(name, regions, func, storedir)
+
+def format_wide(store, stat='mean'):
+  # Same layout as paste colheader.txt ${ID}_pmpbb3_[name].tsv (subjects in the order of the file names)
+  order=np.argsort(store['source'], kind='stable')
+  columns=[['Region'.ljust(30)]+store['region'].tolist()]
+  for i in order:
+    values=[format_value(value, stat, label) for value, label in zip(store['values'][i][:store['count'][i]], store['label'])]
+    columns.append([str(store['ID'][i])]+values)
+  lines=[]
+  for i in range(len(store['region'])+1):
+    lines.append('\t'.join([column[i] if i<len(column) else '' for column in columns])+'\n')
+  return ''.join(lines)
+
+def format_long(store, name, stat='mean'):
+  # One row per (subject, region)
+  lines=['\t'.join(['ID', 'table', 'Region', 'atlas', 'label', 'value'])+'\n']
+  for i in np.argsort(store['source'], kind='stable'):
+    for j in range(store['count'][i]):
+      lines.append('\t'.join([str(store['ID'][i]), name, str(store['region'][j]), str(store['atlas'][j]), str(store['label'][j]),
+                              format_value(store['values'][i][j], stat, store['label'][j])])+'\n')
+  return ''.join(lines)
+
+def export_table(name, regions, fname, stat='mean', directory='.', storedir=None, long=False):
+  sync(name, regions, directory, storedir)
+  store=load_store(name, regions, storedir)
+  text=format_long(store, name, stat) if long else format_wide(store, stat)
+  with open(fname, 'w', encoding='UTF-8') as f:
+    f.write(text)
+  return store
+
+if __name__ == '__main__':
+  from roi_stats import load_region_table
+  parser=argparse.ArgumentParser(description='Keep the regional values of all subjects in a columnar store.')
+  parser.add_argument('command', choices=['sync', 'export'])
+  parser.add_argument('-t', dest='table', required=True)
+  parser.add_argument('-n', dest='name', required=True)
+  parser.add_argument('-s', dest='stat', default='mean')
+  parser.add_argument('-o', dest='output', default=None)
+  parser.add_argument('--long', action='store_true')
+  args=parser.parse_args()
+
+  regions=load_region_table(args.table)
+  if args.command=='sync':
+    print('updated '+str(len(sync(args.name, regions)))+' subjects')
+  elif args.output is None:
+    sync(args.name, regions)
+    store=load_store(args.name, regions)
+    sys.stdout.write(format_long(store, args.name, args.stat) if args.long else format_wide(store, args.stat))
+  else:
+    export_table(args.name, regions, args.output, args.stat, long=args.long)
+  exit()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q compare_tables.py
+### Objectives:
+# This script compares the SUVR tables of two runs of the pipeline, e.g. with TQ_DTYPE=float64 and with the default float32,
+# and reports the largest absolute and relative differences of each table.
+# The tables are compared cell by cell; cells which are not numbers (region names and IDs) must be identical.
+
+### Usage:
+# python compare_tables.py [-p pattern] [--atol 1e-4] [--rtol 1e-4] [directory A] [directory B]
+#   -p: glob pattern of the tables in the directories (default: *_pmpbb3_suvr*.tsv)
+#   --atol, --rtol: tolerance of each value, |a-b| <= atol+rtol*|b| as in numpy.isclose
+# The exit status is 0 when all the tables of directory A are found in directory B and all the differences are within the tolerance.
+
+### Main Outputs:
+# - Standard output: one line per table with the number of values, the largest absolute and relative differences and OK or NG
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, glob, argparse
+import numpy as np
+
+def read_table(fname):
+  with open(fname, encoding='UTF-8') as f:
+    return [line.rstrip('\n').split('\t') for line in f]
+
+def to_float(cell):
+  try:
+    return float(cell)
+  except ValueError:
+    return None
+
+def compare_table(rows_a, rows_b, atol=1e-4, rtol=1e-4):
+  # Returns (number of values, largest absolute difference, largest relative difference, within the tolerance)
+  if len(rows_a)!=len(rows_b) or any([len(a)!=len(b) for a, b in zip(rows_a, rows_b)]):
+    return 0, np.inf, np.inf, False
+  a, b=[], []
+  for row_a, row_b in zip(rows_a, rows_b):
+    for cell_a, cell_b in zip(row_a, row_b):
+      value_a, value_b=to_float(cell_a), to_float(cell_b)
+      if value_a is None or value_b is None:
+        if cell_a.strip()!=cell_b.strip():
+          return 0, np.inf, np.inf, False
+        continue
+      a.append(value_a)
+      b.append(value_b)
+  a, b=np.array(a), np.array(b)
+  if len(a)==0:
+    return 0, 0.0, 0.0, True
+  both_nan=np.isnan(a) & np.isnan(b)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    diff=np.where(both_nan, 0, np.abs(a-b))
+    rel=np.where(diff==0, 0, diff/np.abs(b))
+  ok=bool(np.all(np.isclose(a, b, rtol=rtol, atol=atol, equal_nan=True)))
+  return len(a), float(np.nanmax(diff)), float(np.nanmax(rel)), ok
+
+def compare_directories(dir_a, dir_b, pattern='*_pmpbb3_suvr*.tsv', atol=1e-4, rtol=1e-4):
+  # Returns [(table name, number of values, largest absolute difference, largest relative difference, ok)]
+  results=[]
+  for fname in sorted(glob.glob(os.path.join(dir_a, pattern))):
+    name=os.path.basename(fname)
+    if not os.path.exists(os.path.join(dir_b, name)):
+      results.append((name, 0, np.inf, np.inf, False))
+      continue
+    results.append((name,)+compare_table(read_table(fname), read_table(os.path.join(dir_b, name)), atol, rtol))
+  return results
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Compare the SUVR tables of two runs.')
+  parser.add_argument('-p', dest='pattern', default='*_pmpbb3_suvr*.tsv')
+  parser.add_argument('--atol', type=float, default=1e-4)
+  parser.add_argument('--rtol', type=float, default=1e-4)
+  parser.add_argument('dir_a')
+  parser.add_argument('dir_b')
+  args=parser.parse_args()
+
+  results=compare_directories(args.dir_a, args.dir_b, args.pattern, args.atol, args.rtol)
+  for name, n, diff, rel, ok in results:
+    print('\t'.join([name, str(n), '{:.3g}'.format(diff), '{:.3g}'.format(rel), 'OK' if ok else 'NG']))
+  if len(results)==0:
+    sys.stderr.write('compare_tables.py: no table matches '+args.pattern+' in '+args.dir_a+'\n')
+    exit(1)
+  exit(0 if all([result[-1] for result in results]) else 1)
@@ -17,10 +17,16 @@
 # Run the script using the following command:
 # python get_ref.py [ID] [static PET image] [mask image specifying the target region] [output directory]
 # The reference value will be returned as standard output.
+# The same processing is available from Python as run_subject(ID, pet_path, mask_path, output_directory),
+# and estimate_reference(pet, msk) returns a ReferenceResult without writing any file.
+# See get_ref_batch.py to process a whole cohort in one interpreter.
+# See get_ref_sweep.py to evaluate the reference over a grid of the parameters below for a whole cohort.
 
 ### Main Outputs:
 # - output_directory/${ID}_histogram.png: A visual representation of the curve fitting process used for signal value determination.
 # - output_directory/${ID}_reference.nii: A voxel map image used for the final reference value determination.
+# With TQ_DEFER_FIGURES set, output_directory/${ID}_histogram.npz is saved instead of the figure, which is rendered by tq_report.py.
+# The images are loaded and the reference image is written in the precision set by TQ_DTYPE (see tq_dtype.py, default: float32).
 
 ### License:
 # This script is distributed under the GNU General Public License version 3.
@@ -28,11 +34,17 @@
 
 # K. Nemoto and K. Nakayama 11 Jul 2023
 
-import os, sys
+import os, sys, fcntl, time
+from collections import namedtuple
 import numpy as np
 import nibabel as nib
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from tq_instrument import timed
+from tq_dtype import get_dtype, load_fdata, ge, gt, le
+from tq_report import plt, savefig, defer_figures, save_histogram_data
 
 # Usage: get_ref.py [ID] [PET image] [probability map] [output directory]
 
@@ -42,6 +54,16 @@ bin_width=0.025
 fwhm_area=1.0
 histcutoff=0.5
 weighting=True
+# Number of processes for the multi-start bimodal fitting (1: evaluate the starts in turn).
+# The fit of all starts takes milliseconds and the subjects are already run in parallel (get_ref_batch.py),
+# so a pool is only started with TQ_FIT_WORKERS>1 (processes, since curve_fit holds the GIL).
+fit_workers=int(os.environ.get('TQ_FIT_WORKERS', 1))
+
+# Result of the reference estimation for one subject
+# params: (a1, b1, c1, a2, b2, c2) of the bimodal fit, params_mono: (am, bm, cm) of the monomodal fit
+# x, y: histogram of the PET values inside the mask
+# rss, start, nstarts, fit_time: residual, chosen start, number of starts and wall time of the bimodal fitting
+ReferenceResult=namedtuple('ReferenceResult', ['refval', 'refnum', 'voxnum', 'params', 'params_mono', 'dsc', 'dsc_thr', 'FWHM_min', 'FWHM_max', 'weighting', 'x', 'y', 'rss', 'start', 'nstarts', 'fit_time'])
 
 def check_args(args):
   return True
@@ -49,7 +71,7 @@ def check_args(args):
 def load_img(paths):
   out=[]
   for path in paths:
-    out.append(nib.load(path).get_fdata())
+    out.append(load_fdata(nib.load(path)))
   return out
   
 def load_img_header(path):
@@ -61,23 +83,27 @@ def load_img_affine(path):
   return img.affine
 
 def probmap2mask(probmap, msk_thr):
-  msk=np.zeros(probmap.shape)
-  msk[probmap>msk_thr]=1
-  #msk=msk.astype(int)
-  return msk
+  return gt(probmap, msk_thr).astype(np.uint8)
 
 def get_erodedmap(img):
-  a, b, c=img.shape
-  img=np.pad(img, (1,))
-  out=np.ones(img.size).reshape(img.shape)
-  out[1:-1, 1:-1, 1:-1]=img[1:-1, 1:-1, 1:-1]
-  
-  for i in range(1, a+1):
-    for j in range(1, b+1):
-      for k in range(1, c+1):
-        out[i, j, k]=np.min([img[i, j, k], img[i-1, j, k], img[i+1, j, k], img[i, j-1, k], img[i, j+1, k]])
-        
-  return out[1:-1, 1:-1, 1:-1]
+  # Minimum over the in-plane cross kernel (x-1, x+1, y-1, y+1) with zero padding at the borders
+  img=np.asarray(img)
+  padded=np.pad(img, ((1, 1), (1, 1), (0, 0)))
+  out=img.copy()
+  np.minimum(out, padded[:-2, 1:-1, :], out=out)
+  np.minimum(out, padded[2:, 1:-1, :], out=out)
+  np.minimum(out, padded[1:-1, :-2, :], out=out)
+  np.minimum(out, padded[1:-1, 2:, :], out=out)
+  return out
+
+def get_reference_mask(probmap, brainmask, msk_thr=0.9):
+  # Same as the following FSL commands, without intermediate files
+  #   fslmaths probmap -mas brainmask -thr 0.9 thr
+  #   fslmaths thr -kernel boxv3 3 1 1 -ero thr_xero
+  #   fslmaths thr -kernel boxv3 1 3 1 -ero thr_yero
+  #   fslmaths thr -min thr_xero -min thr_yero -bin eroded
+  msk=(ge(probmap, msk_thr) & (brainmask!=0)).astype(np.uint8)
+  return get_erodedmap(msk)
 
 def get_values_in_mask(img, msk):
   maskedimg=img*msk
@@ -86,17 +112,15 @@ def get_values_in_mask(img, msk):
   return value
 
 def data2dist(data, w):
-  x=np.array([i*w for i in range(int(1+np.max(data)//w))])
-  y=np.zeros(x.size)
-  for d in data:
-    y[int(d//w)]+=1
-    
-  i=0
-  while y[i]<1:
-    i+=1
-  j=int(np.max(data)//w)
-  while y[j]<1:
-    j-=1
+  n=int(1+np.max(data)//w)
+  x=np.arange(n)*w
+  # Bin indexes as in y[int(d//w)]; negative indexes wrap around like Python indexing
+  idx=np.floor_divide(data, w).astype(np.int64)
+  idx[idx<0]+=n
+  y=np.bincount(idx, minlength=n).astype(np.float64)
+  
+  nonzero=np.flatnonzero(y)
+  i, j=nonzero[0], nonzero[-1]
   x+=w/2
   return x[i:j+1], y[i:j+1]
 
@@ -110,13 +134,26 @@ def func_bi(x, *param):
   ys=y1+y2
   return ys
 
+def jac_bi(x, *param):
+  # Analytic Jacobian of func_bi with respect to (a1, b1, c1, a2, b2, c2)
+  jac=np.empty((np.size(x), 6))
+  for k in (0, 3):
+    a, b, c=param[k:k+3]
+    z=(x-b)/c
+    g=np.exp(-pow(z, 2)/2)/pow(2*np.pi, 1/2)/c
+    jac[:, k]=g
+    jac[:, k+1]=a*g*z/c
+    jac[:, k+2]=a*g*(pow(z, 2)-1)/c
+  return jac
+
 def get_gaussian(a, b, c):
   def gaussian(x):
     return a*np.exp(-pow((x-b)/c, 2)/2)/pow(2*np.pi, 1/2)/c
   return gaussian
 
 def calc_dsc(x, y, gm):
-  return 2*np.sum([np.min([gm(xi), yi]) for xi, yi in zip(x, y)])/(np.sum([gm(xi) for xi in x])+np.sum(y))
+  gx=gm(np.asarray(x, dtype=np.float64))
+  return 2*np.sum(np.minimum(gx, y))/(np.sum(gx)+np.sum(y))
 
 def calc_FWHM(mu, sigma, area=fwhm_area):
   FWHM_min=mu-sigma*pow(2*np.log(2), 1/2)*area
@@ -143,29 +180,80 @@ def calc_refval_bi(values, g1, g2, lim_min, lim_max):
   return refnum, refval
 
 def bimodal_curve_fitting(x, y, params, param_bounds):
-  popt, pcov=curve_fit(func_bi, x, y, p0=params, bounds=param_bounds)
+  popt, pcov=curve_fit(func_bi, x, y, p0=params, bounds=param_bounds, jac=jac_bi)
   if popt[1]>popt[4]:
     popt=popt[[3, 4, 5, 0, 1, 2]]
   FWHM_min, FWHM_max=calc_FWHM(popt[1], popt[2])
   if FWHM_max<x[0]:
     raise Exception('InadequateFitting')
   return popt
+
+def get_bimodal_starts(x, y):
+  # Initial parameters of the bimodal fitting; duplicated starts are removed
+  t1, t2=get_tertile(y)
+  list_params=[
+    [np.max(y)/2, 1.0, 0.2, np.max(y)/2, 1.5, 0.2],
+    [np.max(y)/2, x[t1], 0.2, np.max(y)/2, x[t2], 0.2],
+    [np.max(y)*0.66, x[np.argmax(y)], 0.2, np.max(y)*0.34, x[np.argmax(y)], 0.2],
+    [np.max(y)*0.66, x[t1], 0.2, np.max(y)*0.34, x[t2], 0.2],
+  ]
+  starts=[]
+  for params in list_params:
+    if params not in starts:
+      starts.append(params)
+  
+  # The means are first bounded by 0, and by the lowest bin if no start succeeds.
+  list_param_bounds=[
+    [[0]*6, [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
+    [[0, x[0], 0, 0, x[0], 0], [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
+  ]
+  return starts, list_param_bounds
+
+def try_bimodal_curve_fitting(x, y, params, param_bounds):
+  try:
+    popt=bimodal_curve_fitting(x, y, params, param_bounds)
+  except Exception:
+    return None
+  rss=np.sum(pow(func_bi(x, *popt)-y, 2))
+  if not np.isfinite(rss):
+    return None
+  return popt, rss
+
+def multistart_bimodal_curve_fitting(x, y, max_workers=1):
+  # Fit all starts and choose the fit with the smallest residual sum of squares.
+  # Returns (popt, rss, index of the start, number of starts), or None when no start succeeds.
+  starts, list_param_bounds=get_bimodal_starts(x, y)
+  for param_bounds in list_param_bounds:
+    if max_workers>1:
+      with ProcessPoolExecutor(max_workers=min(max_workers, len(starts))) as executor:
+        fits=list(executor.map(try_bimodal_curve_fitting, repeat(x), repeat(y), starts, repeat(param_bounds)))
+    else:
+      fits=[try_bimodal_curve_fitting(x, y, params, param_bounds) for params in starts]
+    
+    candidates=[(fit[1], i, fit[0]) for i, fit in enumerate(fits) if fit is not None]
+    if len(candidates)>0:
+      rss, i, popt=min(candidates, key=lambda c: (c[0], c[1]))
+      return popt, rss, i, len(starts)
+  return None
   
 def monomodal_curve_fitting(x, y):
   popt_mono, pcov_mono=curve_fit(func_mono, x, y, p0=[np.max(y), x[np.argmax(y)], 0.5], bounds=[[0, x[0], 0], [np.inf, x[-1], np.inf]])
   return popt_mono
 
-def save_figure(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory):
+def save_figure(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory, fig=None):
+  # fig: figure to be reused (cleared by the caller and left open), a new figure is created and closed if None
   if dsc<0:
-    save_figure_b(x, y, a1, b1, c1, a2, b2, c2, refnum, refval, ID, output_directory)
+    save_figure_b(x, y, a1, b1, c1, a2, b2, c2, refnum, refval, ID, output_directory, fig)
   else:
-    save_figure_bm(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory)
+    save_figure_bm(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory, fig)
     
-def save_figure_b(x, y, a1, b1, c1, a2, b2, c2, refnum, refval, ID, output_directory):
+def save_figure_b(x, y, a1, b1, c1, a2, b2, c2, refnum, refval, ID, output_directory, fig=None):
   g1=get_gaussian(a1, b1, c1)
   g2=get_gaussian(a2, b2, c2)
   
-  fig=plt.figure(figsize=(13, 4))
+  close=fig is None
+  if close:
+    fig=plt.figure(figsize=(13, 4))
   ax1=fig.add_subplot(1, 3, 1)
   ax1.plot(x, y, c='black', label='original')
   ax1.set_title(ID, size=15)
@@ -194,15 +282,19 @@ def save_figure_b(x, y, a1, b1, c1, a2, b2, c2, refnum, refval, ID, output_direc
   ax3.text(0.35, 0.5, 'No Data', size=15, transform=ax3.transAxes)
   ax3.set_title('monomodal fitting', size=15)
   
-  plt.savefig(os.path.join(output_directory, ID+'_histogram.jpeg'))
+  savefig(fig, os.path.join(output_directory, ID+'_histogram.jpeg'))
+  if close:
+    plt.close(fig)
   return
 
-def save_figure_bm(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory):
+def save_figure_bm(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory, fig=None):
   g1=get_gaussian(a1, b1, c1)
   g2=get_gaussian(a2, b2, c2)
   gm=get_gaussian(am, bm, cm)
   
-  fig=plt.figure(figsize=(13, 4))
+  close=fig is None
+  if close:
+    fig=plt.figure(figsize=(13, 4))
   ax1=fig.add_subplot(1, 3, 1)
   ax1.plot(x, y, c='black', label='original')
   ax1.set_title(ID, size=15)
@@ -245,17 +337,21 @@ def save_figure_bm(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval
     ax3.text(0.1, 0.8, 'SELECTED\n refval=''{:.3f}'.format(refval), size=18, color='magenta', transform=ax3.transAxes, zorder=2)
     ax3.text(0.6, 0.58, 'refnum: '+str(refnum), transform=ax3.transAxes)
   
-  plt.savefig(os.path.join(output_directory, ID+'_histogram.jpeg'))
+  savefig(fig, os.path.join(output_directory, ID+'_histogram.jpeg'))
+  if close:
+    plt.close(fig)
   return
 
 def save_parameters(data, txtfile):
-  f=open(txtfile, 'a', encoding='UTF-8')
-  for d in data[:-1]:
-    f.write(str(d))
-    f.write('\t')
-  f.write(str(data[-1]))
-  f.write('\n')
-  f.close()
+  # One write per row under an exclusive lock, so that concurrent runs never interleave rows
+  line='\t'.join([str(d) for d in data])+'\n'
+  fd=os.open(txtfile, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    os.write(fd, line.encode('UTF-8'))
+  finally:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
   return
   
 def save_refnii_bi(img, g1, g2, llim, ulim, w, h, a, fname):
@@ -263,21 +359,23 @@ def save_refnii_bi(img, g1, g2, llim, ulim, w, h, a, fname):
     save_refnii_mono(img, llim, ulim, h, a, fname)
     return
   else:
-    weights=img.copy()
-    weights[img<llim]=ulim
-    weights[img>ulim]=ulim
-    weights=g1(weights)/(g1(weights)+g2(weights))
-    weights[img<llim]=0
-    weights[img>ulim]=0
-    reference_nii=nib.Nifti1Image(weights, header=h, affine=a)
-    nib.save(reference_nii, fname)
+    # The weights of the voxels within [llim, ulim] are evaluated in float64
+    sel=ge(img, llim) & le(img, ulim)
+    values=img[sel].astype(np.float64)
+    weights=np.zeros(img.shape, dtype=get_dtype())
+    weights[sel]=g1(values)/(g1(values)+g2(values))
+    save_refnii(weights, h, a, fname)
   return
   
 def save_refnii_mono(img, llim, ulim, h, a, fname):
-  img[img<llim]=0
-  img[img>ulim]=0
-  img[img>0]=1
-  reference_nii=nib.Nifti1Image(img, header=h, affine=a)
+  out=np.where(ge(img, llim) & le(img, ulim), img, 0).astype(get_dtype())
+  out[out>0]=1
+  save_refnii(out, h, a, fname)
+  return
+
+def save_refnii(data, h, a, fname):
+  reference_nii=nib.Nifti1Image(data, header=h, affine=a)
+  reference_nii.set_data_dtype(get_dtype())
   nib.save(reference_nii, fname)
   return
 
@@ -293,97 +391,120 @@ def get_tertile(y):
     
   return max(0, t1-1), max(0, t2-1)
   
-if __name__ == '__main__':
-  # Check input variables
-  args=sys.argv
-  if check_args(args):
-    ID=args[1]
-    pet, probmap=load_img(args[2:4])
-    img_header=load_img_header(args[3])
-    img_affine=load_img_affine(args[3])
-    output_directory=args[4]
+def needs_monomodal(x, popt, histcutoff=histcutoff):
+  # The monomodal fitting is tried when the second peak is inside the histogram and higher than the first peak
+  a1, b1, c1, a2, b2, c2=popt
+  return b2 < x[-1] and get_gaussian(a1, b1, c1)(b1)<get_gaussian(a2, b2, c2)(b2)*histcutoff
+
+def fit_monomodal(x, y):
+  # Monomodal parameters (am, bm, cm) and their Dice coefficient with the histogram
+  am, bm, cm=monomodal_curve_fitting(x, y)
+  return (am, bm, cm), calc_dsc(x, y, get_gaussian(am, bm, cm))
+
+def select_reference(pet_gm, popt, params_mono, dsc, dsc_thr=dsc_thr, fwhm_area=fwhm_area, weighting=weighting):
+  # FWHM range of the selected distribution, number of voxels and reference value
+  a1, b1, c1, a2, b2, c2=popt
+  am, bm, cm=params_mono
+  if dsc<dsc_thr:
+    FWHM_min, FWHM_max=calc_FWHM(b1, c1, fwhm_area)
+    if weighting==True:
+      refnum, refval=calc_refval_bi(pet_gm.copy(), get_gaussian(a1, b1, c1), get_gaussian(a2, b2, c2), FWHM_min, FWHM_max)
+    else:
+      refnum, refval=calc_refval_mono(pet_gm.copy(), FWHM_min, FWHM_max)
   else:
-    exit()
-  
-  # Convert probability map to mask image
-  #eroded_probmap=get_erodedmap(probmap)
-  msk=probmap.copy()
-  msk[msk<0.9]=0
-  msk[msk>0]=1
-  
-  # Get PET values inside the mask
-  pet_gm=get_values_in_mask(pet, msk)
+    FWHM_min, FWHM_max=calc_FWHM(bm, cm, fwhm_area)
+    refnum, refval=calc_refval_mono(pet_gm.copy(), FWHM_min, FWHM_max)
+  return FWHM_min, FWHM_max, refnum, refval
+
+def estimate_reference(pet, msk, dsc_thr=dsc_thr, bin_width=bin_width, fwhm_area=fwhm_area, histcutoff=histcutoff, weighting=weighting, fit_workers=fit_workers):
+  # Get PET values inside the mask (the histogram and the fittings are computed in float64)
+  pet_gm=get_values_in_mask(pet, msk).astype(np.float64)
+  return estimate_reference_values(pet_gm, dsc_thr, bin_width, fwhm_area, histcutoff, weighting, fit_workers)
+
+def estimate_reference_values(pet_gm, dsc_thr=dsc_thr, bin_width=bin_width, fwhm_area=fwhm_area, histcutoff=histcutoff, weighting=weighting, fit_workers=fit_workers):
+  # pet_gm: non-zero PET values inside the mask (e.g. from the voxel cache of get_suvr.py)
   x, y=data2dist(pet_gm, bin_width)
   
   # Bimodal Curve Fitting
-  #params=[pow(2*np.pi, 1/2)*np.max(y)/2, 1.0, 0.2, pow(2*np.pi, 1/2)*np.max(y)/2, 1.5, 0.2]
-  t1, t2=get_tertile(y)
-  list_params=[
-    [np.max(y)/2, 1.0, 0.2, np.max(y)/2, 1.5, 0.2],
-    [np.max(y)/2, x[t1], 0.2, np.max(y)/2, x[t2], 0.2],
-    [np.max(y)*0.66, x[np.argmax(y)], 0.2, np.max(y)*0.34, x[np.argmax(y)], 0.2],
-    [np.max(y)*0.66, x[t1], 0.2, np.max(y)*0.34, x[t2], 0.2],
-    [np.max(y)/2, 1.0, 0.2, np.max(y)/2, 1.5, 0.2],
-    [np.max(y)/2, x[t1], 0.2, np.max(y)/2, x[t2], 0.2],
-    [np.max(y)*0.66, x[np.argmax(y)], 0.2, np.max(y)*0.34, x[np.argmax(y)], 0.2],
-    [np.max(y)*0.66, x[t1], 0.2, np.max(y)*0.34, x[t2], 0.2],
-  ]
-  list_param_bounds=[
-    [[0]*6, [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0]*6, [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0]*6, [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0]*6, [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0, x[0], 0, 0, x[0], 0], [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0, x[0], 0, 0, x[0], 0], [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0, x[0], 0, 0, x[0], 0], [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-    [[0, x[0], 0, 0, x[0], 0], [1.5*np.max(y), 5, 5, 1.5*np.max(y), 10, 5]],
-  ]
-  
-  for params, param_bounds in zip(list_params, list_param_bounds):
-    try:
-      a1, b1, c1, a2, b2, c2=bimodal_curve_fitting(x, y, params, param_bounds)
-    except:
-      continue
-    else:
-      break
-  else:
+  fit_start=time.perf_counter()
+  fit=multistart_bimodal_curve_fitting(x, y, fit_workers)
+  fit_time=time.perf_counter()-fit_start
+  if fit is None:
     # Error at Curve Fitting
-    sys.stdout.write('0')
-    exit()
-  
-  g1=get_gaussian(a1, b1, c1)
-  g2=get_gaussian(a2, b2, c2)
+    return None
+  popt, rss, start, nstarts=fit
+  a1, b1, c1, a2, b2, c2=popt
   
   # Monomodal Curve Fitting if necessary
-  if b2 < x[-1] and g1(b1)<g2(b2)*histcutoff:
-    am, bm, cm=monomodal_curve_fitting(x, y)
-    gm=get_gaussian(am, bm, cm)
-    dsc=calc_dsc(x, y, gm)
+  if needs_monomodal(x, popt, histcutoff):
+    (am, bm, cm), dsc=fit_monomodal(x, y)
   else:
     am, bm, cm=0, 0, 0
     dsc=-1
   
   # Calculate FWHM range and reference value.
-  if dsc<dsc_thr:
-    FWHM_min, FWHM_max=calc_FWHM(b1, c1)
-    if weighting==True:
-      refnum, refval=calc_refval_bi(pet_gm, g1, g2, FWHM_min, FWHM_max)
-    else:
-      refnum, refval=calc_refval_mono(pet_gm, FWHM_min, FWHM_max)
-  else:
-    FWHM_min, FWHM_max=calc_FWHM(bm, cm)
-    refnum, refval=calc_refval_mono(pet_gm, FWHM_min, FWHM_max)
+  FWHM_min, FWHM_max, refnum, refval=select_reference(pet_gm, popt, (am, bm, cm), dsc, dsc_thr, fwhm_area, weighting)
+  
+  return ReferenceResult(refval, refnum, len(pet_gm), (a1, b1, c1, a2, b2, c2), (am, bm, cm), dsc, dsc_thr, FWHM_min, FWHM_max, weighting, x, y, rss, start, nstarts, fit_time)
 
-  # Output histogram figure
-  save_figure(x, y, a1, b1, c1, a2, b2, c2, am, bm, cm, dsc, refnum, refval, dsc_thr, ID, output_directory)
+def save_reference(ID, result, pet, msk, img_header, img_affine, mask_name, output_directory):
+  a1, b1, c1, a2, b2, c2=result.params
+  am, bm, cm=result.params_mono
+  
+  # Output histogram figure (only the data with TQ_DEFER_FIGURES, to be rendered by tq_report.py)
+  with timed('get_ref.plot', ID=ID):
+    if defer_figures():
+      save_histogram_data(ID, result, output_directory)
+    else:
+      save_figure(result.x, result.y, a1, b1, c1, a2, b2, c2, am, bm, cm, result.dsc, result.refnum, result.refval, result.dsc_thr, ID, output_directory)
   
   # Output reference image and histogram parameters
-  if dsc<dsc_thr:
-    save_refnii_bi(pet*msk, g1, g2, FWHM_min, FWHM_max, weighting, img_header, img_affine, os.path.join(output_directory, ID+'_reference.nii'))
-    save_parameters([ID, args[3], len(pet_gm), a1, b1, c1, a2, b2, c2, FWHM_min, FWHM_max, refnum, refval], os.path.join(output_directory, 'histogram_parameters.txt'))
+  with timed('get_ref.save', ID=ID):
+    if result.dsc<result.dsc_thr:
+      g1=get_gaussian(a1, b1, c1)
+      g2=get_gaussian(a2, b2, c2)
+      save_refnii_bi(pet*msk, g1, g2, result.FWHM_min, result.FWHM_max, result.weighting, img_header, img_affine, os.path.join(output_directory, ID+'_reference.nii'))
+      save_parameters([ID, mask_name, result.voxnum, a1, b1, c1, a2, b2, c2, result.FWHM_min, result.FWHM_max, result.refnum, result.refval], os.path.join(output_directory, 'histogram_parameters.txt'))
+    else:
+      save_refnii_mono(pet*msk, result.FWHM_min, result.FWHM_max, img_header, img_affine, os.path.join(output_directory, ID+'_reference.nii'))
+      save_parameters([ID, mask_name, result.voxnum, am, bm, cm, 0, 0, 0, result.FWHM_min, result.FWHM_max, result.refnum, result.refval], os.path.join(output_directory, 'histogram_parameters.txt'))
+  return
+
+def log_result(ID, result):
+  # Wall time and chosen parameters of the bimodal fitting are written to stderr
+  if result is None:
+    sys.stderr.write(ID+': bimodal fitting failed\n')
   else:
-    save_refnii_mono(pet*msk, FWHM_min, FWHM_max, img_header, img_affine, os.path.join(output_directory, ID+'_reference.nii'))
-    save_parameters([ID, args[3], len(pet_gm), am, bm, cm, 0, 0, 0, FWHM_min, FWHM_max, refnum, refval], os.path.join(output_directory, 'histogram_parameters.txt'))
+    sys.stderr.write(ID+': bimodal fitting {:.3f} s, start {}/{}, rss {:.4g}, params '.format(result.fit_time, result.start+1, result.nstarts, result.rss)+' '.join(['{:.4g}'.format(p) for p in result.params])+'\n')
+  return
 
+def run_subject(ID, pet_path, mask_path, output_directory):
+  with timed('get_ref.load', ID=ID):
+    pet, probmap=load_img([pet_path, mask_path])
+    img_header=load_img_header(mask_path)
+    img_affine=load_img_affine(mask_path)
+  
+  # Convert probability map to mask image
+  #eroded_probmap=get_erodedmap(probmap)
+  msk=ge(probmap, 0.9).astype(np.uint8)
+  
+  with timed('get_ref.fit', ID=ID):
+    result=estimate_reference(pet, msk)
+  log_result(ID, result)
+  if result is None:
+    # Error at Curve Fitting
+    return 0
+  
+  save_reference(ID, result, pet, msk, img_header, img_affine, mask_path, output_directory)
+  return result.refval
+  
+if __name__ == '__main__':
+  # Check input variables
+  args=sys.argv
+  if check_args(args):
+    refval=run_subject(args[1], args[2], args[3], args[4])
+  else:
+    exit()
+  
   sys.stdout.write(str(refval))
   exit()
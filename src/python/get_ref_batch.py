@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q get_ref_batch.py
+### Objectives:
+# This script runs the reference value determination of get_ref.py for a whole cohort in one interpreter.
+# Subjects are processed in parallel by a process pool, so the library import cost is paid once per worker
+# instead of once per subject.
+
+### Usage:
+# python get_ref_batch.py [manifest] [output directory] [number of workers (optional)]
+# The manifest is a tab-separated text file with one subject per line:
+#   ID<TAB>static PET image<TAB>mask image specifying the target region
+# "ID<TAB>reference value" is returned as standard output for each subject, in the order of the manifest.
+# A reference value of 0 means that the curve fitting failed, and NA means that the subject could not be processed.
+
+### Main Outputs:
+# - output_directory/${ID}_histogram.jpeg and output_directory/${ID}_reference.nii for each subject (see get_ref.py)
+# - output_directory/histogram_parameters.txt: one row is appended per subject.
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys
+from concurrent.futures import ProcessPoolExecutor
+
+import get_ref
+
+def load_manifest(path):
+  rows=[]
+  with open(path, encoding='UTF-8') as f:
+    for line in f:
+      line=line.rstrip('\n')
+      if line=='' or line.startswith('#'):
+        continue
+      ID, pet, msk=line.split('\t')[:3]
+      rows.append((ID, pet, msk))
+  return rows
+
+def get_max_workers():
+  return max(1, (os.cpu_count() or 1)-1)
+
+def call_subject(func, ID, *args):
+  # Errors of one subject are reported and do not stop the other subjects
+  try:
+    return func(ID, *args)
+  except Exception as e:
+    sys.stderr.write(os.path.basename(sys.argv[0])+': '+ID+': '+repr(e)+'\n')
+    return None
+
+def run_pool(func, rows, max_workers=None):
+  # Call func(*row) for each row with a process pool; results are returned in the order of rows.
+  if max_workers is None:
+    max_workers=get_max_workers()
+  max_workers=max(1, min(max_workers, len(rows)))
+  
+  if max_workers==1:
+    return [call_subject(func, *row) for row in rows]
+  
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    futures=[executor.submit(call_subject, func, *row) for row in rows]
+    return [future.result() for future in futures]
+
+def run_batch(rows, output_directory, max_workers=None):
+  return run_pool(get_ref.run_subject, [(ID, pet, msk, output_directory) for ID, pet, msk in rows], max_workers)
+
+if __name__ == '__main__':
+  args=sys.argv
+  if len(args)<3:
+    sys.stderr.write('Usage: get_ref_batch.py [manifest] [output directory] [number of workers]\n')
+    exit(1)
+  
+  rows=load_manifest(args[1])
+  max_workers=int(args[3]) if len(args)>3 else None
+  refvals=run_batch(rows, args[2], max_workers)
+  
+  for (ID, pet, msk), refval in zip(rows, refvals):
+    sys.stdout.write(ID+'\t'+('NA' if refval is None else str(refval))+'\n')
+  exit()
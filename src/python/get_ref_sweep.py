@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q get_ref_sweep.py
+### Objectives:
+# This script evaluates the histogram-based reference of get_ref.py over a grid of its parameters
+# (mask threshold, bin width, histcutoff, dsc_thr, fwhm_area and weighting) for a whole cohort,
+# without editing get_ref.py and running tq_30 again for each parameter set.
+# The values inside the mask are read from the voxel cache (voxel_cache.py) for each mask threshold;
+# the images of a subject are loaded (once) only for the thresholds that are not in the cache.
+# The histogram and the curve fittings are computed once for each bin width and reused for the other parameters.
+# Subjects are processed in parallel by the process pool of get_ref_batch.py. No image is written.
+
+### Usage:
+# python get_ref_sweep.py -t [c1|c2] [-o output table] [-j workers] [--msk-thr 0.9,...] [--bin-width 0.025,...]
+#                         [--histcutoff 0.5,...] [--dsc-thr 0.936,...] [--fwhm-area 1.0,...] [--weighting 1,0] ID [ID ...]
+#   -t: probability map used as the reference region (c1: gray matter, c2: white matter)
+#   Each parameter is a comma-separated list of values (default: the value of get_ref.py).
+# The input files are the same as get_suvr.py.
+
+### Main Outputs:
+# - Tab-separated table (standard output unless -o is given) with one row per (subject, parameter set):
+#   ID, tissue, the parameters, voxnum, dsc, selected fitting (bimodal or monomodal), FWHM_min, FWHM_max, refnum and refval.
+#   refval is NA when the bimodal fitting failed.
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import sys, argparse, itertools
+from collections import OrderedDict
+
+import get_ref
+import get_suvr
+from get_ref_batch import run_pool
+from tq_instrument import timed
+
+PARAMS=['msk_thr', 'bin_width', 'histcutoff', 'dsc_thr', 'fwhm_area', 'weighting']
+COLUMNS=['ID', 'tissue']+PARAMS+['voxnum', 'dsc', 'selected', 'FWHM_min', 'FWHM_max', 'refnum', 'refval']
+
+def get_default_grid():
+  return OrderedDict([('msk_thr', [0.9]), ('bin_width', [get_ref.bin_width]), ('histcutoff', [get_ref.histcutoff]),
+                      ('dsc_thr', [get_ref.dsc_thr]), ('fwhm_area', [get_ref.fwhm_area]), ('weighting', [get_ref.weighting])])
+
+def parse_values(text, name):
+  if name=='weighting':
+    return [value.strip().lower() in ['1', 'true', 'yes'] for value in text.split(',')]
+  return [float(value) for value in text.split(',')]
+
+def sweep_values(pet_gm, grid):
+  # Rows (dict) of all parameter sets except the mask threshold for the values inside the mask
+  rows=[]
+  for bin_width in grid['bin_width']:
+    x, y=get_ref.data2dist(pet_gm, bin_width)
+    fit=get_ref.multistart_bimodal_curve_fitting(x, y, get_ref.fit_workers)
+    mono=None
+    for histcutoff, dsc_thr, fwhm_area, weighting in itertools.product(grid['histcutoff'], grid['dsc_thr'], grid['fwhm_area'], grid['weighting']):
+      row=OrderedDict([('bin_width', bin_width), ('histcutoff', histcutoff), ('dsc_thr', dsc_thr), ('fwhm_area', fwhm_area),
+                       ('weighting', weighting), ('voxnum', len(pet_gm))])
+      rows.append(row)
+      if fit is None:
+        row.update([('dsc', 'NA'), ('selected', 'NA'), ('FWHM_min', 'NA'), ('FWHM_max', 'NA'), ('refnum', 'NA'), ('refval', 'NA')])
+        continue
+      popt=fit[0]
+      if get_ref.needs_monomodal(x, popt, histcutoff):
+        # The monomodal fitting does not depend on histcutoff
+        if mono is None:
+          mono=get_ref.fit_monomodal(x, y)
+        params_mono, dsc=mono
+      else:
+        params_mono, dsc=(0, 0, 0), -1
+      FWHM_min, FWHM_max, refnum, refval=get_ref.select_reference(pet_gm, popt, params_mono, dsc, dsc_thr, fwhm_area, weighting)
+      row.update([('dsc', dsc), ('selected', 'bimodal' if dsc<dsc_thr else 'monomodal'), ('FWHM_min', FWHM_min),
+                  ('FWHM_max', FWHM_max), ('refnum', refnum), ('refval', refval)])
+  return rows
+
+def sweep_subject(ID, tissue, grid):
+  subject=[]
+  def load(msk_thr):
+    if len(subject)==0:
+      with timed('get_ref_sweep.load', ID=ID, tissue=tissue):
+        subject.append(get_suvr.load_subject(ID, tissue))
+    img_pet, img_probmap, brainmask, probmap, pet=subject[0]
+    return pet, get_ref.get_reference_mask(probmap, brainmask, msk_thr)
+
+  rows=[]
+  for msk_thr in grid['msk_thr']:
+    # Same values as get_suvr.py for the mask threshold
+    samples=get_suvr.get_reference_samples(ID, tissue, msk_thr, lambda: load(msk_thr))
+    with timed('get_ref_sweep.fit', ID=ID, tissue=tissue):
+      pet_gm=get_suvr.get_reference_values(samples.arrays['values'])
+      for row in sweep_values(pet_gm, grid):
+        row.update([('ID', ID), ('tissue', tissue), ('msk_thr', msk_thr)])
+        rows.append(row)
+  return rows
+
+def format_table(rows):
+  lines=['\t'.join(COLUMNS)]
+  for row in rows:
+    lines.append('\t'.join([str(row[column]) for column in COLUMNS]))
+  return '\n'.join(lines)+'\n'
+
+def run_sweep(IDs, tissue, grid, max_workers=None):
+  results=run_pool(sweep_subject, [(ID, tissue, grid) for ID in IDs], max_workers)
+  rows=[]
+  for ID, result in zip(IDs, results):
+    if result is None:
+      sys.stderr.write('get_ref_sweep.py: '+ID+' could not be processed\n')
+      continue
+    rows+=result
+  return rows
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Evaluate the histogram-based reference over a grid of parameters.')
+  parser.add_argument('-t', dest='tissue', choices=['c1', 'c2'], required=True)
+  parser.add_argument('-o', dest='output', default=None)
+  parser.add_argument('-j', dest='max_workers', type=int, default=None)
+  for name in PARAMS:
+    parser.add_argument('--'+name.replace('_', '-'), dest=name, default=None)
+  parser.add_argument('IDs', nargs='+')
+  args=parser.parse_args()
+
+  grid=get_default_grid()
+  for name in PARAMS:
+    if getattr(args, name) is not None:
+      grid[name]=parse_values(getattr(args, name), name)
+
+  table=format_table(run_sweep(args.IDs, args.tissue, grid, args.max_workers))
+  if args.output is None:
+    sys.stdout.write(table)
+  else:
+    with open(args.output, 'w', encoding='UTF-8') as f:
+      f.write(table)
+  exit()
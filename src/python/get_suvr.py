@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q get_suvr.py
+### Objectives:
+# This script generates SUVR images using the histogram-based reference of get_ref.py.
+# For each subject, the static PET image, the probability map and the brain mask are loaded once, and
+# mask creation, MEAN/2 scaling, reference determination and division are done in memory.
+# It replaces the fslmaths/fslstats/get_ref.py sequence previously run by tq_30_suvr_im.sh and tq_31_suvr_wm.sh.
+# The PET values inside the reference mask are kept in the voxel cache (voxel_cache.py) for later analyses
+# such as the parameter sweep of get_ref_sweep.py.
+# The images are processed and the SUVR image is written in the precision set by TQ_DTYPE (see tq_dtype.py).
+# With the default float32, the arithmetic is the same as fslmaths.
+
+### Usage:
+# python get_suvr.py -t [c1|c2] -o [output directory] -s [SUVR suffix] [--keep-mod] [-j workers] ID [ID ...]
+#   -t: probability map used as the reference region (c1: gray matter, c2: white matter)
+#   -s: suffix of the SUVR image, e.g. _pmpbb3_suvr or _pmpbb3_suvr_wm
+#   --keep-mod: also save the scaled PET image ${ID}_pmpbb3_dyn_mean_mod.nii.gz
+# The following files are required for each subject:
+#    - ${ID}_pmpbb3_dyn_mean.nii
+#    - [c1|c2]${ID}_t1w_r.nii
+#    - ${ID}_t1w_brain_mask_r.nii
+# "ID<TAB>reference value" is returned as standard output for each subject.
+# A reference value of 0 means that the curve fitting failed, and NA means that the subject could not be processed.
+
+### Main Outputs:
+# - ${ID}${suffix}.nii.gz: SUVR image
+# - [c1|c2]${ID}_t1w_r_eroded.nii.gz: mask of the reference region
+# - output_directory/${ID}_histogram.jpeg, output_directory/${ID}_reference.nii, output_directory/histogram_parameters.txt (see get_ref.py)
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, argparse
+from decimal import Decimal, ROUND_DOWN
+import numpy as np
+import nibabel as nib
+
+import get_ref
+import voxel_cache
+from tq_dtype import get_dtype, load_fdata
+from get_ref_batch import run_pool
+from tq_instrument import timed
+
+# Version of the reference samples in the voxel cache, changed when the masks or the values change
+SAMPLES_VERSION=1
+
+def find_image(basename):
+  for ext in ['.nii', '.nii.gz']:
+    if os.path.exists(basename+ext):
+      return basename+ext
+  raise FileNotFoundError(basename+'.nii')
+
+def get_scaling(pet, msk):
+  # Same as $(echo "scale=5; $(fslstats pet -k msk -M)/2" | bc)
+  return get_scaling_values(pet[msk!=0])
+
+def get_scaling_values(values):
+  # values: PET values inside the mask
+  # fslstats -M is the mean of non-zero voxels, printed with 6 decimals; bc truncates to 5 decimals.
+  values=values[values!=0]
+  MEAN=Decimal('{:.6f}'.format(np.mean(values, dtype=np.float64)))
+  return float((MEAN/2).quantize(Decimal('0.00001'), rounding=ROUND_DOWN))
+
+def save_float32(data, img, fname):
+  # fslmaths writes float32 images with the header of the input image
+  return save_image(data, img, fname, np.float32)
+
+def save_image(data, img, fname, dtype=None):
+  dtype=get_dtype() if dtype is None else dtype
+  out=nib.Nifti1Image(np.asarray(data, dtype=dtype), img.affine, header=img.header)
+  out.set_data_dtype(dtype)
+  out.header.set_slope_inter(1, 0)
+  nib.save(out, fname)
+  return out
+
+def load_subject(ID, tissue):
+  # Static PET, probability map (in the precision of TQ_DTYPE) and brain mask of a subject
+  img_pet=nib.load(find_image(ID+'_pmpbb3_dyn_mean'))
+  img_probmap=nib.load(find_image(tissue+ID+'_t1w_r'))
+  brainmask=np.asanyarray(nib.load(find_image(ID+'_t1w_brain_mask_r')).dataobj)
+  probmap=load_fdata(img_probmap)
+  pet=load_fdata(img_pet)
+  return img_pet, img_probmap, brainmask, probmap, pet
+
+def modulate(pet, msk):
+  # modulate excessive signal distribution as the MEAN == 2.
+  # Arithmetic is done in float32 as fslmaths does.
+  return pet/np.float32(get_scaling(pet, msk))
+
+def get_reference_samples(ID, tissue, msk_thr=0.9, load=None):
+  # PET values (get_dtype()) and flat indices of the voxels of the reference mask, from the voxel cache
+  # load() -> (pet, msk) is called only when they are not in the cache
+  paths=[find_image(ID+'_pmpbb3_dyn_mean'), find_image(tissue+ID+'_t1w_r'), find_image(ID+'_t1w_brain_mask_r')]
+  if load is None:
+    def load():
+      img_pet, img_probmap, brainmask, probmap, pet=load_subject(ID, tissue)
+      return pet, get_ref.get_reference_mask(probmap, brainmask, msk_thr)
+  def build():
+    pet, msk=load()
+    return voxel_cache.mask_arrays(pet, msk), pet.shape
+  return voxel_cache.get_samples(ID, paths, voxel_cache.get_spec('get_suvr.reference', SAMPLES_VERSION, repr(float(msk_thr))), build)
+
+def get_reference_values(values):
+  # Same as get_ref.get_values_in_mask(modulate(pet, msk).astype(np.float64), msk) for the values inside the mask
+  pet_gm=(values.astype(get_dtype())/np.float32(get_scaling_values(values))).astype(np.float64)
+  return pet_gm[pet_gm!=0]
+
+def process_subject(ID, tissue, suffix, output_directory, keep_mod=False):
+  with timed('get_suvr.load', ID=ID, tissue=tissue):
+    img_pet, img_probmap, brainmask, probmap, pet=load_subject(ID, tissue)
+  
+  # Reference region
+  with timed('get_suvr.mask', ID=ID, tissue=tissue):
+    msk=get_ref.get_reference_mask(probmap, brainmask)
+    mask_name=tissue+ID+'_t1w_r_eroded.nii.gz'
+    img_msk=save_float32(msk, img_probmap, mask_name)
+  
+  pet_mod=modulate(pet, msk)
+  if keep_mod:
+    save_float32(pet_mod, img_pet, ID+'_pmpbb3_dyn_mean_mod.nii.gz')
+  
+  # Reference value
+  samples=get_reference_samples(ID, tissue, load=lambda: (pet, msk))
+  with timed('get_ref.fit', ID=ID, tissue=tissue):
+    result=get_ref.estimate_reference_values(get_reference_values(samples.arrays['values']))
+  get_ref.log_result(ID, result)
+  if result is None:
+    return 0
+  get_ref.save_reference(ID, result, pet_mod, msk, img_msk.header, img_msk.affine, mask_name, output_directory)
+  
+  # SUVR image
+  with timed('get_suvr.save', ID=ID, tissue=tissue):
+    dtype=get_dtype()
+    save_image(pet_mod.astype(dtype)/dtype(result.refval), img_pet, ID+suffix+'.nii.gz')
+  return result.refval
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Generate SUVR images with the histogram-based reference.')
+  parser.add_argument('-t', dest='tissue', choices=['c1', 'c2'], required=True)
+  parser.add_argument('-o', dest='output_directory', required=True)
+  parser.add_argument('-s', dest='suffix', required=True)
+  parser.add_argument('-j', dest='max_workers', type=int, default=None)
+  parser.add_argument('--keep-mod', action='store_true')
+  parser.add_argument('IDs', nargs='+')
+  args=parser.parse_args()
+  
+  rows=[(ID, args.tissue, args.suffix, args.output_directory, args.keep_mod) for ID in args.IDs]
+  refvals=run_pool(process_subject, rows, args.max_workers)
+  
+  for ID, refval in zip(args.IDs, refvals):
+    sys.stdout.write(ID+'\t'+('NA' if refval is None else str(refval))+'\n')
+  exit()
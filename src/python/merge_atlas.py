@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q merge_atlas.py
+### Objectives:
+# This script creates a merged atlas, `wmparc_merged`, by combining smaller cortical areas in the wmparc into anatomically unified regions.
+# All merges are applied as one lookup-table remap of the label volume, followed by the substitution of
+# the wmparc Brain-Stem by the brainstem segmentation (segmentBS), so each subject needs one read and one write.
+# The merges are defined by a merge specification (src/tables/merged_spec.tsv by default):
+#   cortical   [label] [target]          : label 1000+n, 2000+n, ... with n==label is relabelled to 1000+target, ...
+#   substitute [label] [atlas] [uthr]    : voxels of the label are replaced by ${ID}_[atlas]_r (values above uthr set to 0)
+
+### Usage:
+# python merge_atlas.py [-s merge specification] ${ID}_wmparc_r.nii.gz [...]
+
+### Main Outputs:
+# - ${ID}_merged_r.nii.gz: The ROI map image of `wmparc_merged` with smaller regions merged into larger, anatomically unified areas.
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, argparse
+import numpy as np
+import nibabel as nib
+
+TABLEDIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tables')
+
+def load_merge_spec(spec):
+  path=spec if os.path.exists(spec) else os.path.join(TABLEDIR, spec+'_spec.tsv')
+  cortical=[]
+  substitute=[]
+  with open(path, encoding='UTF-8') as f:
+    header=f.readline().rstrip('\n').split('\t')
+    for line in f:
+      if line.strip()=='' or line.startswith('#'):
+        continue
+      row=dict(zip(header, line.rstrip('\n').split('\t')))
+      if row['rule']=='cortical':
+        cortical.append((int(row['label']), int(row['target'])))
+      elif row['rule']=='substitute':
+        uthr=float(row['uthr']) if row.get('uthr', '')!='' else None
+        substitute.append((int(row['label']), row['target'], uthr))
+      else:
+        raise ValueError('unknown rule: '+row['rule'])
+  return cortical, substitute
+
+def build_lut(maxlabel, cortical):
+  # Same as fslmaths ${f} -thr 1000 -rem 1000 -thr n -uthr n -sub target -thr 0 and -sub from ${f}:
+  # every label >= 1000 whose remainder is n is moved down to the target of the same block
+  # (-thr 0 drops the rules whose target is above the label). Each rule sees the original labels.
+  lut=np.arange(maxlabel+1, dtype=np.int64)
+  for label, target in cortical:
+    if target>label:
+      continue
+    src=np.arange(1000, maxlabel+1)
+    src=src[src%1000==label]
+    lut[src]=src-label+target
+  return lut
+
+def merge_labels(labels, cortical, substitute=(), atlases={}):
+  # labels: wmparc label volume, atlases: {atlas name: label volume} used by the substitute rules
+  labels=np.rint(labels).astype(np.int64)
+  labels[labels<0]=0
+  merged=build_lut(int(labels.max(initial=0)), cortical)[labels]
+  for label, atlas, uthr in substitute:
+    msk=labels==label
+    values=np.rint(atlases[atlas][msk]).astype(np.int64)
+    if uthr is not None:
+      values[values>uthr]=0
+    merged[msk]=values
+  return merged
+
+def process_file(f, cortical, substitute):
+  img=nib.load(f)
+  atlases={atlas: np.asanyarray(nib.load(f.replace('wmparc', atlas, 1)).dataobj)
+           for atlas in set([rule[1] for rule in substitute])}
+  merged=merge_labels(np.asanyarray(img.dataobj), cortical, substitute, atlases)
+
+  f_merged=f.replace('wmparc', 'merged', 1)
+  img_merged=nib.Nifti1Image(merged.astype(img.get_data_dtype()), img.affine, header=img.header)
+  nib.save(img_merged, f_merged)
+  return f_merged
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Create merged atlases from wmparc label volumes.')
+  parser.add_argument('-s', dest='spec', default='merged')
+  parser.add_argument('files', nargs='*')
+  args=parser.parse_args()
+
+  cortical, substitute=load_merge_spec(args.spec)
+  status=0
+  for f in args.files:
+    print('Get merged wmparc from '+f)
+    try:
+      f_merged=process_file(f, cortical, substitute)
+    except Exception as e:
+      sys.stderr.write('merge_atlas.py: '+f+': '+repr(e)+'\n')
+      status=1
+      continue
+    print('Save '+f_merged)
+  exit(status)
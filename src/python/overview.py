@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q overview.py
+### Objectives:
+# This script is the single entry point of the overviews of a subject, instead of tq_60_overview_axi.sh and
+# tq_61_overview_cor.sh with overlay_view.py and overlay_view_cor.py in separate processes.
+#   - The T1W image is registered to the MNI template with a 9-DOF affine transform (flirt) once, and the same
+#     matrix is applied to the SUVR image. The matrix and the images are written under temporary names unique
+#     to the subject and the process and renamed when done, so that concurrent runs for the same subject
+#     neither share the matrix nor read a partial image. ${ID}_pmpbb3_suvr_l.nii.gz is renamed last.
+#   - Both images are loaded once, and the axial and coronal overviews are rendered in this process by tq_report.py.
+# The grid and the slices of the lightboxes and the resolution of the figures are set by the options.
+
+### Usage:
+# python overview.py [-a lower threshold] [-b upper threshold] [-n] [--views axi,cor] [--grid XxY]
+#                    [--axi START,INTERVAL] [--cor START,INTERVAL] [--dpi DPI] ID
+#   -a, -b: display range of SUVR (default: 1 and 2)
+#   -n: only the affine transform; the figures are rendered later (e.g. by tq_report.py for the cohort)
+#   --grid: rows and columns of the lightboxes (default: 6x5)
+#   --axi, --cor: first slice and interval of the slices (default: 20,4 and 30,5)
+#   --dpi: resolution of the figures (default: 600; TQ_FIG_DPI takes precedence)
+# The MNI template is ${FSLDIR}/data/standard/MNI152_T1_1mm.nii.gz.
+
+### Main Outputs:
+# - ${ID}_t1w_r_l.nii.gz, ${ID}_pmpbb3_suvr_l.nii.gz: images in the MNI space
+# - ${ID}_overview_axi_t1.png, ${ID}_overview_axi_[a]_[b].png, ${ID}_overview_cor_t1.png, ${ID}_overview_cor_[a]_[b].png
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, argparse, subprocess
+
+import tq_report
+
+VIEWS=['axi', 'cor']
+
+def get_reference():
+  return os.path.join(os.environ.get('FSLDIR', ''), 'data', 'standard', 'MNI152_T1_1mm.nii.gz')
+
+def get_names(ID):
+  # (T1W image, T1W in MNI, SUVR image, SUVR in MNI) as tq_60_overview_axi.sh
+  return ID+'_t1w_r.nii', ID+'_t1w_r_l.nii.gz', ID+'_pmpbb3_suvr.nii.gz', ID+'_pmpbb3_suvr_l.nii.gz'
+
+def get_tmp_prefix(ID):
+  return '.'+ID+'_overview_'+str(os.getpid())
+
+def affine_transform(ID, ref=None):
+  # Returns False when the transform is already done
+  t1w, t1w_l, pet, pet_l=get_names(ID)
+  if os.path.exists(pet_l) and os.path.exists(t1w_l):
+    return False
+  ref=get_reference() if ref is None else ref
+  prefix=get_tmp_prefix(ID)
+  mat, tmp_t1w, tmp_pet=prefix+'.mat', prefix+'_t1w_l.nii.gz', prefix+'_pet_l.nii.gz'
+  try:
+    subprocess.run(['flirt', '-dof', '9', '-in', t1w, '-ref', ref, '-omat', mat, '-out', tmp_t1w], check=True)
+    subprocess.run(['flirt', '-dof', '9', '-in', pet, '-ref', ref, '-applyxfm', '-init', mat, '-out', tmp_pet], check=True)
+    os.replace(tmp_t1w, t1w_l)
+    os.replace(tmp_pet, pet_l)
+  finally:
+    for f in [mat, tmp_t1w, tmp_pet]:
+      if os.path.exists(f):
+        os.remove(f)
+  return True
+
+def get_outputs(ID, thr, uthr, views=VIEWS):
+  return {view: (ID+'_overview_'+view+'_t1.png', ID+'_overview_'+view+'_'+thr+'_'+uthr+'.png') for view in views}
+
+def render(ID, thr='1', uthr='2', views=VIEWS, X=tq_report.OVERVIEW_X, Y=tq_report.OVERVIEW_Y, slices=None, dpi=600):
+  t1w, t1w_l, pet, pet_l=get_names(ID)
+  tq_report.render_overview(ID, t1w_l, pet_l, thr, uthr, get_outputs(ID, thr, uthr, views), X, Y, slices, dpi)
+  return
+
+def parse_pair(text, sep):
+  values=[int(v) for v in text.lower().split(sep)]
+  if len(values)!=2:
+    raise argparse.ArgumentTypeError('two integers separated by '+sep+' are required: '+text)
+  return tuple(values)
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Render the axial and coronal overviews of a subject in one process.')
+  parser.add_argument('-a', dest='thr', default='1')
+  parser.add_argument('-b', dest='uthr', default='2')
+  parser.add_argument('-n', dest='no_figure', action='store_true')
+  parser.add_argument('--views', default=','.join(VIEWS))
+  parser.add_argument('--grid', type=lambda t: parse_pair(t, 'x'), default=(tq_report.OVERVIEW_X, tq_report.OVERVIEW_Y))
+  parser.add_argument('--axi', type=lambda t: parse_pair(t, ','), default=tq_report.OVERVIEW_SLICES['axi'])
+  parser.add_argument('--cor', type=lambda t: parse_pair(t, ','), default=tq_report.OVERVIEW_SLICES['cor'])
+  parser.add_argument('--dpi', type=float, default=600)
+  parser.add_argument('ID')
+  args=parser.parse_args()
+
+  views=args.views.split(',')
+  if any([view not in VIEWS for view in views]):
+    parser.error('views must be '+' or '.join(VIEWS))
+  if affine_transform(args.ID):
+    print('Affine transform of '+args.ID)
+  else:
+    print('Affine transform of '+args.ID+' is already done')
+  if args.no_figure:
+    exit()
+  print('Overlay SUVR image onto T1w image')
+  render(args.ID, args.thr, args.uthr, views, args.grid[0], args.grid[1], {'axi': args.axi, 'cor': args.cor}, args.dpi)
+  exit()
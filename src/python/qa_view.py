@@ -4,11 +4,14 @@
 import sys
 import numpy as np
 import nibabel as nib
-import matplotlib.pyplot as plt
 from scipy.ndimage import zoom
 
-def pad2square(mat):
-    n, m=mat.shape
+from tq_instrument import timed
+from tq_dtype import load_fdata
+from tq_report import plt, savefig
+
+def get_pad2square(shape):
+    n, m=shape
     size=max(n, m)
     
     pad_top=(size-n)//2
@@ -16,13 +19,11 @@ def pad2square(mat):
     pad_left=(size-m)//2
     pad_right=size-m-pad_left
     
-    padded=np.pad(mat, ((pad_top, pad_bottom), (pad_left, pad_right)), mode='constant')
-    
-    return padded
+    return (pad_top, pad_bottom), (pad_left, pad_right)
 
-def pad2square_pixdim(mat, pixdims):
-    L1=pixdims[0]*mat.shape[0]
-    L2=pixdims[1]*mat.shape[1]
+def get_pad2square_pixdim(shape, pixdims):
+    L1=pixdims[0]*shape[0]
+    L2=pixdims[1]*shape[1]
     size=max(L1, L2)
 
     pad_top=((size-L1)/pixdims[0])//2
@@ -30,7 +31,15 @@ def pad2square_pixdim(mat, pixdims):
     pad_left=((size-L2)/pixdims[1])//2
     pad_right=(size-L2-pixdims[1]*pad_left)//pixdims[1]
 
-    padded=np.pad(mat, ((pad_top.astype('int16'), pad_bottom.astype('int16')), (pad_left.astype('int16'), pad_right.astype('int16'))), mode='constant')
+    return (pad_top.astype('int16'), pad_bottom.astype('int16')), (pad_left.astype('int16'), pad_right.astype('int16'))
+
+def pad2square(mat):
+    padded=np.pad(mat, get_pad2square(mat.shape), mode='constant')
+    
+    return padded
+
+def pad2square_pixdim(mat, pixdims):
+    padded=np.pad(mat, get_pad2square_pixdim(mat.shape, pixdims), mode='constant')
     return padded
 
 def adjust_size(mat, s=200, interp=1):
@@ -43,6 +52,28 @@ def adjust_size_pixdim(mat, pixdims, s=200, interp=1):
     adjusted=zoom(padded, zoom=s/padded.shape[0], order=interp)
     return adjusted
 
+def adjust_size_stack(mats, s=200, interp=1, pixdims=None):
+    # adjust_size (or adjust_size_pixdim) of each slice of mats (N, rows, cols) in one zoom call.
+    # The zoom factor along the stack axis is 1, so each slice is the same as when resampled alone.
+    pads=get_pad2square(mats.shape[1:]) if pixdims is None else get_pad2square_pixdim(mats.shape[1:], pixdims)
+    padded=np.pad(mats, ((0, 0),)+tuple(pads), mode='constant')
+    factor=s/padded.shape[1]
+    adjusted=zoom(padded, zoom=(1, factor, factor), order=interp)
+    return adjusted
+
+def get_slices(img, idxes):
+    # Axial slices img[:, ::-1, idx].transpose(1, 0) of all idxes (and frames) as one stack
+    slices=img[:, ::-1, idxes]
+    if slices.ndim==3:
+        return slices.transpose(2, 1, 0)
+    # 4D: (frames*idxes, rows, cols) ordered by frame
+    return slices.transpose(3, 2, 1, 0).reshape((-1, slices.shape[1], slices.shape[0]))
+
+def stack2mosaic(stack, n=5):
+    # np.c_ of each group of n slices: (N, rows, cols) -> (N/n, rows, n*cols)
+    k, rows, cols=stack.shape
+    return stack.reshape((k//n, n, rows, cols)).transpose(0, 2, 1, 3).reshape((k//n, rows, n*cols))
+
 def get_display_indexes(img, n=5):
     tmp=img.max(axis=0).max(axis=0)
     nonzeroidxes=np.where(tmp>0)[0]
@@ -52,47 +83,19 @@ def get_display_indexes(img, n=5):
 def get_mat_t1w_pet(img_t1w, img_pet, img_t1w_outline):
     idxes=get_display_indexes(img_t1w_outline)
     
-    mat_t1w_1=adjust_size(img_t1w[:, ::-1, idxes[0]].transpose(1, 0))
-    mat_t1w_2=adjust_size(img_t1w[:, ::-1, idxes[1]].transpose(1, 0))
-    mat_t1w_3=adjust_size(img_t1w[:, ::-1, idxes[2]].transpose(1, 0))
-    mat_t1w_4=adjust_size(img_t1w[:, ::-1, idxes[3]].transpose(1, 0))
-    mat_t1w_5=adjust_size(img_t1w[:, ::-1, idxes[4]].transpose(1, 0))
-    mat_t1w=np.c_[mat_t1w_1, mat_t1w_2, mat_t1w_3, mat_t1w_4, mat_t1w_5]
-
-    mat_pet_1=adjust_size(img_pet[:, ::-1, idxes[0]].transpose(1, 0))
-    mat_pet_2=adjust_size(img_pet[:, ::-1, idxes[1]].transpose(1, 0))
-    mat_pet_3=adjust_size(img_pet[:, ::-1, idxes[2]].transpose(1, 0))
-    mat_pet_4=adjust_size(img_pet[:, ::-1, idxes[3]].transpose(1, 0))
-    mat_pet_5=adjust_size(img_pet[:, ::-1, idxes[4]].transpose(1, 0))
-    mat_pet=np.c_[mat_pet_1, mat_pet_2, mat_pet_3, mat_pet_4, mat_pet_5]
-
-    mat_t1w_outline_1=adjust_size(img_t1w_outline[:, ::-1, idxes[0]].transpose(1, 0), interp=0)
-    mat_t1w_outline_2=adjust_size(img_t1w_outline[:, ::-1, idxes[1]].transpose(1, 0), interp=0)
-    mat_t1w_outline_3=adjust_size(img_t1w_outline[:, ::-1, idxes[2]].transpose(1, 0), interp=0)
-    mat_t1w_outline_4=adjust_size(img_t1w_outline[:, ::-1, idxes[3]].transpose(1, 0), interp=0)
-    mat_t1w_outline_5=adjust_size(img_t1w_outline[:, ::-1, idxes[4]].transpose(1, 0), interp=0)
-    mat_t1w_outline=np.c_[mat_t1w_outline_1, mat_t1w_outline_2, mat_t1w_outline_3, mat_t1w_outline_4, mat_t1w_outline_5]
+    mat_t1w=stack2mosaic(adjust_size_stack(get_slices(img_t1w, idxes)))[0]
+    mat_pet=stack2mosaic(adjust_size_stack(get_slices(img_pet, idxes)))[0]
+    mat_t1w_outline=stack2mosaic(adjust_size_stack(get_slices(img_t1w_outline, idxes), interp=0))[0]
 
     return mat_t1w, mat_pet, mat_t1w_outline
 
 def get_mat_ref(img_ref, img_t1w_outline4pet, l, interp=1):
     idxes=get_display_indexes(img_t1w_outline4pet)
-    mat_ref_1=adjust_size_pixdim(img_ref[:, ::-1, idxes[0]].transpose(1, 0), [l[1], l[0]])
-    mat_ref_2=adjust_size_pixdim(img_ref[:, ::-1, idxes[1]].transpose(1, 0), [l[1], l[0]])
-    mat_ref_3=adjust_size_pixdim(img_ref[:, ::-1, idxes[2]].transpose(1, 0), [l[1], l[0]])
-    mat_ref_4=adjust_size_pixdim(img_ref[:, ::-1, idxes[3]].transpose(1, 0), [l[1], l[0]])
-    mat_ref_5=adjust_size_pixdim(img_ref[:, ::-1, idxes[4]].transpose(1, 0), [l[1], l[0]])
-    mat_ref=np.c_[mat_ref_1, mat_ref_2, mat_ref_3, mat_ref_4, mat_ref_5]
-
-    mat_ref_outline_1=adjust_size_pixdim(img_t1w_outline4pet[:, ::-1, idxes[0]].transpose(1, 0), [l[1], l[0]], interp=0)
-    mat_ref_outline_2=adjust_size_pixdim(img_t1w_outline4pet[:, ::-1, idxes[1]].transpose(1, 0), [l[1], l[0]], interp=0)
-    mat_ref_outline_3=adjust_size_pixdim(img_t1w_outline4pet[:, ::-1, idxes[2]].transpose(1, 0), [l[1], l[0]], interp=0)
-    mat_ref_outline_4=adjust_size_pixdim(img_t1w_outline4pet[:, ::-1, idxes[3]].transpose(1, 0), [l[1], l[0]], interp=0)
-    mat_ref_outline_5=adjust_size_pixdim(img_t1w_outline4pet[:, ::-1, idxes[4]].transpose(1, 0), [l[1], l[0]], interp=0)
-    mat_ref_outline=np.c_[mat_ref_outline_1, mat_ref_outline_2, mat_ref_outline_3, mat_ref_outline_4, mat_ref_outline_5]
+    mat_ref=stack2mosaic(adjust_size_stack(get_slices(img_ref, idxes), pixdims=[l[1], l[0]]))[0]
+    mat_ref_outline=stack2mosaic(adjust_size_stack(get_slices(img_t1w_outline4pet, idxes), pixdims=[l[1], l[0]], interp=0))[0]
     return mat_ref, mat_ref_outline, idxes
 
-def get_qareport_process1(mat_t1w, mat_pet, mat_ref, mode='Mode1'):
+def get_qareport_process1(mat_t1w, mat_pet, mat_ref, ID, l, mode='Mode1'):
     fig=plt.figure(figsize=(8.27, 11.69), dpi=300, facecolor='white')
     if mode=='Mode1':
         figtitle="QA Report (Overlay): Coregistration and Realignment"
@@ -109,14 +112,13 @@ def get_qareport_process1(mat_t1w, mat_pet, mat_ref, mode='Mode1'):
     
     if mode=='Mode1':
         ax1.imshow(mat_t1w, cmap='gray')
-        msk=ax1.imshow(mat_pet, cmap='jet', alpha=0.4).set_clim(0.1, mat_pet.max())
+        ax1.imshow(mat_pet, cmap='jet', alpha=0.4).set_clim(0.1, mat_pet.max())
     
     if mode=='Mode2':
         ax1.imshow(mat_pet, cmap='gray').set_clim(np.percentile(mat_pet, 1), np.percentile(mat_pet, 99))
         outline=np.zeros((mat_t1w.shape[0], mat_t1w.shape[1], 4))
         outline[:, :, 0]=1.0
         outline[:, :, 3]=mat_t1w
-        #msk=ax1.imshow(outline)
         ax1.imshow(outline, interpolation='nearest').set_clim(0, 1)
 
     ax1.axes.xaxis.set_visible(False)
@@ -129,15 +131,17 @@ def get_qareport_process1(mat_t1w, mat_pet, mat_ref, mode='Mode1'):
     ax2.axes.yaxis.set_visible(False)
     return fig
 
-def get_mat_dyn(img_dyn, idxes, l, f_num):
-    mat_dyn=adjust_size_pixdim(img_dyn[:, ::-1, idxes[0], f_num].transpose(1, 0), [l[1], l[0]])
-    for i in range(1, 5):
-        mat_dyn=np.c_[mat_dyn, adjust_size_pixdim(img_dyn[:, ::-1, idxes[i], f_num].transpose(1, 0), [l[1], l[0]])]
-    return mat_dyn
+def get_mat_dyn_all(img_dyn, idxes, l):
+    # Mosaics of all frames (frames, rows, 5*cols), the slices of all frames being resampled at once
+    return stack2mosaic(adjust_size_stack(get_slices(img_dyn, idxes), pixdims=[l[1], l[0]]), n=len(idxes))
 
-def get_mat_dyn_multiple(img_dyn, idxes, l, start_num):
-    mat_dyn_multiple=[get_mat_dyn(img_dyn, idxes, l, i) for i in range(start_num, start_num+4) if i<img_dyn.shape[3]]
-    return mat_dyn_multiple
+def remove_artists(fig, n_axes, n_texts):
+    # Remove the axes and texts added after the first n_axes axes and n_texts texts
+    for ax in fig.axes[n_axes:]:
+        ax.remove()
+    for text in fig.texts[n_texts:]:
+        text.remove()
+    return
 
 def get_qareport_process2(fig, mat_ref, mat_dyn_multiple, l, start_num, N_frame, mode='Mode1'):
     axs=[]
@@ -163,73 +167,116 @@ def get_qareport_process2(fig, mat_ref, mat_dyn_multiple, l, start_num, N_frame,
         
     return fig
 
-if __name__=="__main__":
-    ID=sys.argv[1]
-    t1w=sys.argv[2]
-    pet_mean=sys.argv[3]
-    pet_dyn=sys.argv[4]
-    pet_ref=sys.argv[5]
+def get_crop_ranges(center, size, shape):
+    # Index ranges (start, stop) of the FOV of the given size around center in an image of the given shape
+    return [(max(int(c-n/2), 0), min(int(c+n/2), int(m-1))) for c, n, m in zip(center, size, shape)]
+
+def read_slices(dataobj, ranges, zs, frames=None, pad=1):
+    # img[x0:x1, y0:y1, zs, f0:f1] of the image zero-padded by pad voxels on the spatial axes,
+    # where ranges=[(x0, x1), (y0, y1)] and zs are indexes of the padded image and frames=(f0, f1).
+    # Only the voxels of the requested slices and frames inside the image are read from the proxy.
+    # The slices keep the precision of the image (at least float32 for scaled integers); matplotlib converts them for display.
+    shape=dataobj.shape
+    n_frames=shape[3] if len(shape)>3 else 1
+    (x0, x1), (y0, y1)=ranges
+    f0, f1=(0, n_frames) if frames is None else frames
+    out=np.zeros((x1-x0, y1-y0, len(zs), f1-f0), dtype=np.result_type(dataobj.dtype, np.float32))
+
+    u0, u1=max(x0-pad, 0), min(x1-pad, shape[0])
+    v0, v1=max(y0-pad, 0), min(y1-pad, shape[1])
+    if u0>=u1 or v0>=v1:
+        return out
+    for i, z in enumerate(zs):
+        if not 0<=z-pad<shape[2]:
+            continue
+        if len(shape)>3:
+            block=dataobj[u0:u1, v0:v1, z-pad, f0:f1]
+        else:
+            block=dataobj[u0:u1, v0:v1, z-pad][:, :, np.newaxis]
+        out[u0+pad-x0:u1+pad-x0, v0+pad-y0:v1+pad-y0, i]=block
+    return out
+
+def render_qa(ID, t1w, pet_mean, pet_dyn, pet_ref, pdf=False):
+    # pdf: save the pages in ${ID}_qareport.pdf and ${ID}_qaoutline.pdf instead of ${ID}_qareport_N.png and ${ID}_qaoutline_N.png
 
     # Load Data
-    img_t1w=nib.load(t1w).get_fdata()
-    img_t1w_outline=nib.load(ID+'_t1w_brain_outline_r.nii').get_fdata()
-    img_t1w_outline4pet=nib.load(ID+'_t1w_brain_outline4pet.nii').get_fdata()
-    img_pet=nib.load(pet_mean).get_fdata()
-    img_dyn=nib.load(pet_dyn).get_fdata()
-    if len(img_dyn.shape)==3:
-        img_dyn=img_dyn.reshape(list(img_dyn.shape)+[1])
-    img_dyn=np.pad(img_dyn, pad_width=((1, 1), (1, 1), (1, 1), (0, 0)), mode='constant')
-    img_ref=np.pad(nib.load(pet_ref).get_fdata(), pad_width=((1, 1), (1, 1), (1, 1)), mode='constant')
-
-    # Determine FOV
-    head_pet=nib.load(pet_mean).header
-    fov=head_pet['pixdim'][1:4]*head_pet['dim'][1:4]
-
-    l=nib.load(pet_ref).header['pixdim'][1:4]
-    size=(fov//l).astype('int16')
-
-    xaxis_sum=img_ref.sum(axis=1).sum(axis=1)
-    yaxis_sum=img_ref.sum(axis=2).sum(axis=0)
-    zaxis_sum=img_ref.sum(axis=0).sum(axis=0)
-
-    Gx=np.average(np.arange(xaxis_sum.size), weights=xaxis_sum)
-    Gy=np.average(np.arange(yaxis_sum.size), weights=yaxis_sum)
-    Gz=np.average(np.arange(zaxis_sum.size), weights=zaxis_sum)
-
-    # Crop images within FOV
-    img_ref=img_ref[max(int(Gx-size[0]/2), 0):min(int(Gx+size[0]/2), int(img_ref.shape[0]-1)),
-                    max(int(Gy-size[1]/2), 0):min(int(Gy+size[1]/2), int(img_ref.shape[1]-1)),
-                    max(int(Gz-size[2]/2), 0):min(int(Gz+size[2]/2), int(img_ref.shape[2]-1))]
-    img_t1w_outline4pet=img_t1w_outline4pet[max(int(Gx-size[0]/2), 0):min(int(Gx+size[0]/2), int(img_t1w_outline4pet.shape[0]-1)),
-                    max(int(Gy-size[1]/2), 0):min(int(Gy+size[1]/2), int(img_t1w_outline4pet.shape[1]-1)),
-                    max(int(Gz-size[2]/2), 0):min(int(Gz+size[2]/2), int(img_t1w_outline4pet.shape[2]-1))]
-    img_dyn=img_dyn[max(int(Gx-size[0]/2), 0):min(int(Gx+size[0]/2), int(img_dyn.shape[0]-1)),
-                    max(int(Gy-size[1]/2), 0):min(int(Gy+size[1]/2), int(img_dyn.shape[1]-1)),
-                    max(int(Gz-size[2]/2), 0):min(int(Gz+size[2]/2), int(img_dyn.shape[2]-1)), :]
-
-    # Image to Matrix
-    mat_t1w, mat_pet, mat_t1w_outline=get_mat_t1w_pet(img_t1w, img_pet, img_t1w_outline)
-    mat_ref, mat_ref_outline, idxes=get_mat_ref(img_ref, img_t1w_outline4pet, l)
+    # The dynamic PET is not loaded: the displayed slices are read from the proxy for each page of frames
+    with timed('qa_view.load', ID=ID):
+        img_t1w=load_fdata(nib.load(t1w))
+        img_t1w_outline=load_fdata(nib.load(ID+'_t1w_brain_outline_r.nii'))
+        img_t1w_outline4pet=load_fdata(nib.load(ID+'_t1w_brain_outline4pet.nii'))
+        img_pet=load_fdata(nib.load(pet_mean))
+        dyn=nib.load(pet_dyn).dataobj
+        n_frames=dyn.shape[3] if len(dyn.shape)>3 else 1
+        img_ref=np.pad(load_fdata(nib.load(pet_ref)), pad_width=((1, 1), (1, 1), (1, 1)), mode='constant')
+
+    with timed('qa_view.prepare', ID=ID):
+        # Determine FOV
+        head_pet=nib.load(pet_mean).header
+        fov=head_pet['pixdim'][1:4]*head_pet['dim'][1:4]
+
+        l=nib.load(pet_ref).header['pixdim'][1:4]
+        size=(fov//l).astype('int16')
+
+        xaxis_sum=img_ref.sum(axis=1).sum(axis=1)
+        yaxis_sum=img_ref.sum(axis=2).sum(axis=0)
+        zaxis_sum=img_ref.sum(axis=0).sum(axis=0)
+
+        Gx=np.average(np.arange(xaxis_sum.size), weights=xaxis_sum)
+        Gy=np.average(np.arange(yaxis_sum.size), weights=yaxis_sum)
+        Gz=np.average(np.arange(zaxis_sum.size), weights=zaxis_sum)
+
+        # Crop images within FOV (the dynamic PET, padded by 1 voxel, is cropped when it is read)
+        (x0, x1), (y0, y1), (z0, z1)=get_crop_ranges((Gx, Gy, Gz), size, img_ref.shape)
+        img_ref=img_ref[x0:x1, y0:y1, z0:z1]
+        (x0, x1), (y0, y1), (z0, z1)=get_crop_ranges((Gx, Gy, Gz), size, img_t1w_outline4pet.shape)
+        img_t1w_outline4pet=img_t1w_outline4pet[x0:x1, y0:y1, z0:z1]
+        ranges_dyn=get_crop_ranges((Gx, Gy, Gz), size, [n+2 for n in dyn.shape[:3]])
+
+        # Image to Matrix
+        mat_t1w, mat_pet, mat_t1w_outline=get_mat_t1w_pet(img_t1w, img_pet, img_t1w_outline)
+        mat_ref, mat_ref_outline, idxes=get_mat_ref(img_ref, img_t1w_outline4pet, l)
+        zs=[ranges_dyn[2][0]+i for i in idxes]
 
     # Create Summary
-    for i in range((img_dyn.shape[3]-1)//4+1):
-        # QA Report
-        fig1=get_qareport_process1(mat_t1w, mat_pet, mat_ref)
-        mat_dyn_multiple=get_mat_dyn_multiple(img_dyn, idxes, l, 4*i)
-        fig2=get_qareport_process2(fig1, mat_ref, mat_dyn_multiple, l, 4*i, img_dyn.shape[3])
-        fig2.savefig(f'{ID}_qareport_{i+1}.png')
-        fig1.clear()
-        fig2.clear()
-        plt.close(fig1)
-        plt.close(fig2)
-
-        # QA Report (outline)
-        fig1=get_qareport_process1(mat_t1w_outline, mat_pet, mat_ref, mode='Mode2')
-        fig2=get_qareport_process2(fig1, mat_ref_outline, mat_dyn_multiple, l, 4*i, img_dyn.shape[3], mode='Mode2')
-        fig2.savefig(f'{ID}_qaoutline_{i+1}.png')
-        fig1.clear()
-        fig2.clear()
-        plt.close(fig1)
-        plt.close(fig2)
+    # The header panels (T1W/PET and target image) are drawn once for each mode,
+    # and only the panels of the frames are replaced for each page.
+    modes=[('Mode1', mat_t1w, mat_ref, 'qareport'), ('Mode2', mat_t1w_outline, mat_ref_outline, 'qaoutline')]
+    figs=[]
+    for mode, mat_header, mat_frame_ref, name in modes:
+        with timed('qa_view.plot', ID=ID):
+            fig=get_qareport_process1(mat_header, mat_pet, mat_ref, ID, l, mode=mode)
+            figs.append((fig, len(fig.axes), len(fig.texts)))
+    if pdf:
+        from matplotlib.backends.backend_pdf import PdfPages
+        pdf_pages=[PdfPages(f'{ID}_{name}.pdf') for mode, mat_header, mat_frame_ref, name in modes]
+
+    # The frames of each page are read and resampled in turn, so that the memory does not depend on the number of frames
+    for i in range((n_frames-1)//4+1):
+        with timed('qa_view.prepare', ID=ID):
+            frames=read_slices(dyn, ranges_dyn[:2], zs, (4*i, min(4*i+4, n_frames)))
+            mat_dyn_multiple=list(get_mat_dyn_all(frames, list(range(len(zs))), l))
+        for k, ((mode, mat_header, mat_frame_ref, name), (fig, n_axes, n_texts)) in enumerate(zip(modes, figs)):
+            with timed('qa_view.plot', ID=ID):
+                get_qareport_process2(fig, mat_frame_ref, mat_dyn_multiple, l, 4*i, n_frames, mode=mode)
+            with timed('qa_view.save', ID=ID):
+                if pdf:
+                    pdf_pages[k].savefig(fig)
+                else:
+                    savefig(fig, f'{ID}_{name}_{i+1}.png')
+            remove_artists(fig, n_axes, n_texts)
+
+    for fig, n_axes, n_texts in figs:
+        fig.clear()
+        plt.close(fig)
+    if pdf:
+        for pages in pdf_pages:
+            pages.close()
+    return
+
+if __name__=="__main__":
+    pdf='--pdf' in sys.argv
+    args=[arg for arg in sys.argv if arg!='--pdf']
+    render_qa(args[1], args[2], args[3], args[4], args[5], pdf)
 
     exit()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q realign.py
+### Objectives:
+# This script realigns the frames of a dynamic PET image to its first frame in memory.
+# It replaces fslsplit, fslreorient2std, flirt -dof 6 -cost normmi for each frame, avscale, fslmerge and
+# fslmaths -Tmean of tq_10_realign.sh: the 4D image is loaded once (in the precision of TQ_DTYPE), the rigid motion
+# of each frame is estimated by maximizing the normalized mutual information with the reference frame (frames in
+# parallel with a process pool), and the realigned 4D image and its mean are written at the end.
+# The transforms follow the FLIRT conventions (4x4 matrix from the frame to the reference in scaled mm coordinates,
+# Euler angles of avscale), so Rmax_frame is the same quantity as in coregistration_results_pet.csv.
+
+### Usage:
+# python realign.py [-j workers] [dynamic PET image] [output prefix]
+#   -j: number of worker processes (default: $TQ_NCPUS or number of cores - 1)
+# Rmax_frame (the largest rotation angle of all frames in radians, as sort -nr of avscale) is returned as standard output.
+
+### Main Outputs:
+# - ${prefix}_f0000.nii: reference frame (reoriented as fslreorient2std)
+# - ${prefix}_align.nii: realigned frames
+# - ${prefix}_align_mean.nii: mean of the realigned frames
+# - ${prefix}_align_params.tsv: rotation angles (rad), translations (mm) and cost of each frame
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, argparse
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import gaussian_filter, map_coordinates
+from scipy.optimize import minimize
+from concurrent.futures import ProcessPoolExecutor
+
+from tq_dtype import load_fdata
+from tq_instrument import timed
+
+# Number of bins of the joint histogram
+NBINS=32
+# Coarse-to-fine levels: (sampling step in voxels, smoothing FWHM in mm)
+LEVELS=[(4, 8.0), (2, 4.0), (1, 2.0)]
+# Scale of the rotation parameters for the optimizer (rad -> mm at the radius of the head)
+ROT_SCALE=50.0
+
+def reorient2std(img):
+  # Same axis permutation and flips as fslreorient2std (orientation of MNI152: LAS)
+  ornt=nib.orientations.ornt_transform(nib.io_orientation(img.affine), nib.orientations.axcodes2ornt(('L', 'A', 'S')))
+  data=nib.orientations.apply_orientation(np.asanyarray(img.dataobj), ornt)
+  affine=img.affine.dot(nib.orientations.inv_ornt_aff(ornt, img.shape[:3]))
+  out=nib.Nifti1Image(data, affine, header=img.header)
+  return out
+
+def construct_rotmat_euler(angles):
+  # Rotation matrix of FSL (miscmaths) from the Euler angles (Rx, Ry, Rz) in radians
+  cx, cy, cz=np.cos(angles)
+  sx, sy, sz=np.sin(angles)
+  rx=np.array([[1, 0, 0], [0, cx, sx], [0, -sx, cx]])
+  ry=np.array([[cy, 0, -sy], [0, 1, 0], [sy, 0, cy]])
+  rz=np.array([[cz, sz, 0], [-sz, cz, 0], [0, 0, 1]])
+  return rx.dot(ry).dot(rz)
+
+def rotmat2euler(rotmat):
+  # Euler angles (Rx, Ry, Rz) of a rotation matrix as "Rotation Angles" of avscale
+  cy=np.sqrt(rotmat[0, 0]**2+rotmat[0, 1]**2)
+  if cy<1e-4:
+    return np.array([np.arctan2(-rotmat[2, 1], rotmat[1, 1]), np.arctan2(-rotmat[0, 2], 0.0), 0.0])
+  cz, sz=rotmat[0, 0]/cy, rotmat[0, 1]/cy
+  cx, sx=rotmat[2, 2]/cy, rotmat[1, 2]/cy
+  sy=-rotmat[0, 2]
+  return np.array([np.arctan2(sx, cx), np.arctan2(sy, cy), np.arctan2(sz, cz)])
+
+def params2mat(params, centre):
+  # 4x4 matrix from the frame to the reference (FLIRT .mat) for the rotation (rad) and translation (mm)
+  # about centre (mm)
+  mat=np.eye(4)
+  mat[:3, :3]=construct_rotmat_euler(params[:3])
+  mat[:3, 3]=centre-mat[:3, :3].dot(centre)+params[3:6]
+  return mat
+
+def get_centre(img, pixdims):
+  # Centre of gravity in mm
+  w=np.clip(img, 0, None)
+  total=w.sum()
+  if total==0:
+    return (np.array(img.shape)-1)/2*pixdims
+  return np.array([np.dot(np.arange(n), w.sum(axis=tuple([j for j in range(3) if j!=i]))) for i, n in enumerate(img.shape)])/total*pixdims
+
+def get_bins(values, vmin, vmax, nbins=NBINS):
+  # Lower bin and weight of the upper bin for the linear (partial volume) histogram
+  pos=np.clip((values-vmin)/(vmax-vmin)*(nbins-1), 0, nbins-1-1e-6)
+  lower=pos.astype(np.intp)
+  return lower, pos-lower
+
+def joint_histogram(ref_bins, mov_bins, nbins=NBINS):
+  (i, wi), (j, wj)=ref_bins, mov_bins
+  hist=np.bincount(i*nbins+j, (1-wi)*(1-wj), nbins*nbins)
+  hist+=np.bincount(i*nbins+j+1, (1-wi)*wj, nbins*nbins+1)[:nbins*nbins]
+  hist+=np.bincount((i+1)*nbins+j, wi*(1-wj), (nbins+1)*nbins)[:nbins*nbins]
+  hist+=np.bincount((i+1)*nbins+j+1, wi*wj, (nbins+1)*nbins+1)[:nbins*nbins]
+  return hist.reshape((nbins, nbins))
+
+def entropy(p):
+  p=p[p>0]
+  return -np.sum(p*np.log(p))
+
+def normmi(hist):
+  # Normalized mutual information (H(A)+H(B))/H(A,B)
+  p=hist/hist.sum()
+  return (entropy(p.sum(axis=1))+entropy(p.sum(axis=0)))/entropy(p.ravel())
+
+class Level:
+  # Reference samples of one level of the coarse-to-fine search
+  def __init__(self, ref, pixdims, step, fwhm):
+    sigma=fwhm/2.3548/pixdims
+    self.ref=gaussian_filter(ref, sigma)
+    grid=np.mgrid[tuple([slice(0, n, step) for n in ref.shape])].reshape((3, -1)).astype(np.float64)
+    values=self.ref[tuple(grid.astype(np.intp))]
+    self.vmin, self.vmax=values.min(), values.max()
+    self.points=grid*pixdims[:, np.newaxis]
+    self.ref_bins=get_bins(values, self.vmin, self.vmax)
+    self.sigma=sigma
+
+  def cost(self, mov, params, centre, pixdims):
+    # -NMI of the frame resampled at the reference samples (params: rotation scaled by ROT_SCALE, translation)
+    p=np.r_[params[:3]/ROT_SCALE, params[3:]]
+    inv=np.linalg.inv(params2mat(p, centre))
+    coords=(inv[:3, :3].dot(self.points)+inv[:3, 3:])/pixdims[:, np.newaxis]
+    values=map_coordinates(mov, coords, order=1, mode='constant', cval=0.0)
+    mvmax=mov.max()
+    mov_bins=get_bins(values, min(mov.min(), 0.0), mvmax if mvmax>0 else 1.0)
+    return -normmi(joint_histogram(self.ref_bins, mov_bins))
+
+# Reference of the worker processes
+_reference=None
+
+def init_worker(ref, pixdims):
+  global _reference
+  centre=get_centre(ref, pixdims)
+  _reference=(pixdims, centre, [Level(ref, pixdims, step, fwhm) for step, fwhm in LEVELS])
+  return
+
+def estimate_motion(frame):
+  # Rigid transform (Rx, Ry, Rz (rad), Tx, Ty, Tz (mm)) of the frame to the reference, and its cost
+  pixdims, centre, levels=_reference
+  frame=np.asarray(frame, dtype=np.float64)
+  params=np.zeros(6)
+  for level in levels:
+    mov=gaussian_filter(frame, level.sigma)
+    result=minimize(lambda x: level.cost(mov, x, centre, pixdims), params, method='Powell',
+                    options={'xtol': 1e-3, 'ftol': 1e-5})
+    params=result.x
+  return np.r_[params[:3]/ROT_SCALE, params[3:]], result.fun
+
+def resample(frame, mat, pixdims):
+  # Frame on the reference grid with trilinear interpolation (flirt -applyxfm)
+  inv=np.linalg.inv(mat)
+  grid=np.mgrid[tuple([slice(0, n) for n in frame.shape])].reshape((3, -1)).astype(np.float64)*pixdims[:, np.newaxis]
+  coords=(inv[:3, :3].dot(grid)+inv[:3, 3:])/pixdims[:, np.newaxis]
+  return map_coordinates(frame, coords, order=1, mode='constant', cval=0.0).reshape(frame.shape)
+
+def realign_frames(data, pixdims, max_workers=1):
+  # data: 4D array, the first frame being the reference.
+  # Returns the realigned frames (float32), the transforms (frames, 6), the costs and the matrices
+  # Each frame is converted to float64 when it is used, so that the 4D array stays in the precision it was loaded in
+  ref=np.asarray(data[..., 0], dtype=np.float64)
+  frames=[data[..., k] for k in range(1, data.shape[3])]
+  if max_workers>1 and len(frames)>1:
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(frames)), initializer=init_worker, initargs=(ref, pixdims)) as executor:
+      results=list(executor.map(estimate_motion, frames))
+  else:
+    init_worker(ref, pixdims)
+    results=[estimate_motion(frame) for frame in frames]
+
+  centre=get_centre(ref, pixdims)
+  params=np.zeros((data.shape[3], 6))
+  costs=np.zeros(data.shape[3])
+  mats=[np.eye(4)]
+  aligned=np.empty(data.shape, dtype=np.float32)
+  # The reference frame is copied as is (cp ${pet}_f0000.nii ${pet}_f0000_align.nii)
+  aligned[..., 0]=ref
+  for k, (p, cost) in enumerate(results, 1):
+    params[k], costs[k]=p, cost
+    mats.append(params2mat(p, centre))
+    aligned[..., k]=resample(np.asarray(data[..., k], dtype=np.float64), mats[k], pixdims)
+  return aligned, params, costs, mats
+
+def get_rmax(mats):
+  # Largest of the rotation angles of all frames except the reference (sort -nr | head -n1 of avscale)
+  angles=[rotmat2euler(mat[:3, :3]) for mat in mats[1:]]
+  if len(angles)==0:
+    return 0
+  return float(np.max(angles))
+
+def save_float32(data, img, fname):
+  out=nib.Nifti1Image(np.asarray(data, dtype=np.float32), img.affine, header=img.header)
+  out.set_data_dtype(np.float32)
+  out.header.set_slope_inter(1, 0)
+  nib.save(out, fname)
+  return out
+
+def save_params(params, costs, mats, fname):
+  with open(fname, 'w', encoding='UTF-8') as f:
+    f.write('\t'.join(['frame', 'Rx', 'Ry', 'Rz', 'Tx', 'Ty', 'Tz', 'cost'])+'\n')
+    for k, (p, cost, mat) in enumerate(zip(params, costs, mats)):
+      # Angles of the matrix as avscale reports them
+      rx, ry, rz=rotmat2euler(mat[:3, :3])
+      f.write('\t'.join([str(k)]+['{:.6f}'.format(v) for v in [rx, ry, rz]+list(mat[:3, 3])+[cost]])+'\n')
+  return
+
+def get_max_workers():
+  if os.environ.get('TQ_NCPUS'):
+    return max(1, int(os.environ['TQ_NCPUS']))
+  return max(1, (os.cpu_count() or 1)-1)
+
+def run(pet, prefix, max_workers=None):
+  max_workers=get_max_workers() if max_workers is None else max_workers
+  ID=os.path.basename(prefix)
+  with timed('realign.load', ID=ID):
+    img=reorient2std(nib.load(pet))
+    data=load_fdata(img)
+    if data.ndim==3:
+      data=data[..., np.newaxis]
+  pixdims=np.array(img.header.get_zooms()[:3], dtype=np.float64)
+
+  with timed('realign.fit', ID=ID):
+    aligned, params, costs, mats=realign_frames(data, pixdims, max_workers)
+
+  with timed('realign.save', ID=ID):
+    img3d=nib.Nifti1Image(data[..., 0], img.affine)
+    img3d.header.set_xyzt_units(*img.header.get_xyzt_units())
+    save_float32(data[..., 0], img3d, prefix+'_f0000.nii')
+    save_float32(aligned, img, prefix+'_align.nii')
+    save_float32(aligned.mean(axis=3, dtype=np.float64), img3d, prefix+'_align_mean.nii')
+    save_params(params, costs, mats, prefix+'_align_params.tsv')
+  return get_rmax(mats)
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Realign the frames of a dynamic PET image to the first frame.')
+  parser.add_argument('-j', dest='max_workers', type=int, default=None)
+  parser.add_argument('pet')
+  parser.add_argument('prefix')
+  args=parser.parse_args()
+
+  rmax=run(args.pet, args.prefix, args.max_workers)
+  sys.stdout.write(str(rmax)+'\n')
+  exit()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q reg_qc.py
+### Objectives:
+# This script computes the registration QC of tq_10 in one process, instead of calc_dice (fslstats and bc)
+# and avscale --allparams for each matrix in tq_10_realign.sh.
+#   - Dice: 2*|A and B|/(|A|+|B|) of the non-zero voxels of two masks (fslstats A -k B -V and fslstats -V),
+#     truncated to 3 decimals as bc with scale=3
+#   - Rotation angles: the FLIRT .mat files are decomposed into rotation, scales and skews as avscale
+#     (QR decomposition of the 3x3 part), and the Euler angles (Rx, Ry, Rz in radians) of all matrices are
+#     computed in one vectorized call. Rmax_frame is the largest angle of all frames (sort -nr | head -n1).
+#   - QC: OK when Rmax_frame and the absolute angles of the PET to MNI matrix are below the rotation threshold
+#     and Dice is above the Dice threshold, otherwise CHECK
+# The thresholds are set by the environment variables TQ_ROT_THR (default: 1, in the radians of the angles) and
+# TQ_DICE_THR (default: 0.94). tq_qc.py and tq_scheduler.py use the same decision.
+
+### Usage:
+# python reg_qc.py t1w -o [QC csv] ID [t1w2MNI.mat] [mask A] [mask B]
+# python reg_qc.py pet -o [QC csv] [--rmax Rmax_frame | --frames 'pattern'] ID [PET2MNI.mat] [mask A] [mask B]
+#   --rmax: Rmax_frame computed by realign.py (NA when the realignment failed, then the QC is CHECK)
+#   --frames: glob pattern of the .mat files of the realigned frames (flirt); Rmax_frame is 0 without frames
+# The header is written when the QC csv is created, and the row of the subject replaces an existing row of the
+# same ID under an exclusive lock, so that concurrent runs and reruns leave one row per subject.
+# The QC (OK or CHECK) is printed for pet.
+
+### Main Outputs:
+# - coregistration_results_t1w.csv: ID,Rx,Ry,Rz,Dice
+# - coregistration_results_pet.csv: ID,Rmax_frame,Rx_mean,Ry_mean,Rz_mean,Dice,QC
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, glob, fcntl, argparse
+import numpy as np
+import nibabel as nib
+
+# QC thresholds of tq_10 (same as tq-all.sh)
+ROT_THR=1
+DICE_THR=0.94
+
+HEADER_T1W=['ID', 'Rx', 'Ry', 'Rz', 'Dice']
+HEADER_PET=['ID', 'Rmax_frame', 'Rx_mean', 'Ry_mean', 'Rz_mean', 'Dice', 'QC']
+
+def get_rot_threshold():
+  return float(os.environ.get('TQ_ROT_THR', ROT_THR))
+
+def get_dice_threshold():
+  return float(os.environ.get('TQ_DICE_THR', DICE_THR))
+
+def decide(rotations, dice, rot_thr=None, dice_thr=None):
+  # rotations: (..., n) angles, dice: (...); True where all |angles| < rot_thr and dice > dice_thr (NaN: False)
+  rot_thr=get_rot_threshold() if rot_thr is None else rot_thr
+  dice_thr=get_dice_threshold() if dice_thr is None else dice_thr
+  with np.errstate(invalid='ignore'):
+    return (np.abs(np.asarray(rotations, dtype=np.float64))<rot_thr).all(axis=-1) & (np.asarray(dice, dtype=np.float64)>dice_thr)
+
+def read_mats(fnames):
+  # (n, 4, 4) FLIRT matrices
+  return np.array([np.loadtxt(fname).reshape((4, 4)) for fname in fnames]).reshape((-1, 4, 4))
+
+def rotation_matrices(mats):
+  # Rotations of the decomposition mat = rotation x scales x skews of avscale: Q of the QR decomposition
+  # of the 3x3 part with the diagonal of R made positive
+  q, r=np.linalg.qr(np.asarray(mats, dtype=np.float64)[..., :3, :3])
+  signs=np.sign(np.diagonal(r, axis1=-2, axis2=-1))
+  signs[signs==0]=1
+  return q*signs[..., np.newaxis, :]
+
+def euler_angles(rotmats):
+  # (n, 3) Euler angles (Rx, Ry, Rz) of rotation matrices as "Rotation Angles" of avscale (see realign.rotmat2euler)
+  R=np.asarray(rotmats, dtype=np.float64)
+  cy=np.sqrt(R[..., 0, 0]**2+R[..., 0, 1]**2)
+  singular=cy<1e-4
+  rx=np.where(singular, np.arctan2(-R[..., 2, 1], R[..., 1, 1]), np.arctan2(R[..., 1, 2], R[..., 2, 2]))
+  ry=np.where(singular, np.arctan2(-R[..., 0, 2], 0.0), np.arctan2(-R[..., 0, 2], cy))
+  rz=np.where(singular, 0.0, np.arctan2(R[..., 0, 1], R[..., 0, 0]))
+  return np.stack([rx, ry, rz], axis=-1)
+
+def get_angles(fnames):
+  return euler_angles(rotation_matrices(read_mats(fnames)))
+
+def get_rmax(angles):
+  # Largest angle of all frames (sort -nr | head -n1), 0 without frames
+  angles=np.asarray(angles)
+  return float(angles.max()) if angles.size>0 else 0.0
+
+def calc_dice(mask_a, mask_b):
+  # Same as calc_dice of tq_10_realign.sh (0 when both masks are empty)
+  a=np.asarray(mask_a)!=0
+  b=np.asarray(mask_b)!=0
+  union=int(np.count_nonzero(a))+int(np.count_nonzero(b))
+  if union==0:
+    return 0.0
+  overlap=int(np.count_nonzero(a & b))
+  # scale=3 of bc truncates
+  return (overlap*2*1000//union)/1000
+
+def load_mask(fname):
+  return np.asanyarray(nib.load(fname).dataobj)
+
+def format_angle(value):
+  # NA when the angle is unknown (e.g. the realignment failed)
+  return 'NA' if np.isnan(value) else '{:.6f}'.format(value)
+
+def parse_angle(text):
+  return np.nan if text=='NA' else float(text)
+
+def write_row(cells, header, fname):
+  # Header of a new file, and the row replacing the rows of the same ID, under an exclusive lock
+  # (as get_ref.save_parameters)
+  ID=str(cells[0])
+  fd=os.open(fname, os.O_RDWR|os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    with os.fdopen(os.dup(fd), 'r+', encoding='UTF-8') as f:
+      lines=f.read().splitlines()
+      rows=[line for line in lines[1:] if line.split(',')[0]!=ID]
+      lines=(lines[:1] if lines else [','.join(header)])+rows+[','.join([str(c) for c in cells])]
+      f.seek(0)
+      f.write('\n'.join(lines)+'\n')
+      f.truncate()
+  finally:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+  return
+
+def qc_t1w(ID, mat, mask_a, mask_b, fname):
+  # Returns (angles, Dice)
+  angles=get_angles([mat])[0]
+  dice=calc_dice(load_mask(mask_a), load_mask(mask_b))
+  write_row([ID]+[format_angle(a) for a in angles]+['{:.3f}'.format(dice)], HEADER_T1W, fname)
+  return angles, dice
+
+def qc_pet(ID, mat, mask_a, mask_b, fname, rmax=None, frames=()):
+  # Returns (Rmax_frame, angles, Dice, QC)
+  if rmax is None:
+    rmax=get_rmax(get_angles(frames)) if len(frames)>0 else 0.0
+  angles=get_angles([mat])[0]
+  dice=calc_dice(load_mask(mask_a), load_mask(mask_b))
+  state='OK' if decide(np.r_[rmax, angles], dice) else 'CHECK'
+  write_row([ID, format_angle(rmax)]+[format_angle(a) for a in angles]+['{:.3f}'.format(dice), state], HEADER_PET, fname)
+  return rmax, angles, dice, state
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Compute the registration QC of tq_10.')
+  parser.add_argument('modality', choices=['t1w', 'pet'])
+  parser.add_argument('-o', dest='output', required=True)
+  parser.add_argument('--rmax', type=parse_angle, default=None)
+  parser.add_argument('--frames', default=None)
+  parser.add_argument('ID')
+  parser.add_argument('mat')
+  parser.add_argument('mask_a')
+  parser.add_argument('mask_b')
+  args=parser.parse_args()
+
+  if args.modality=='t1w':
+    qc_t1w(args.ID, args.mat, args.mask_a, args.mask_b, args.output)
+  else:
+    frames=sorted(glob.glob(args.frames)) if args.frames else []
+    rmax, angles, dice, state=qc_pet(args.ID, args.mat, args.mask_a, args.mask_b, args.output, args.rmax, frames)
+    print(state)
+  exit()
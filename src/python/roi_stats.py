@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q roi_stats.py
+### Objectives:
+# This script calculates regional statistics of SUVR images for the ROIs of FreeSurfer label volumes.
+# Each label volume is loaded once, and all labels are summarised in a single grouped reduction
+# for all the given SUVR images. The ROIs and their order are defined by a region table
+# (src/tables/*_regions.tsv) keyed by FreeSurfer label ID.
+# As in fslstats -K ... -M, voxels with a value of 0 are excluded from the statistics, and a label which is
+# not in the label volume is written as "missing label: N".
+# The SUVR values and labels of the labelled voxels are kept in the voxel cache (voxel_cache.py), so that
+# a rerun (e.g. with other statistics) does not load the volumes again.
+# The values of each subject are also upserted in the cohort store (cohort_store.py), from which the consolidated
+# tables are exported without pasting the tables of all subjects again.
+
+### Usage:
+# python roi_stats.py -t [region table] -i [SUVR image suffix]:[table name] [-i ...] [-s mean,count,sd,median] [--timestamp YYYYmmdd_HHMM] ID [ID ...]
+#   -t: name of a table in src/tables (wmparc or merged) or path to a region table
+#   -i: e.g. _pmpbb3_suvr:suvr_wmparc_mean reads ${ID}_pmpbb3_suvr.nii.gz and writes ${ID}_pmpbb3_suvr_wmparc_mean.tsv
+#   -s: statistics to be calculated (default: mean)
+#   --timestamp: also write consolidated tables [table name]_[timestamp].tsv of all subjects in the directory
+# The region table is a tab-separated file with the columns Region, atlas and label.
+# The label volume of the atlas is read from ${ID}_[atlas]_r.nii.gz.
+
+### Main Outputs:
+# - ${ID}_pmpbb3_[table name].tsv: ID followed by the mean value of each ROI
+# - ${ID}_pmpbb3_[table name with mean replaced by count, sd or median].tsv: when requested by -s
+# - [table name]_[timestamp].tsv: consolidated tables across subjects
+# - .tq_tables/[table name].npz: cohort store of each table (see cohort_store.py)
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, argparse
+import numpy as np
+import nibabel as nib
+
+import voxel_cache
+import cohort_store
+from cohort_store import format_value, MISSING
+from tq_dtype import load_fdata
+
+TABLEDIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tables')
+STATS=['mean', 'count', 'sd', 'median']
+# Version of the label samples in the voxel cache, changed when the labels or the values change
+SAMPLES_VERSION=1
+
+def load_region_table(table):
+  path=table if os.path.exists(table) else os.path.join(TABLEDIR, table+'_regions.tsv')
+  regions=[]
+  with open(path, encoding='UTF-8') as f:
+    header=f.readline().rstrip('\n').split('\t')
+    for line in f:
+      if line.strip()=='':
+        continue
+      row=dict(zip(header, line.rstrip('\n').split('\t')))
+      regions.append((row['Region'], row['atlas'], int(row['label'])))
+  return regions
+
+def load_labels(path):
+  # Label volumes are stored as float by fslmaths and as integers by mri_convert
+  return np.rint(np.asanyarray(nib.load(path).dataobj)).astype(np.int64)
+
+def group_stats(labels, img, label_ids, stats=('mean',)):
+  # Statistics of non-zero voxels of img for each label ID, in one pass over the volume
+  labels=labels.reshape(-1)
+  img=np.asarray(img).reshape(-1)
+  label_ids=np.asarray(label_ids, dtype=np.int64)
+  n=max(int(labels.max(initial=0)), int(label_ids.max(initial=0)))+1
+  
+  sel=(labels>0) & (img!=0) & np.isfinite(img)
+  l=labels[sel]
+  v=img[sel].astype(np.float64)
+  
+  count=np.bincount(l, minlength=n)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean=np.bincount(l, weights=v, minlength=n)/count
+  
+  out={}
+  if 'mean' in stats:
+    out['mean']=mean[label_ids]
+  if 'count' in stats:
+    out['count']=count[label_ids]
+  if 'sd' in stats:
+    ss=np.bincount(l, weights=pow(v-mean[l], 2), minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+      sd=np.sqrt(ss/(count-1))
+    sd[count<2]=np.nan
+    out['sd']=sd[label_ids]
+  if 'median' in stats:
+    order=np.lexsort((v, l))
+    ls, vs=l[order], v[order]
+    c=count[label_ids]
+    start=np.searchsorted(ls, label_ids, side='left')
+    lo=np.minimum(start+(c-1)//2, max(len(vs)-1, 0))
+    hi=np.minimum(start+c//2, max(len(vs)-1, 0))
+    median=np.full(len(label_ids), np.nan)
+    if len(vs)>0:
+      median=np.where(c>0, (vs[lo]+vs[hi])/2, np.nan)
+    out['median']=median
+  
+  # Labels without any voxel (whatever the value) are missing for fslstats -K
+  missing=np.bincount(labels[labels>0], minlength=n)[label_ids]==0
+  for stat in ['mean', 'sd', 'median']:
+    if stat in out:
+      out[stat][missing]=MISSING
+  return out
+
+def region_stats(atlases, images, regions, stats=('mean',)):
+  # atlases: {atlas name: label volume (or labels of the samples)}
+  # images: list of SUVR volumes (or of {atlas name: SUVR values of the samples})
+  # Returns one {stat: values in the order of regions} per image
+  results=[{stat: np.full(len(regions), np.nan) for stat in stats} for img in images]
+  for atlas, labels in atlases.items():
+    idx=[i for i, region in enumerate(regions) if region[1]==atlas]
+    label_ids=[regions[i][2] for i in idx]
+    for img, result in zip(images, results):
+      values=group_stats(labels, img[atlas] if isinstance(img, dict) else img, label_ids, stats)
+      for stat in stats:
+        result[stat][idx]=values[stat]
+  return results
+
+def stat_name(name, stat):
+  if stat=='mean':
+    return name
+  if name.endswith('_mean'):
+    return name[:-len('_mean')]+'_'+stat
+  return name+'_'+stat
+
+def find_image(basename):
+  for ext in ['.nii.gz', '.nii']:
+    if os.path.exists(basename+ext):
+      return basename+ext
+  raise FileNotFoundError(basename+'.nii.gz')
+
+def save_subject_table(ID, values, stat, fname, labels=None):
+  # labels: label IDs of the values, printed for missing labels
+  labels=[None]*len(values) if labels is None else labels
+  with open(fname, 'w', encoding='UTF-8') as f:
+    f.write(ID+'\n')
+    for value, label in zip(values, labels):
+      f.write(format_value(value, stat, label)+'\n')
+  return
+
+def save_cohort_table(regions, name, fname, stat='mean'):
+  # Same layout as paste colheader.txt *_[table name].tsv, exported from the cohort store
+  # after reading the tables of the subjects which are new or modified
+  cohort_store.export_table(name, regions, fname, stat)
+  return
+
+def load_image(path):
+  return load_fdata(nib.load(path))
+
+def get_label_samples(ID, image_path, atlas_path, load):
+  # SUVR values, labels and flat indices of the labelled voxels, from the voxel cache
+  # load(path, func) is called only when they are not in the cache
+  def build():
+    labels=load(atlas_path, load_labels)
+    arrays=voxel_cache.mask_arrays(load(image_path, load_image), labels>0)
+    arrays['labels']=labels.reshape(-1)[arrays['index']].astype(np.int32)
+    return arrays, labels.shape
+  return voxel_cache.get_samples(ID, [image_path, atlas_path], voxel_cache.get_spec('roi_stats.labels', SAMPLES_VERSION), build)
+
+def process_subject(ID, regions, references, stats=('mean',)):
+  # references: list of (SUVR image suffix, table name)
+  atlas_names=sorted(set([region[1] for region in regions]))
+  volumes={}
+  def load(path, func):
+    if path not in volumes:
+      volumes[path]=func(path)
+    return volumes[path]
+  
+  # The samples of an atlas have the same voxels and labels for all the images
+  atlases={}
+  images=[{} for reference in references]
+  for (suffix, name), img in zip(references, images):
+    for atlas in atlas_names:
+      samples=get_label_samples(ID, find_image(ID+suffix), find_image(ID+'_'+atlas+'_r'), load)
+      atlases[atlas]=samples.arrays['labels']
+      img[atlas]=samples.arrays['values']
+  
+  results=region_stats(atlases, images, regions, stats)
+  for (suffix, name), result in zip(references, results):
+    for stat in stats:
+      fname=ID+'_pmpbb3_'+stat_name(name, stat)+'.tsv'
+      save_subject_table(ID, result[stat], stat, fname, [region[2] for region in regions])
+      cohort_store.upsert_subject(stat_name(name, stat), regions, fname, result[stat])
+  return results
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Calculate regional statistics of SUVR images.')
+  parser.add_argument('-t', dest='table', required=True)
+  parser.add_argument('-i', dest='references', action='append', required=True)
+  parser.add_argument('-s', dest='stats', default='mean')
+  parser.add_argument('--timestamp', default=None)
+  parser.add_argument('IDs', nargs='*')
+  args=parser.parse_args()
+  
+  regions=load_region_table(args.table)
+  references=[tuple(reference.split(':', 1)) for reference in args.references]
+  stats=[stat for stat in args.stats.split(',') if stat!='']
+  for stat in stats:
+    if stat not in STATS:
+      parser.error('unknown statistic: '+stat)
+  
+  for ID in args.IDs:
+    try:
+      process_subject(ID, regions, references, stats)
+    except Exception as e:
+      sys.stderr.write('roi_stats.py: '+ID+': '+repr(e)+'\n')
+      continue
+    print('extract SUVR within '+args.table+' rois of '+ID)
+  
+  if args.timestamp is not None:
+    for suffix, name in references:
+      for stat in stats:
+        fname=stat_name(name, stat)+'_'+args.timestamp+'.tsv'
+        save_cohort_table(regions, stat_name(name, stat), fname, stat)
+        print('Done. Please check '+fname)
+  exit()
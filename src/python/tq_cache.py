@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_cache.py
+### Objectives:
+# This script keeps a manifest (.tq_cache.json) of the inputs, parameters and scripts used to produce
+# the outputs of each (subject, stage), so that a rerun only processes the stages whose inputs have changed.
+# Files are identified by the hash of their contents. The hash is memoized by size and modification time,
+# so unchanged files are not read again.
+# A stage is up to date when all its outputs exist and the hashes of its inputs, the parameters
+# (e.g. dsc_thr and bin_width of get_ref.py) and the scripts are the same as when it was recorded.
+
+### Usage:
+# python tq_cache.py check ID stage   # exit status 0 if up to date, 1 otherwise
+# python tq_cache.py record ID stage  # record the current inputs and outputs
+# python tq_cache.py clean ID stage   # remove the outputs so that the stage is recomputed
+# The scheduler (tq_scheduler.py) calls these functions for each task.
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, json, glob, fcntl, hashlib
+
+TAMEQDIR=os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+MANIFEST='.tq_cache.json'
+
+# get_ref.py parameters recorded for the stages using the histogram-based reference
+REF_PARAMS=['dsc_thr', 'bin_width', 'fwhm_area', 'histcutoff', 'weighting']
+
+def src(*path):
+  return os.path.join(TAMEQDIR, 'src', *path)
+
+# inputs: files read by the stage, outputs: files written by the stage,
+# clean: outputs removed before a rerun (stages skip the work when these exist),
+# code: scripts and modules of the stage,
+# params: parameter sets recorded with the stage ('get_ref' or the name of an environment variable)
+CACHE_SPEC={
+  'tq_10': dict(inputs=['{ID}_t1w.nii*', '{ID}_pmpbb3_dyn.nii*'],
+                outputs=['{ID}_t1w_r.nii', '{ID}_pmpbb3_dyn_mean.nii', '{ID}_t1w_brain_mask_r.nii'],
+                clean=[],
+                code=[src('bash', 'tq_10_realign.sh'), src('python', 'realign.py'), src('python', 'reg_qc.py'), src('python', 'qa_view.py'),
+                      src('python', 'tq_dtype.py')],
+                params=['TQ_REALIGN', 'TQ_ROT_THR', 'TQ_DICE_THR', 'TQ_DTYPE']),
+  'tq_20': dict(inputs=['{ID}_t1w_r.nii'],
+                outputs=['c1{ID}_t1w_r.nii', 'c2{ID}_t1w_r.nii'],
+                clean=[],
+                code=[src('bash', 'tq_20_segmentation.sh'), src('matlab', 'segmentation.m')], params=None),
+  'tq_30': dict(inputs=['{ID}_pmpbb3_dyn_mean.nii*', 'c1{ID}_t1w_r.nii*', '{ID}_t1w_brain_mask_r.nii*'],
+                outputs=['{ID}_pmpbb3_suvr.nii.gz'],
+                clean=[],
+                code=[src('bash', 'tq_30_suvr_im.sh'), src('python', 'get_suvr.py'), src('python', 'get_ref.py'), src('python', 'tq_dtype.py'),
+                      src('python', 'voxel_cache.py')],
+                params=['get_ref', 'TQ_DTYPE']),
+  'tq_31': dict(inputs=['{ID}_pmpbb3_dyn_mean.nii*', 'c2{ID}_t1w_r.nii*', '{ID}_t1w_brain_mask_r.nii*'],
+                outputs=['{ID}_pmpbb3_suvr_wm.nii.gz'],
+                clean=[],
+                code=[src('bash', 'tq_31_suvr_wm.sh'), src('python', 'get_suvr.py'), src('python', 'get_ref.py'), src('python', 'tq_dtype.py'),
+                      src('python', 'voxel_cache.py')],
+                params=['get_ref', 'TQ_DTYPE']),
+  # recon-all and segmentBS are never removed automatically
+  'tq_40': dict(inputs=['{ID}_t1w_r.nii'],
+                outputs=['subjects/{ID}/mri/aseg.mgz', 'subjects/{ID}/mri/wmparc.mgz'],
+                clean=[],
+                code=[src('bash', 'tq_40_recon-all.sh')], params=None),
+  'tq_41': dict(inputs=['subjects/{ID}/mri/aseg.mgz'],
+                outputs=['subjects/{ID}/mri/brainstemSsLabels*.FSvoxelSpace.mgz'],
+                clean=[],
+                code=[src('bash', 'tq_41_segmentBS.sh')], params=None),
+  'tq_42': dict(inputs=['{ID}_pmpbb3_dyn_mean.nii', 'subjects/{ID}/mri/wmparc.mgz'],
+                outputs=['{ID}_wmparc_r.nii.gz', '{ID}_pmpbb3_suvr_cer.nii.gz'],
+                clean=['{ID}_wmparc_r.nii.gz', '{ID}_pmpbb3_suvr_cer.nii.gz'],
+                code=[src('bash', 'tq_42_suvr_cer.sh'), src('python', 'atlas_cache.py')], params=None),
+  'tq_50': dict(inputs=['{ID}_pmpbb3_suvr.nii.gz', '{ID}_pmpbb3_suvr_wm.nii.gz', '{ID}_pmpbb3_suvr_cer.nii.gz',
+                        '{ID}_wmparc_r.nii.gz', 'subjects/{ID}/mri/brainstemSsLabels*.FSvoxelSpace.mgz',
+                        src('tables', '*.tsv')],
+                outputs=['{ID}_bsseg_r.nii.gz', '{ID}_merged_r.nii.gz', '{ID}_pmpbb3_suvr*_mean.tsv'],
+                clean=['{ID}_bsseg_r.nii.gz', '{ID}_merged_r.nii.gz', '{ID}_pmpbb3_suvr*_mean.tsv'],
+                code=[src('bash', 'tq_5'+str(i)+'_*.sh') for i in range(7)]+[src('python', 'roi_stats.py'), src('python', 'merge_atlas.py'), src('python', 'cohort_store.py'),
+                      src('python', 'atlas_cache.py'), src('python', 'tq_dtype.py'), src('python', 'voxel_cache.py')],
+                params=['TQ_DTYPE']),
+  'tq_60': dict(inputs=['{ID}_t1w_r.nii', '{ID}_pmpbb3_suvr.nii.gz'],
+                outputs=['{ID}_overview_axi_*', '{ID}_overview_cor_*'],
+                clean=['{ID}_pmpbb3_suvr_l.nii.gz', '{ID}_t1w_r_l.nii.gz'],
+                code=[src('bash', 'tq_60_*.sh'), src('python', 'overview.py'), src('python', 'tq_report.py')], params=None),
+}
+
+def expand(patterns, ID):
+  files=[]
+  for pattern in patterns:
+    files+=sorted(glob.glob(pattern.replace('{ID}', ID)))
+  return files
+
+def hash_file(path, memo=None):
+  # memo: {path: [size, mtime_ns, hash]}
+  st=os.stat(path)
+  if memo is not None and path in memo and memo[path][:2]==[st.st_size, st.st_mtime_ns]:
+    return memo[path][2]
+  h=hashlib.blake2b(digest_size=20)
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1<<20), b''):
+      h.update(block)
+  digest=h.hexdigest()
+  if memo is not None:
+    memo[path]=[st.st_size, st.st_mtime_ns, digest]
+  return digest
+
+def hash_files(files, memo=None):
+  return {f: hash_file(f, memo) for f in files if os.path.isfile(f)}
+
+def get_params(names):
+  # Parameters of get_ref.py, and the values of the environment variables ('' when not set)
+  names=[names] if isinstance(names, str) else names
+  params={}
+  for name in names:
+    if name=='get_ref':
+      sys.path.insert(0, src('python'))
+      import get_ref
+      params.update({key: getattr(get_ref, key) for key in REF_PARAMS})
+    else:
+      params[name]=os.environ.get(name, '')
+  return params
+
+def load_manifest(fname=MANIFEST):
+  if not os.path.exists(fname):
+    return {'files': {}, 'stages': {}}
+  with open(fname, encoding='UTF-8') as f:
+    return json.load(f)
+
+def save_manifest(manifest, fname=MANIFEST):
+  with open(fname+'.tmp', 'w', encoding='UTF-8') as f:
+    json.dump(manifest, f, indent=1, sort_keys=True)
+  os.replace(fname+'.tmp', fname)
+  return
+
+def update_manifest(func, fname=MANIFEST):
+  # Read-modify-write under a lock for concurrent callers of the CLI
+  with open(fname+'.lock', 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    manifest=load_manifest(fname)
+    result=func(manifest)
+    save_manifest(manifest, fname)
+  return result
+
+def get_state(manifest, ID, stage, spec=None):
+  # Inputs, parameters and code of (ID, stage) at present
+  spec=CACHE_SPEC[stage] if spec is None else spec
+  memo=manifest['files']
+  return {
+    'inputs': hash_files(expand(spec['inputs'], ID), memo),
+    'params': get_params(spec['params']) if spec['params'] else {},
+    'code': hash_files(expand(spec['code'], ID), memo),
+  }
+
+def is_fresh(manifest, ID, stage, spec=None):
+  spec=CACHE_SPEC[stage] if spec is None else spec
+  entry=manifest['stages'].get(ID+'/'+stage)
+  if entry is None or len(entry['inputs'])==0:
+    return False
+  outputs=expand(spec['outputs'], ID)
+  if len(outputs)==0 or sorted(entry['outputs'])!=sorted(outputs):
+    return False
+  if hash_files(outputs, manifest['files'])!=entry['outputs']:
+    return False
+  state=get_state(manifest, ID, stage, spec)
+  return all([state[key]==entry[key] for key in ['inputs', 'params', 'code']])
+
+def record(manifest, ID, stage, spec=None):
+  spec=CACHE_SPEC[stage] if spec is None else spec
+  entry=get_state(manifest, ID, stage, spec)
+  entry['outputs']=hash_files(expand(spec['outputs'], ID), manifest['files'])
+  manifest['stages'][ID+'/'+stage]=entry
+  return entry
+
+def clean(ID, stage, spec=None):
+  spec=CACHE_SPEC[stage] if spec is None else spec
+  for f in expand(spec['clean'], ID):
+    if os.path.isfile(f):
+      os.remove(f)
+  return
+
+if __name__ == '__main__':
+  args=sys.argv
+  if len(args)<4 or args[1] not in ['check', 'record', 'clean'] or args[3] not in CACHE_SPEC:
+    sys.stderr.write('Usage: tq_cache.py check|record|clean ID stage\n')
+    sys.stderr.write('  stage: '+' '.join(CACHE_SPEC)+'\n')
+    exit(2)
+
+  command, ID, stage=args[1:4]
+  if command=='check':
+    fresh=update_manifest(lambda manifest: is_fresh(manifest, ID, stage))
+    print(ID+' '+stage+(' is up to date' if fresh else ' needs to be processed'))
+    exit(0 if fresh else 1)
+  elif command=='record':
+    update_manifest(lambda manifest: record(manifest, ID, stage))
+  else:
+    clean(ID, stage)
+  exit()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_dtype.py
+### Objectives:
+# This module sets the floating-point precision of the images loaded, processed and written by the Python stages.
+# By default the volumes are kept in float32, which halves the memory of each worker compared with get_fdata().
+# The histogram fittings and the statistics are always computed in float64 from the float32 voxel values.
+# Masks are kept as uint8 or bool.
+# The comparison functions (ge, gt, le, lt) compare the voxel values with a threshold given as a Python float
+# exactly, as in float64, whatever the precision of the volume.
+
+### Usage:
+# from tq_dtype import get_dtype, load_fdata, ge
+# The precision is set by the environment variable TQ_DTYPE (float32 or float64, default: float32).
+# Run compare_tables.py on the SUVR tables of both precisions to check the differences.
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os
+import numpy as np
+
+DTYPES={'float32': np.float32, 'float64': np.float64}
+
+def get_dtype():
+  name=os.environ.get('TQ_DTYPE', 'float32').strip().lower()
+  if name not in DTYPES:
+    raise ValueError('TQ_DTYPE must be one of '+', '.join(DTYPES)+': '+name)
+  return DTYPES[name]
+
+def load_fdata(img, dtype=None):
+  # img.get_fdata() in the precision of the pipeline
+  return img.get_fdata(dtype=get_dtype() if dtype is None else dtype)
+
+def get_bounds(data, thr):
+  # Largest and smallest values of the dtype of data which are <= thr and >= thr
+  dtype=np.asarray(data).dtype
+  if not np.issubdtype(dtype, np.floating):
+    return thr, thr
+  t=dtype.type(thr)
+  lower=np.nextafter(t, dtype.type(-np.inf)) if float(t)>thr else t
+  upper=np.nextafter(t, dtype.type(np.inf)) if float(t)<thr else t
+  return lower, upper
+
+def ge(data, thr):
+  return data>=get_bounds(data, thr)[1]
+
+def gt(data, thr):
+  return data>get_bounds(data, thr)[0]
+
+def le(data, thr):
+  return data<=get_bounds(data, thr)[0]
+
+def lt(data, thr):
+  return data<get_bounds(data, thr)[1]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_instrument.py
+### Objectives:
+# This script records the wall time, CPU time, peak memory and bytes read/written of each stage invocation
+# and of each step of the python scripts (load, fit, plot and save) in a JSONL file,
+# and summarizes them into a table at the end of tq-all.sh.
+# Nothing is recorded unless the environment variable TQ_METRICS is set to the path of the JSONL file.
+# Bytes read/written are the storage I/O (/proc/self/io for python steps, block I/O of rusage for commands).
+# The peak memory of a python step is the peak of the whole process up to the end of the step.
+
+### Usage:
+# From python:
+#   with timed('get_ref.fit', ID=ID): ...
+#   returncode=run(command, 'tq_30_suvr_im', ID=ID, stage='tq_30')
+# From the command line:
+#   python tq_instrument.py run [step] [key=value ...] -- command [args ...]
+#   python tq_instrument.py report [metrics.jsonl] [output table (optional)]
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, json, time, resource, subprocess
+from collections import OrderedDict
+from contextlib import contextmanager
+
+def get_metrics_file():
+  return os.environ.get('TQ_METRICS', '')
+
+def maxrss_mb(ru_maxrss):
+  # KB on Linux, bytes on macOS
+  if sys.platform=='darwin':
+    return ru_maxrss/1024/1024
+  return ru_maxrss/1024
+
+def read_proc_io():
+  io={}
+  try:
+    with open('/proc/self/io') as f:
+      for line in f:
+        key, value=line.split(':')
+        io[key]=int(value)
+  except OSError:
+    pass
+  return io.get('read_bytes', 0), io.get('write_bytes', 0)
+
+def write_record(record, fname=None):
+  fname=get_metrics_file() if fname is None else fname
+  if not fname:
+    return
+  line=(json.dumps(record)+'\n').encode('UTF-8')
+  # One write per record with O_APPEND so that concurrent processes do not interleave lines
+  fd=os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+  try:
+    os.write(fd, line)
+  finally:
+    os.close(fd)
+  return
+
+def make_record(step, wall, cpu, rss, read, write, status, fields):
+  record=OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('step', step)])
+  record.update(fields)
+  record.update([('pid', os.getpid()), ('wall_s', round(wall, 3)), ('cpu_s', round(cpu, 3)),
+                 ('maxrss_mb', round(rss, 1)), ('read_mb', round(read/1024/1024, 3)),
+                 ('write_mb', round(write/1024/1024, 3)), ('status', status)])
+  return record
+
+@contextmanager
+def timed(step, **fields):
+  if not get_metrics_file():
+    yield
+    return
+  wall=time.perf_counter()
+  ru=resource.getrusage(resource.RUSAGE_SELF)
+  read, write=read_proc_io()
+  status='ok'
+  try:
+    yield
+  except BaseException as e:
+    status=type(e).__name__
+    raise
+  finally:
+    ru2=resource.getrusage(resource.RUSAGE_SELF)
+    read2, write2=read_proc_io()
+    write_record(make_record(step, time.perf_counter()-wall,
+                             (ru2.ru_utime+ru2.ru_stime)-(ru.ru_utime+ru.ru_stime), maxrss_mb(ru2.ru_maxrss),
+                             read2-read, write2-write, status, fields))
+
+def run(command, step, stdout=None, stderr=None, env=None, **fields):
+  # subprocess.call with the resource usage of the command (and its waited-for children) recorded
+  wall=time.perf_counter()
+  p=subprocess.Popen(command, stdout=stdout, stderr=stderr, env=env)
+  _, waitstatus, ru=os.wait4(p.pid, 0)
+  returncode=os.waitstatus_to_exitcode(waitstatus)
+  p.returncode=returncode
+  write_record(make_record(step, time.perf_counter()-wall, ru.ru_utime+ru.ru_stime, maxrss_mb(ru.ru_maxrss),
+                           ru.ru_inblock*512, ru.ru_oublock*512, 'ok' if returncode==0 else 'exit '+str(returncode), fields))
+  return returncode
+
+def load_records(fname):
+  records=[]
+  with open(fname, encoding='UTF-8') as f:
+    for line in f:
+      if line.strip():
+        records.append(json.loads(line))
+  return records
+
+def summarize(records):
+  # One row per step: count, wall time (total, mean, max), CPU time, peak memory and I/O
+  rows=OrderedDict()
+  for r in records:
+    row=rows.setdefault(r['step'], dict(n=0, wall=0.0, wall_max=0.0, cpu=0.0, rss=0.0, read=0.0, write=0.0, failed=0, slowest=''))
+    row['n']+=1
+    row['wall']+=r['wall_s']
+    if r['wall_s']>=row['wall_max']:
+      row['wall_max']=r['wall_s']
+      row['slowest']=r.get('ID', '')
+    row['cpu']+=r['cpu_s']
+    row['rss']=max(row['rss'], r['maxrss_mb'])
+    row['read']+=r['read_mb']
+    row['write']+=r['write_mb']
+    row['failed']+=r['status']!='ok'
+  return rows
+
+def format_summary(rows):
+  header=['step', 'n', 'wall_total_s', 'wall_mean_s', 'wall_max_s', 'slowest_ID', 'cpu_total_s', 'maxrss_mb', 'read_mb', 'write_mb', 'failed']
+  lines=['\t'.join(header)]
+  for step, row in sorted(rows.items(), key=lambda item: -item[1]['wall']):
+    lines.append('\t'.join([step, str(row['n']), '{:.1f}'.format(row['wall']), '{:.1f}'.format(row['wall']/row['n']),
+                            '{:.1f}'.format(row['wall_max']), str(row['slowest']), '{:.1f}'.format(row['cpu']),
+                            '{:.0f}'.format(row['rss']), '{:.1f}'.format(row['read']), '{:.1f}'.format(row['write']),
+                            str(row['failed'])]))
+  return '\n'.join(lines)+'\n'
+
+if __name__ == '__main__':
+  args=sys.argv
+  if len(args)>2 and args[1]=='run' and '--' in args:
+    sep=args.index('--')
+    fields=dict([arg.split('=', 1) for arg in args[3:sep]])
+    exit(run(args[sep+1:], args[2], **fields))
+  elif len(args)>1 and args[1]=='report':
+    fname=args[2] if len(args)>2 else get_metrics_file()
+    if not fname or not os.path.exists(fname):
+      sys.stderr.write('tq_instrument.py: no metrics are found\n')
+      exit(1)
+    table=format_summary(summarize(load_records(fname)))
+    sys.stdout.write(table)
+    if len(args)>3:
+      with open(args[3], 'w', encoding='UTF-8') as f:
+        f.write(table)
+  else:
+    sys.stderr.write('Usage: tq_instrument.py run [step] [key=value ...] -- command [args ...]\n')
+    sys.stderr.write('       tq_instrument.py report [metrics.jsonl] [output table]\n')
+    exit(2)
+  exit()
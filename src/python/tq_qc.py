@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_qc.py
+### Objectives:
+# This script gathers the QC results of all subjects into one table and screens the cohort for outliers,
+# instead of reviewing the results of each subject one at a time.
+# The table has one row per subject with
+#   - the rotations and Dice coefficients of coregistration_results_pet.csv and coregistration_results_t1w.csv (tq_10),
+#   - the reference values, FWHM ranges (FWHM_max-FWHM_min) and numbers of reference voxels of
+#     histogram_GMref/histogram_parameters.txt and histogram_WMref/histogram_parameters.txt (tq_30, tq_31),
+#   - the number of QA pages (${ID}_qareport_N.png, see qa_view.py).
+# Rows appended by earlier runs are superseded by the last row of each subject.
+# The status of tq_10 (OK, CHECK or NA) is given by the thresholds of reg_qc.py (rotations < TQ_ROT_THR and
+# Dice > TQ_DICE_THR), and each metric is screened with the robust z-score (x-median)/(1.4826*MAD) of the cohort.
+# The thresholds and z-scores are computed for all subjects at once with numpy.
+
+### Usage:
+# python tq_qc.py status ID [ID ...]
+# python tq_qc.py report [-z threshold] [--timestamp YYYYmmdd_HHMM] [ID ...]
+#   status: print the status of tq_10 of each subject (one line per ID, used by tq-all.sh)
+#   report: write the QC tables of the subjects (default: all subjects of coregistration_results_pet.csv)
+#   -z: robust z-score above which a value is flagged (default: TQ_QC_Z or 3.5)
+
+### Main Outputs:
+# - QC_Report_[timestamp].tsv: metrics, robust z-scores, flagged metrics and QC (OK, CHECK or NA) of each subject
+# - QC_Summary_[timestamp].tsv: number of subjects, median, MAD, acceptable range and flagged subjects of each metric
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, csv, glob, time, argparse
+import numpy as np
+
+from reg_qc import decide
+
+Z_THR=3.5
+# Metrics with fewer values are not screened
+MIN_SUBJECTS=3
+# MAD of a normal distribution
+MAD_SCALE=1.4826
+
+HISTOGRAM_DIRECTORIES=[('GM', 'histogram_GMref'), ('WM', 'histogram_WMref')]
+HISTOGRAM_COLUMNS=['ID', 'mask', 'voxnum', 'a1', 'b1', 'c1', 'a2', 'b2', 'c2', 'FWHM_min', 'FWHM_max', 'refnum', 'refval']
+
+# Screened metrics and the side which is flagged (both, low or high)
+METRICS=[
+  ('refval_GM', 'both'),
+  ('FWHM_GM', 'both'),
+  ('refval_WM', 'both'),
+  ('FWHM_WM', 'both'),
+  ('Dice_pet', 'low'),
+  ('Dice_t1w', 'low'),
+  ('rotation', 'high'),
+]
+
+def get_z_threshold():
+  return float(os.environ.get('TQ_QC_Z', Z_THR))
+
+def to_float(value):
+  # Dice is written as .950 by bc
+  try:
+    return float('0'+value if value.startswith('.') else value)
+  except (AttributeError, ValueError):
+    return np.nan
+
+def read_rows(fname, columns=None, delimiter=','):
+  # Last row of each ID ({ID: {column: value}}); columns: names of the columns of a file without a header
+  rows={}
+  if not os.path.exists(fname):
+    return rows
+  with open(fname, encoding='UTF-8') as f:
+    reader=csv.reader(f, delimiter=delimiter)
+    header=columns
+    for row in reader:
+      if len(row)==0:
+        continue
+      if header is None:
+        header=row
+        continue
+      if row[0]==header[0]:
+        continue
+      rows[row[0]]=dict(zip(header, row))
+  return rows
+
+def get_column(rows, IDs, key):
+  return np.array([to_float(rows.get(ID, {}).get(key)) for ID in IDs])
+
+def load_results(IDs, directory='.'):
+  # Returns {column: array with one value per subject}
+  pet=read_rows(os.path.join(directory, 'coregistration_results_pet.csv'))
+  t1w=read_rows(os.path.join(directory, 'coregistration_results_t1w.csv'))
+  table={}
+  for key in ['Rmax_frame', 'Rx_mean', 'Ry_mean', 'Rz_mean']:
+    table[key]=get_column(pet, IDs, key)
+  table['Dice_pet']=get_column(pet, IDs, 'Dice')
+  for key in ['Rx', 'Ry', 'Rz']:
+    table[key+'_t1w']=get_column(t1w, IDs, key)
+  table['Dice_t1w']=get_column(t1w, IDs, 'Dice')
+  # Largest absolute rotation (NaN when one is missing)
+  table['rotation']=np.abs(np.stack([table[key] for key in ['Rmax_frame', 'Rx_mean', 'Ry_mean', 'Rz_mean']])).max(axis=0, initial=0)
+  for tissue, d in HISTOGRAM_DIRECTORIES:
+    rows=read_rows(os.path.join(directory, d, 'histogram_parameters.txt'), HISTOGRAM_COLUMNS, delimiter='\t')
+    for key in ['refval', 'refnum', 'voxnum']:
+      table[key+'_'+tissue]=get_column(rows, IDs, key)
+    table['FWHM_'+tissue]=get_column(rows, IDs, 'FWHM_max')-get_column(rows, IDs, 'FWHM_min')
+  table['qa_pages']=np.array([len(glob.glob(os.path.join(directory, ID+'_qareport_*'))) for ID in IDs], dtype=float)
+  return table
+
+def get_status_10(IDs, table=None, directory='.'):
+  # OK, CHECK or NA of each subject as the bc loop of tq-all.sh; missing or unreadable results are CHECK
+  table=load_results(IDs, directory) if table is None else table
+  exists=np.array([os.path.exists(os.path.join(directory, ID+'_t1w_r.nii')) and
+                   os.path.exists(os.path.join(directory, ID+'_pmpbb3_dyn_mean.nii')) for ID in IDs], dtype=bool)
+  rotations=np.stack([table[key] for key in ['Rmax_frame', 'Rx_mean', 'Ry_mean', 'Rz_mean']], axis=1)
+  ok=decide(rotations, table['Dice_pet'])
+  return np.where(exists, np.where(ok, 'OK', 'CHECK'), 'NA').tolist()
+
+def robust_stats(values):
+  # values: subjects x metrics; returns the median, MAD and scale (1.4826*MAD) of each metric ignoring NaN
+  n=np.sum(~np.isnan(values), axis=0)
+  median=np.full(values.shape[1], np.nan)
+  mad=np.full(values.shape[1], np.nan)
+  some=n>0
+  if some.any():
+    median[some]=np.nanmedian(values[:, some], axis=0)
+    mad[some]=np.nanmedian(np.abs(values[:, some]-median[some]), axis=0)
+  return n, median, mad, MAD_SCALE*mad
+
+def robust_z(values, median, scale):
+  # Values equal to the median are 0 and other values are infinite when the scale is 0
+  with np.errstate(invalid='ignore', divide='ignore'):
+    diff=values-median
+    z=np.where(scale>0, diff/scale, np.where(diff==0, 0, np.sign(diff)*np.inf))
+  return z
+
+def screen(table, metrics=METRICS, z_thr=None, mask=None):
+  # Returns (z-scores, flags, statistics) with subjects x metrics arrays; mask: subjects used for the statistics
+  z_thr=get_z_threshold() if z_thr is None else z_thr
+  values=np.stack([table[name] for name, side in metrics], axis=1)
+  used=values if mask is None else np.where(np.asarray(mask)[:, np.newaxis], values, np.nan)
+  n, median, mad, scale=robust_stats(used)
+  z=robust_z(values, median, scale)
+  sides=np.array([side for name, side in metrics])
+  with np.errstate(invalid='ignore'):
+    flags=np.where(sides=='low', z<-z_thr, np.where(sides=='high', z>z_thr, np.abs(z)>z_thr))
+  flags&=(n>=MIN_SUBJECTS)
+  with np.errstate(invalid='ignore'):
+    low=np.where(sides=='high', -np.inf, median-z_thr*scale)
+    high=np.where(sides=='low', np.inf, median+z_thr*scale)
+  stats={'n': n, 'median': median, 'MAD': mad, 'low': low, 'high': high}
+  return z, flags, stats
+
+def get_qc(status_10, flags):
+  status_10=np.asarray(status_10)
+  return np.where(status_10=='NA', 'NA', np.where((status_10=='OK') & ~flags.any(axis=1), 'OK', 'CHECK')).tolist()
+
+def format_number(value):
+  if np.isnan(value):
+    return 'NA'
+  return '{:.6g}'.format(value)
+
+REPORT_COLUMNS=['Rmax_frame', 'Rx_mean', 'Ry_mean', 'Rz_mean', 'rotation', 'Dice_pet', 'Rx_t1w', 'Ry_t1w', 'Rz_t1w', 'Dice_t1w',
+                'voxnum_GM', 'refnum_GM', 'refval_GM', 'FWHM_GM', 'voxnum_WM', 'refnum_WM', 'refval_WM', 'FWHM_WM', 'qa_pages']
+
+def write_report(fname, IDs, table, status_10, z, flags, metrics=METRICS):
+  names=[name for name, side in metrics]
+  qc=get_qc(status_10, flags)
+  with open(fname, 'w', encoding='UTF-8') as f:
+    f.write('\t'.join(['ID', 'tq_10']+REPORT_COLUMNS+['z_'+name for name in names]+['flagged', 'QC'])+'\n')
+    for i, ID in enumerate(IDs):
+      cells=[ID, status_10[i]]+[format_number(table[key][i]) for key in REPORT_COLUMNS]
+      cells+=['{:.2f}'.format(value) if not np.isnan(value) else 'NA' for value in z[i]]
+      cells+=[','.join([name for name, flag in zip(names, flags[i]) if flag]), qc[i]]
+      f.write('\t'.join(cells)+'\n')
+  return qc
+
+def write_summary(fname, IDs, flags, stats, metrics=METRICS):
+  with open(fname, 'w', encoding='UTF-8') as f:
+    f.write('\t'.join(['metric', 'n', 'median', 'MAD', 'low', 'high', 'flagged'])+'\n')
+    for j, (name, side) in enumerate(metrics):
+      flagged=[ID for ID, flag in zip(IDs, flags[:, j]) if flag]
+      f.write('\t'.join([name, str(int(stats['n'][j]))]+[format_number(stats[key][j]) for key in ['median', 'MAD', 'low', 'high']]+
+                        [','.join(flagged)])+'\n')
+  return
+
+def get_IDs(directory='.'):
+  # Subjects of coregistration_results_pet.csv in the order of the file
+  return list(read_rows(os.path.join(directory, 'coregistration_results_pet.csv')).keys())
+
+def run_report(IDs=None, timestamp=None, z_thr=None, directory='.'):
+  # Returns the QC of each subject
+  IDs=get_IDs(directory) if not IDs else list(IDs)
+  timestamp=time.strftime('%Y%m%d_%H%M') if timestamp is None else timestamp
+  table=load_results(IDs, directory)
+  status_10=get_status_10(IDs, table, directory)
+  # Subjects which failed tq_10 are left out of the cohort statistics
+  z, flags, stats=screen(table, z_thr=z_thr, mask=np.array(status_10)!='NA')
+  qc=write_report(os.path.join(directory, 'QC_Report_'+timestamp+'.tsv'), IDs, table, status_10, z, flags)
+  write_summary(os.path.join(directory, 'QC_Summary_'+timestamp+'.tsv'), IDs, flags, stats)
+  return dict(zip(IDs, qc))
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Gather the QC results of the cohort and flag the outliers.')
+  parser.add_argument('command', choices=['status', 'report'])
+  parser.add_argument('-z', dest='z_thr', type=float, default=None)
+  parser.add_argument('--timestamp', default=time.strftime('%Y%m%d_%H%M'))
+  parser.add_argument('IDs', nargs='*')
+  args=parser.parse_args()
+
+  if args.command=='status':
+    if not args.IDs:
+      parser.error('IDs are required for status')
+    for state in get_status_10(args.IDs):
+      print(state)
+  else:
+    qc=run_report(args.IDs, args.timestamp, args.z_thr)
+    check=[ID for ID, state in qc.items() if state!='OK']
+    print(str(len(qc)-len(check))+' of '+str(len(qc))+' subjects passed QC. Please check QC_Report_'+args.timestamp+'.tsv'+
+          (' for '+' '.join(check) if check else ''))
+  exit()
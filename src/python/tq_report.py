@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_report.py
+### Objectives:
+# This script is the shared figure backend of TAME-Q and renders the figures of a whole cohort with a process pool.
+# matplotlib is set to the non-interactive Agg backend before pyplot is imported, so that the figures are
+# rendered without a display. get_ref.py, qa_view.py and overlay_view*.py import pyplot from this module.
+# The resolution and the format of the saved figures can be changed with the environment variables
+#   TQ_FIG_DPI: dots per inch of all figures (default: the resolution of each figure, e.g. 600 for the overviews)
+#   TQ_FIG_FORMAT: file format (e.g. png, jpeg or pdf; default: the extension of each file name)
+# Each worker keeps one figure for each kind of figure and clears it for the next subject,
+# and the axial/coronal overviews of a subject are drawn from images loaded once.
+# When TQ_DEFER_FIGURES is set, get_ref.py saves the histogram as ${ID}_histogram.npz and tq_10 skips qa_view.py,
+# so that the histograms and QA pages are rendered together with the overviews by this script.
+
+### Usage:
+# python tq_report.py [-j workers] [-a lower threshold] [-b upper threshold] [--only overview|histogram|qa] ID [ID ...]
+#   -j: number of worker processes (default: number of cores - 1)
+#   -a, -b: display range of SUVR in the overviews (default: 1 and 2, as tq_60_overview_axi.sh)
+# The figures whose inputs are not found are skipped.
+# The overviews need ${ID}_t1w_r_l.nii.gz and ${ID}_pmpbb3_suvr_l.nii.gz (see tq_60_overview_axi.sh -n).
+
+### Main Outputs:
+# - ${ID}_overview_axi_t1.png, ${ID}_overview_axi_[a]_[b].png, ${ID}_overview_cor_t1.png, ${ID}_overview_cor_[a]_[b].png
+# - histogram_GMref/${ID}_histogram.jpeg, histogram_WMref/${ID}_histogram.jpeg (from ${ID}_histogram.npz)
+# - ${ID}_qareport_N.png and ${ID}_qaoutline_N.png (see qa_view.py)
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, argparse
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+HISTOGRAM_DIRECTORIES=['histogram_GMref', 'histogram_WMref']
+KINDS=['overview', 'histogram', 'qa']
+
+# Default lightbox of the overviews: X rows and Y columns of slices from START every INTERVAL slices
+# (set by the arguments of render_overview, see overview.py)
+OVERVIEW_X=6
+OVERVIEW_Y=5
+OVERVIEW_SLICES={'axi': (20, 4), 'cor': (30, 5)}
+
+# Figures kept by this process for reuse: {name: figure}
+_figures={}
+
+def get_dpi(default=None):
+  dpi=os.environ.get('TQ_FIG_DPI', '')
+  return float(dpi) if dpi else default
+
+def get_format():
+  return os.environ.get('TQ_FIG_FORMAT', '').lstrip('.')
+
+def get_fname(fname):
+  # File name with the extension of TQ_FIG_FORMAT
+  fmt=get_format()
+  if not fmt:
+    return fname
+  return os.path.splitext(fname)[0]+'.'+fmt
+
+def savefig(fig, fname, **kwargs):
+  fname=get_fname(fname)
+  fig.savefig(fname, dpi=get_dpi(fig.dpi), **kwargs)
+  return fname
+
+def get_figure(name, **kwargs):
+  # Cleared figure of the given name, created at the first call in this process
+  fig=_figures.get(name)
+  if fig is None:
+    fig=_figures[name]=plt.figure(**kwargs)
+  else:
+    fig.clear()
+  return fig
+
+def defer_figures():
+  return os.environ.get('TQ_DEFER_FIGURES', '')!=''
+
+def tiling(mat, view, X=OVERVIEW_X, Y=OVERVIEW_Y):
+  # Mosaic of X rows and Y columns of the slices with one reshape and transpose
+  # (axi: slices along the 3rd axis, cor: slices along the 2nd axis; missing slices are blank)
+  if view=='axi':
+    tiles=np.moveaxis(mat[:, ::-1, :], 2, 0).transpose(0, 2, 1)
+  else:
+    tiles=np.moveaxis(mat[:, :, ::-1], 1, 0).transpose(0, 2, 1)
+  n, s, t=tiles.shape
+  if n<X*Y:
+    tiles=np.concatenate([tiles, np.zeros((X*Y-n, s, t), dtype=tiles.dtype)])
+  return tiles[:X*Y].reshape((X, Y, s, t)).transpose(0, 2, 1, 3).reshape((X*s, Y*t)).astype(np.float64)
+
+def get_overview_slices(img, view, X=OVERVIEW_X, Y=OVERVIEW_Y, start=None, interval=None):
+  # X*Y slices from start every interval slices (default: OVERVIEW_SLICES)
+  default_start, default_interval=OVERVIEW_SLICES[view]
+  start=default_start if start is None else start
+  interval=default_interval if interval is None else interval
+  if view=='axi':
+    return img[:, :, start:start+interval*(X*Y):interval]
+  stop=start-1 if start>0 else None
+  return img[:, start+interval*(X*Y-1):stop:-interval, :]
+
+def draw_overview(mat_t1w, mat_pet, thr, uthr, ID, out_t1, out_pet, dpi=600):
+  # The T1W figure is saved first, and the SUVR overlay and the colorbar are added to the same figure
+  fig=get_figure('overview', figsize=(8.27, 11.69), dpi=dpi, facecolor='white')
+  fig.set_dpi(dpi)
+  ax=fig.add_axes((0.03, 0.13, 0.94, 0.8))
+  ax.imshow(mat_t1w, cmap='gray')
+
+  ax.axes.xaxis.set_visible(False)
+  ax.axes.yaxis.set_visible(False)
+
+  fig.text(0.6, 0.09, ID, size=20)
+  savefig(fig, out_t1)
+
+  msk=ax.imshow(mat_pet, cmap='jet', alpha=0.4)
+  msk.set_clim(thr, uthr)
+
+  cax=fig.add_axes((0.11, 0.09, 0.4, 0.03))
+  fig.colorbar(msk, orientation='horizontal', cax=cax)
+  savefig(fig, out_pet)
+  return
+
+def render_overview(ID, t1w, pet, thr, uthr, outputs, X=OVERVIEW_X, Y=OVERVIEW_Y, slices=None, dpi=600):
+  # outputs: {view: (T1W figure, overlay figure)}
+  # slices: {view: (start, interval)} (default: OVERVIEW_SLICES)
+  import nibabel as nib
+  from tq_instrument import timed
+  from tq_dtype import load_fdata
+
+  slices=OVERVIEW_SLICES if slices is None else slices
+  with timed('tq_report.load', ID=ID):
+    img_t1w=load_fdata(nib.load(t1w))
+    img_pet=load_fdata(nib.load(pet))
+  for view, (out_t1, out_pet) in outputs.items():
+    start, interval=slices.get(view, OVERVIEW_SLICES[view])
+    with timed('tq_report.overview_'+view, ID=ID):
+      mat_t1w=tiling(get_overview_slices(img_t1w, view, X, Y, start, interval), view, X, Y)
+      mat_pet=tiling(get_overview_slices(img_pet, view, X, Y, start, interval), view, X, Y)
+      draw_overview(mat_t1w, mat_pet, float(thr), float(uthr), ID, out_t1, out_pet, dpi)
+  return
+
+def save_histogram_data(ID, result, output_directory):
+  # Histogram and fitted parameters of get_ref.py, rendered later by render_histogram
+  np.savez(os.path.join(output_directory, ID+'_histogram.npz'), x=result.x, y=result.y,
+           params=result.params, params_mono=result.params_mono, dsc=result.dsc,
+           refnum=result.refnum, refval=result.refval, dsc_thr=result.dsc_thr)
+  return
+
+def render_histogram(ID, npz, output_directory):
+  import get_ref
+  from tq_instrument import timed
+
+  with timed('tq_report.histogram', ID=ID):
+    data=np.load(npz)
+    a1, b1, c1, a2, b2, c2=data['params']
+    am, bm, cm=data['params_mono']
+    fig=get_figure('histogram', figsize=(13, 4))
+    get_ref.save_figure(data['x'], data['y'], a1, b1, c1, a2, b2, c2, am, bm, cm, float(data['dsc']),
+                        int(data['refnum']), float(data['refval']), float(data['dsc_thr']), ID, output_directory, fig=fig)
+  return
+
+def render_qa(ID, t1w, pet_mean, pet_dyn, pet_ref):
+  import qa_view
+  qa_view.render_qa(ID, t1w, pet_mean, pet_dyn, pet_ref)
+  return
+
+def render_task(ID, kind, *args):
+  if kind=='overview':
+    render_overview(ID, *args)
+  elif kind=='histogram':
+    render_histogram(ID, *args)
+  else:
+    render_qa(ID, *args)
+  return True
+
+def get_tasks(IDs, thr='1', uthr='2', kinds=KINDS):
+  # Rows of (ID, kind, arguments of the renderer) for the figures whose inputs exist
+  rows=[]
+  for ID in IDs:
+    t1w, pet=ID+'_t1w_r_l.nii.gz', ID+'_pmpbb3_suvr_l.nii.gz'
+    if 'overview' in kinds and os.path.exists(t1w) and os.path.exists(pet):
+      outputs={view: (ID+'_overview_'+view+'_t1.png', ID+'_overview_'+view+'_'+thr+'_'+uthr+'.png') for view in ['axi', 'cor']}
+      rows.append((ID, 'overview', t1w, pet, thr, uthr, outputs))
+    for directory in HISTOGRAM_DIRECTORIES:
+      npz=os.path.join(directory, ID+'_histogram.npz')
+      if 'histogram' in kinds and os.path.exists(npz):
+        rows.append((ID, 'histogram', npz, directory))
+    qa=[ID+'_t1w_r.nii', ID+'_pmpbb3_dyn_mean.nii', ID+'_pmpbb3_dyn_align.nii', ID+'_pmpbb3_dyn_f0000.nii']
+    if 'qa' in kinds and all([os.path.exists(f) for f in qa+[ID+'_t1w_brain_outline4pet.nii']]):
+      rows.append(tuple([ID, 'qa']+qa))
+  return rows
+
+def render_all(IDs, thr='1', uthr='2', kinds=KINDS, max_workers=None):
+  from get_ref_batch import run_pool
+  rows=get_tasks(IDs, thr, uthr, kinds)
+  # The QA pages take the longest, so they are started first
+  rows.sort(key=lambda row: KINDS.index(row[1]), reverse=True)
+  results=run_pool(render_task, rows, max_workers) if len(rows)>0 else []
+  return [(ID, kind) for (ID, kind, *args), result in zip(rows, results) if result is None]
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Render the overviews, histograms and QA pages of TAME-Q with a process pool.')
+  parser.add_argument('-j', dest='max_workers', type=int, default=None)
+  parser.add_argument('-a', dest='thr', default='1')
+  parser.add_argument('-b', dest='uthr', default='2')
+  parser.add_argument('--only', dest='kinds', action='append', choices=KINDS)
+  parser.add_argument('IDs', nargs='+')
+  args=parser.parse_args()
+
+  failed=render_all(args.IDs, args.thr, args.uthr, args.kinds or KINDS, args.max_workers)
+  for ID, kind in failed:
+    sys.stderr.write('tq_report.py: '+kind+' of '+ID+' could not be rendered\n')
+  exit(1 if len(failed)>0 else 0)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q tq_scheduler.py
+### Objectives:
+# This script runs the stages of TAME-Q for each subject as soon as the prerequisites of that subject are finished,
+# instead of running each stage for the whole cohort before starting the next one.
+# The per-subject dependencies are:
+#   tq_10 -> tq_20 -> tq_30, tq_31
+#   tq_10 -> tq_40 -> tq_41 -> tq_42
+#   tq_30, tq_31, tq_42 -> tq_50 (tq_50 -a, tq_53 and tq_54 -a for the subject)
+#   tq_30 -> tq_60 (affine transform and axial/coronal overviews of overview.py for the subject in one process)
+# and the consolidated tables are generated once after tq_50 of all subjects.
+# Ready tasks are started from a single pool limited by the number of cores and the memory,
+# with the tasks on the longest remaining path (recon-all) started first.
+# The status of each subject is written to Process_Status_[timestamp].csv as in tq-all.sh,
+# and the files of the subjects which failed are moved to failed/[stage]/${ID} at the end.
+# The stages whose inputs, parameters and scripts have not changed since the last run are skipped
+# (see tq_cache.py); use --no-cache to process everything again.
+
+### Usage:
+# python tq_scheduler.py [-j cores] [-m memory (MB)] [--timestamp YYYYmmdd_HHMM] [--no-cache] [--dry-run] ID [ID ...]
+#   -j: number of cores available to the pool (default: number of cores - 1)
+#   -m: memory available to the pool in MB (default: total memory)
+
+### Main Outputs:
+# - Process_Status_[timestamp].csv: status (OK, CHECK or NA) of each stage of each subject
+# - tq_logs/${ID}_[stage].log: output of the stage scripts for each subject
+# - QC_Report_[timestamp].tsv and QC_Summary_[timestamp].tsv: QC of the cohort (see tq_qc.py)
+# - resource usage of each stage script in $TQ_METRICS when it is set (see tq_instrument.py)
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, glob, time, shutil, argparse, subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tq_cache
+import tq_instrument
+import tq_qc
+
+TAMEQDIR=os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+BASHDIR=os.path.join(TAMEQDIR, 'src', 'bash')
+
+# name: stage name, commands: list of commands ({ID} is replaced), deps: stages of the same subject to be finished,
+# cpus/mem: resources used by one subject (MB), weight: rough duration (min) used for the priority,
+# check: function of ID returning OK, CHECK or NA (None: no status, NA when a command fails)
+Stage=namedtuple('Stage', ['name', 'commands', 'deps', 'cpus', 'mem', 'weight', 'check'])
+Task=namedtuple('Task', ['ID', 'stage'])
+
+def exists_any(pattern):
+  return len(glob.glob(pattern))>0
+
+def status_of(ok):
+  return 'OK' if ok else 'NA'
+
+def check_tq_10(ID):
+  # Thresholds of reg_qc.py (TQ_ROT_THR and TQ_DICE_THR)
+  return tq_qc.get_status_10([ID])[0]
+
+def script(name, *args):
+  return [os.path.join(BASHDIR, name)]+list(args)
+
+STAGES=[
+  Stage('tq_10', [script('tq_10_realign.sh', '{ID}')], [], 2, 4096, 30, check_tq_10),
+  Stage('tq_20', [script('tq_20_segmentation.sh', '{ID}')], ['tq_10'], 1, 4096, 10,
+        lambda ID: status_of(os.path.exists('c1'+ID+'_t1w_r.nii') and os.path.exists('c2'+ID+'_t1w_r.nii'))),
+  Stage('tq_30', [script('tq_30_suvr_im.sh', '{ID}')], ['tq_20'], 1, 1024, 1,
+        lambda ID: status_of(os.path.exists(ID+'_pmpbb3_suvr.nii.gz'))),
+  Stage('tq_31', [script('tq_31_suvr_wm.sh', '{ID}')], ['tq_20'], 1, 1024, 1,
+        lambda ID: status_of(os.path.exists(ID+'_pmpbb3_suvr_wm.nii.gz'))),
+  Stage('tq_40', [script('tq_40_recon-all.sh', '{ID}')], ['tq_10'], 1, 1024, 480,
+        lambda ID: status_of(os.path.exists(os.path.join('subjects', ID, 'mri', 'wmparc.mgz')))),
+  Stage('tq_41', [script('tq_41_segmentBS.sh', '{ID}')], ['tq_40'], 1, 4096, 30,
+        lambda ID: status_of(exists_any(os.path.join('subjects', ID, 'mri', 'brainstemSsLabels*mgz')))),
+  Stage('tq_42', [script('tq_42_suvr_cer.sh', '{ID}')], ['tq_41'], 1, 1024, 1,
+        lambda ID: status_of(os.path.exists(ID+'_pmpbb3_suvr_cer.nii.gz'))),
+  Stage('tq_50', [script('tq_50_gen_table_wmparc_gm.sh', '-n', '-a', '{ID}'),
+                  script('tq_53_merge_wmparc.sh', '{ID}'),
+                  script('tq_54_gen_table_merged_gm.sh', '-n', '-a', '{ID}')],
+        ['tq_30', 'tq_31', 'tq_42'], 1, 1024, 2, None),
+  Stage('tq_60', [[os.path.join(TAMEQDIR, 'src', 'python', 'overview.py'), '-a', '1', '-b', '2', '{ID}']],
+        ['tq_30'], 1, 1024, 1, None),
+]
+
+# Run once after tq_50 of all subjects
+COHORT_STAGES=[
+  Stage('tables', [script('tq_50_gen_table_wmparc_gm.sh', '-t', '-a'),
+                   script('tq_54_gen_table_merged_gm.sh', '-t', '-a')],
+        ['tq_50'], 1, 1024, 1, None),
+]
+
+def get_max_cpus():
+  return max(1, (os.cpu_count() or 1)-1)
+
+def get_max_mem():
+  # MB
+  try:
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')//(1024*1024)
+  except (ValueError, OSError, AttributeError):
+    return 4096
+
+def get_priorities(stages):
+  # Longest remaining path (sum of weights) from each stage to the end of the subject
+  by_name={stage.name: stage for stage in stages}
+  priorities={}
+  def remaining(name):
+    if name not in priorities:
+      after=[remaining(s.name) for s in stages if name in s.deps]
+      priorities[name]=by_name[name].weight+max(after, default=0)
+    return priorities[name]
+  for stage in stages:
+    remaining(stage.name)
+  return priorities
+
+def run_task(task, stage, log_directory, cpus):
+  env=dict(os.environ, TQ_NCPUS=str(cpus))
+  log=os.path.join(log_directory, task.ID+'_'+stage.name+'.log') if task.ID is not None \
+      else os.path.join(log_directory, stage.name+'.log')
+  returncode=0
+  with open(log, 'a', encoding='UTF-8') as f:
+    for command in stage.commands:
+      command=[c.replace('{ID}', task.ID) if task.ID is not None else c for c in command]
+      f.write('$ '+' '.join(command)+'\n')
+      f.flush()
+      step=os.path.splitext(os.path.basename(command[0]))[0]
+      fields={'ID': task.ID, 'stage': stage.name} if task.ID is not None else {'stage': stage.name}
+      # The commands after a failed command are not run
+      returncode=returncode or tq_instrument.run(command, step, stdout=f, stderr=subprocess.STDOUT, env=env, **fields)
+  return returncode
+
+def write_status(fname, IDs, status, stages):
+  names=[stage.name for stage in stages if stage.check is not None]
+  with open(fname+'.tmp', 'w', encoding='UTF-8') as f:
+    f.write(','.join(['ID']+names)+'\n')
+    for ID in IDs:
+      f.write(','.join([ID]+[status.get((ID, name), '') for name in names])+'\n')
+  os.replace(fname+'.tmp', fname)
+  return
+
+def run_tasks(IDs, stages=STAGES, cohort_stages=COHORT_STAGES, max_cpus=None, max_mem=None,
+              log_directory='tq_logs', status_file=None, dry_run=False, cache_file=None, cache_spec=None):
+  # Returns {(ID, stage name): status}. Tasks whose prerequisites failed are NA without being run.
+  # With cache_file, tasks which are up to date in the manifest are not run.
+  max_cpus=get_max_cpus() if max_cpus is None else max_cpus
+  max_mem=get_max_mem() if max_mem is None else max_mem
+  os.makedirs(log_directory, exist_ok=True)
+
+  by_name={stage.name: stage for stage in stages+cohort_stages}
+  priorities=get_priorities(stages)
+  pending=[Task(ID, stage.name) for ID in IDs for stage in stages]
+  pending+=[Task(None, stage.name) for stage in cohort_stages]
+  done={}
+  status={}
+  running={}
+  free_cpus, free_mem=max_cpus, max_mem
+  cache_spec=tq_cache.CACHE_SPEC if cache_spec is None else cache_spec
+  manifest=tq_cache.load_manifest(cache_file) if cache_file is not None else None
+
+  def cached(task):
+    return manifest is not None and task.ID is not None and task.stage in cache_spec
+
+  def deps_state(task):
+    # 'ready', 'wait' or 'failed'
+    stage=by_name[task.stage]
+    if task.ID is None:
+      deps=[Task(ID, name) for ID in IDs for name in stage.deps]
+      return 'ready' if all([dep in done for dep in deps]) else 'wait'
+    deps=[Task(task.ID, name) for name in stage.deps]
+    if any([done.get(dep) is False for dep in deps]):
+      return 'failed'
+    return 'ready' if all([dep in done for dep in deps]) else 'wait'
+
+  def finish(task, ok, state):
+    done[task]=ok
+    if by_name[task.stage].check is not None and task.ID is not None:
+      status[(task.ID, task.stage)]=state
+    if status_file is not None:
+      write_status(status_file, IDs, status, stages)
+
+  # Each running task holds at least one core, so no more than max_cpus threads are needed
+  with ThreadPoolExecutor(max_workers=max(1, max_cpus)) as executor:
+    while pending or running:
+      # Tasks of failed subjects are not run
+      for task in [t for t in pending if deps_state(t)=='failed']:
+        pending.remove(task)
+        finish(task, False, 'NA')
+
+      ready=[t for t in pending if deps_state(t)=='ready']
+      ready.sort(key=lambda t: -priorities.get(t.stage, 0))
+      for task in ready:
+        stage=by_name[task.stage]
+        cpus, mem=min(stage.cpus, max_cpus), min(stage.mem, max_mem)
+        if cpus>free_cpus or mem>free_mem:
+          continue
+        pending.remove(task)
+        if cached(task) and tq_cache.is_fresh(manifest, task.ID, task.stage, cache_spec[task.stage]):
+          state=stage.check(task.ID) if stage.check is not None else 'OK'
+          print(time.strftime('%Y-%m-%d %H:%M:%S')+' skip  '+stage.name+' '+task.ID+' (up to date) '+state, flush=True)
+          finish(task, state!='NA', state)
+          continue
+        print(time.strftime('%Y-%m-%d %H:%M:%S')+' start '+stage.name+('' if task.ID is None else ' '+task.ID), flush=True)
+        if dry_run:
+          finish(task, True, 'OK')
+          continue
+        if cached(task):
+          tq_cache.clean(task.ID, task.stage, cache_spec[task.stage])
+        free_cpus-=cpus
+        free_mem-=mem
+        running[executor.submit(run_task, task, stage, log_directory, cpus)]=(task, cpus, mem)
+
+      if not running:
+        if pending and not [t for t in pending if deps_state(t)!='wait']:
+          raise RuntimeError('unresolved dependencies: '+', '.join([t.stage for t in pending]))
+        continue
+
+      finished, _=wait(list(running), return_when=FIRST_COMPLETED)
+      for future in finished:
+        task, cpus, mem=running.pop(future)
+        free_cpus+=cpus
+        free_mem+=mem
+        stage=by_name[task.stage]
+        try:
+          returncode=future.result()
+        except Exception as e:
+          sys.stderr.write('tq_scheduler.py: '+stage.name+' '+str(task.ID)+': '+repr(e)+'\n')
+          returncode=None
+        # Stages without a check are OK when all their commands succeeded
+        if stage.check is not None and task.ID is not None:
+          state=stage.check(task.ID)
+        else:
+          state='OK' if returncode==0 else 'NA'
+        print(time.strftime('%Y-%m-%d %H:%M:%S')+' done  '+stage.name+('' if task.ID is None else ' '+task.ID)+' '+state, flush=True)
+        if cached(task) and state!='NA':
+          tq_cache.record(manifest, task.ID, task.stage, cache_spec[task.stage])
+          tq_cache.save_manifest(manifest, cache_file)
+        finish(task, state!='NA', state)
+  return status
+
+def relocate_failed(ID, stage_name):
+  # Same layout as tq-all.sh
+  d=os.path.join('failed', stage_name, ID)
+  files=[f for f in glob.glob('*'+ID+'*') if f!='failed']
+  histograms=[(h, f) for h in ['histogram_GMref', 'histogram_WMref'] for f in glob.glob(os.path.join(h, ID+'*'))]
+  subject=os.path.join('subjects', ID)
+  if not files and not histograms and not os.path.exists(subject):
+    return
+  os.makedirs(d, exist_ok=True)
+  for f in files:
+    shutil.move(f, os.path.join(d, f))
+  for h, f in histograms:
+    os.makedirs(os.path.join(d, h), exist_ok=True)
+    shutil.move(f, os.path.join(d, h, os.path.basename(f)))
+  if stage_name>='tq_40' and os.path.exists(subject):
+    os.makedirs(os.path.join(d, 'subjects'), exist_ok=True)
+    shutil.move(subject, os.path.join(d, 'subjects', ID))
+  return
+
+def relocate_all_failed(IDs, status, stages=STAGES):
+  names=[stage.name for stage in stages if stage.check is not None]
+  for ID in IDs:
+    for name in names:
+      if status.get((ID, name))=='NA':
+        print('Move the files of '+ID+' to failed/'+name+'/'+ID)
+        relocate_failed(ID, name)
+        break
+  return
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Run the TAME-Q stages of each subject as soon as their prerequisites are finished.')
+  parser.add_argument('-j', dest='cpus', type=int, default=None)
+  parser.add_argument('-m', dest='mem', type=int, default=None)
+  parser.add_argument('--timestamp', default=time.strftime('%Y%m%d_%H%M'))
+  parser.add_argument('--no-cache', action='store_true')
+  parser.add_argument('--dry-run', action='store_true')
+  parser.add_argument('IDs', nargs='+')
+  args=parser.parse_args()
+
+  status_file='Process_Status_'+args.timestamp+'.csv'
+  status=run_tasks(args.IDs, max_cpus=args.cpus, max_mem=args.mem,
+                   status_file=None if args.dry_run else status_file, dry_run=args.dry_run,
+                   cache_file=None if args.no_cache else tq_cache.MANIFEST)
+  if not args.dry_run:
+    # The QC of the cohort before the files of the failed subjects are moved
+    tq_qc.run_report(args.IDs, args.timestamp)
+    relocate_all_failed(args.IDs, status)
+    print('Done. Please check '+status_file)
+  exit()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q voxel_cache.py
+### Objectives:
+# This script keeps the voxel values of an image inside a mask (e.g. the PET values of the reference region
+# or the SUVR values of the labelled voxels of an atlas), so that repeated analyses read a few megabytes
+# instead of loading the whole volumes again.
+# Each entry holds the values (in the precision of TQ_DTYPE, see tq_dtype.py) and the flat indices of the voxels (plus optional arrays such as labels)
+# as .npy files, which are memory-mapped when read.
+# Entries are keyed by the hashes of the contents of the input files (tq_cache.hash_file, memoized by size and
+# modification time) and by a specification of the mask, so that a modified input is never read from the cache.
+# The specifications include the version of the code building the samples and the precision of the values.
+# The total size of the cache is capped, and the least recently used entries are removed first.
+
+### Usage:
+# python voxel_cache.py list            # list the entries (key, ID, specification, size and last access)
+# python voxel_cache.py prune           # remove the entries whose input files were modified or removed
+# python voxel_cache.py clean [ID ...]  # remove the entries of the given subjects (all entries without ID)
+# The cache is used by get_suvr.py, get_ref_sweep.py and roi_stats.py, and configured by the environment variables:
+#   TQ_VOXEL_CACHE: directory of the cache (default: .tq_voxels in the working directory; none to disable it)
+#   TQ_VOXEL_CACHE_MB: maximum size of the cache in megabytes (default: 2048)
+
+### Main Outputs:
+# - [cache directory]/[key]_[array].npy: arrays of each entry
+# - [cache directory]/index.json: inputs, size and last access of the entries
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, json, time, fcntl, hashlib
+from collections import namedtuple
+import numpy as np
+
+from tq_cache import hash_file
+from tq_dtype import get_dtype
+
+CACHEDIR='.tq_voxels'
+INDEX='index.json'
+MAX_MB=2048
+
+# arrays: {name: array} with at least values and index, shape: shape of the volume, hit: read from the cache
+Samples=namedtuple('Samples', ['arrays', 'shape', 'hit'])
+
+def get_cache_dir():
+  cachedir=os.environ.get('TQ_VOXEL_CACHE', CACHEDIR)
+  if cachedir.strip().lower() in ['', 'none', 'off', '0']:
+    return None
+  return cachedir
+
+def get_max_bytes():
+  return int(float(os.environ.get('TQ_VOXEL_CACHE_MB', MAX_MB))*1024*1024)
+
+def get_spec(name, version, *args):
+  # Specification of the samples: name, version of the code, precision of the values and parameters
+  return ':'.join([name, 'v'+str(version), np.dtype(get_dtype()).name]+[str(arg) for arg in args])
+
+def mask_arrays(img, msk):
+  # Values of img (in get_dtype()) and flat indices (C order) of the non-zero voxels of msk
+  index=np.flatnonzero(np.asarray(msk))
+  if np.asarray(msk).size<2**31:
+    index=index.astype(np.int32)
+  return {'values': np.asarray(img, dtype=get_dtype()).reshape(-1)[index], 'index': index}
+
+def to_volume(values, index, shape, fill=0):
+  # Inverse of mask_arrays
+  out=np.full(int(np.prod(shape)), fill, dtype=np.asarray(values).dtype)
+  out[np.asarray(index)]=values
+  return out.reshape(shape)
+
+def load_index(cachedir):
+  fname=os.path.join(cachedir, INDEX)
+  if not os.path.exists(fname):
+    return {'files': {}, 'entries': {}}
+  with open(fname, encoding='UTF-8') as f:
+    return json.load(f)
+
+def save_index(index, cachedir):
+  fname=os.path.join(cachedir, INDEX)
+  with open(fname+'.tmp', 'w', encoding='UTF-8') as f:
+    json.dump(index, f, indent=1, sort_keys=True)
+  os.replace(fname+'.tmp', fname)
+  return
+
+def update_index(cachedir, func):
+  # Read-modify-write under a lock for concurrent workers
+  os.makedirs(cachedir, exist_ok=True)
+  with open(os.path.join(cachedir, INDEX+'.lock'), 'w') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    index=load_index(cachedir)
+    result=func(index)
+    save_index(index, cachedir)
+  return result
+
+def get_sources(paths, memo):
+  return {os.path.abspath(path): hash_file(os.path.abspath(path), memo) for path in paths}
+
+def get_key(sources, spec):
+  # Contents of the inputs (in the given order) and the specification of the mask, but not their paths
+  h=hashlib.blake2b(digest_size=20)
+  h.update(spec.encode('UTF-8'))
+  for digest in sources.values():
+    h.update(digest.encode('ascii'))
+  return h.hexdigest()
+
+def array_file(cachedir, key, name):
+  return os.path.join(cachedir, key+'_'+name+'.npy')
+
+def remove_entry(index, cachedir, key):
+  entry=index['entries'].pop(key)
+  for name in entry['arrays']:
+    try:
+      os.remove(array_file(cachedir, key, name))
+    except FileNotFoundError:
+      pass
+  return entry
+
+def evict(index, cachedir, max_bytes, keep=()):
+  # Remove the least recently used entries until the cache fits in max_bytes
+  entries=index['entries']
+  total=sum([entry['bytes'] for entry in entries.values()])
+  for key in sorted(entries, key=lambda key: entries[key]['atime']):
+    if total<=max_bytes:
+      break
+    if key in keep:
+      continue
+    total-=remove_entry(index, cachedir, key)['bytes']
+  return total
+
+def lookup(cachedir, key, memo):
+  # Arrays (memory-mapped) and shape of an entry, or None
+  def touch(index):
+    index['files'].update(memo)
+    entry=index['entries'].get(key)
+    if entry is not None:
+      entry['atime']=time.time()
+    return entry
+  entry=update_index(cachedir, touch)
+  if entry is None:
+    return None
+  try:
+    arrays={name: np.load(array_file(cachedir, key, name), mmap_mode='r') for name in entry['arrays']}
+  except (FileNotFoundError, ValueError):
+    # Removed by another process
+    return None
+  return arrays, tuple(entry['shape'])
+
+def store(cachedir, key, arrays, shape, ID, spec, sources, max_bytes):
+  if sum([np.asarray(array).nbytes for array in arrays.values()])>max_bytes:
+    return False
+  os.makedirs(cachedir, exist_ok=True)
+  nbytes=0
+  for name, array in arrays.items():
+    fname=array_file(cachedir, key, name)
+    with open(fname+'.'+str(os.getpid())+'.tmp', 'wb') as f:
+      np.save(f, np.asarray(array))
+    os.replace(fname+'.'+str(os.getpid())+'.tmp', fname)
+    nbytes+=os.path.getsize(fname)
+
+  def register(index):
+    index['entries'][key]=dict(ID=ID, spec=spec, sources=sources, shape=[int(n) for n in shape],
+                               arrays=list(arrays), bytes=nbytes, atime=time.time())
+    evict(index, cachedir, max_bytes, keep=[key])
+  update_index(cachedir, register)
+  return True
+
+def get_samples(ID, paths, spec, build, cachedir=None, max_bytes=None):
+  # Samples of the input files (paths) for the mask specification (spec)
+  # build() -> ({name: array}, shape) is called only when the entry is not in the cache
+  cachedir=get_cache_dir() if cachedir is None else cachedir
+  if cachedir is None:
+    arrays, shape=build()
+    return Samples(arrays, tuple(shape), False)
+  max_bytes=get_max_bytes() if max_bytes is None else max_bytes
+
+  # Files are hashed outside the lock and the memo is merged by lookup
+  memo=load_index(cachedir)['files'] if os.path.isdir(cachedir) else {}
+  sources=get_sources(paths, memo)
+  key=get_key(sources, spec)
+  found=lookup(cachedir, key, {path: memo[path] for path in sources})
+  if found is not None:
+    return Samples(found[0], found[1], True)
+
+  arrays, shape=build()
+  store(cachedir, key, arrays, shape, ID, spec, sources, max_bytes)
+  return Samples(arrays, tuple(shape), False)
+
+def prune(cachedir):
+  # Remove the entries whose input files were modified or removed
+  def func(index):
+    removed=[]
+    for key, entry in list(index['entries'].items()):
+      try:
+        fresh=get_sources(entry['sources'], index['files'])==entry['sources']
+      except FileNotFoundError:
+        fresh=False
+      if not fresh:
+        remove_entry(index, cachedir, key)
+        removed.append(key)
+    return removed
+  return update_index(cachedir, func)
+
+def clean(cachedir, IDs=None):
+  def func(index):
+    removed=[key for key, entry in index['entries'].items() if IDs is None or entry['ID'] in IDs]
+    for key in removed:
+      remove_entry(index, cachedir, key)
+    return removed
+  return update_index(cachedir, func)
+
+def format_entries(index):
+  lines=[]
+  for key, entry in sorted(index['entries'].items(), key=lambda item: item[1]['atime']):
+    lines.append('\t'.join([key[:12], str(entry['ID']), entry['spec'], '{:.2f}MB'.format(entry['bytes']/1024/1024),
+                            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['atime']))]))
+  return lines
+
+if __name__ == '__main__':
+  if len(sys.argv)<2 or sys.argv[1] not in ['list', 'prune', 'clean']:
+    sys.stderr.write('Usage: python voxel_cache.py [list|prune|clean] [ID ...]\n')
+    exit(2)
+  cachedir=get_cache_dir()
+  if cachedir is None or not os.path.isdir(cachedir):
+    exit()
+  if sys.argv[1]=='list':
+    for line in format_entries(load_index(cachedir)):
+      print(line)
+  elif sys.argv[1]=='prune':
+    print('removed '+str(len(prune(cachedir)))+' entries')
+  else:
+    print('removed '+str(len(clean(cachedir, sys.argv[2:] if len(sys.argv)>2 else None)))+' entries')
+  exit()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+### TAME-Q benchmark.py
+### Objectives:
+# Benchmarks of the python hot paths of TAME-Q on the synthetic phantoms of phantom.py, so that
+# optimizations can be compared with a stored baseline on a machine without FSL, SPM or FreeSurfer.
+# Each case is run on the phantoms of the selected sizes. The wall time is the minimum over the repeats,
+# and the peak memory is the peak of the memory allocated by the case (tracemalloc, measured in a separate run).
+# The cases are:
+#   get_ref: data2dist, calc_dsc, multistart bimodal fit, monomodal fit, get_erodedmap, get_values_in_mask
+#   qa_view: mosaics of the T1W/PET header panels (get_mat_t1w_pet) and of all frames (get_mat_dyn_all)
+#   tq_report: tiling of the axial and coronal overviews (formerly in overlay_view.py)
+#   cen2cen: compute_centroid
+
+### Usage:
+# python test/benchmark.py [-s small,medium,large] [-r repeats] [-k pattern] [-o results.json] [--baseline baseline.json] [--tolerance 1.25]
+#   -s: sizes of the phantoms (see phantom.SIZES, default: small,medium)
+#   -r: number of repeats of each case (default: 5)
+#   -k: run only the cases whose name contains the pattern
+#   --baseline: results of an earlier run; the exit status is 1 when a case is slower than tolerance x the baseline
+# Example: save a baseline before an optimization and compare after it
+#   python test/benchmark.py -o baseline.json
+#   python test/benchmark.py --baseline baseline.json -o results.json
+
+### Main Outputs:
+# - output JSON (default: benchmark_[timestamp].json): environment and one record per case and size
+#   (case, size, shape, repeats, wall_min_s, wall_mean_s, peak_mb)
+# - Standard output: table of the records, with the ratios to the baseline if given
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import os, sys, json, time, platform, argparse, tracemalloc
+from collections import namedtuple, OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+import nibabel as nib
+
+import get_ref
+import qa_view
+import tq_report
+import cen2cen
+from get_suvr import get_scaling_values
+from phantom import SIZES, make_phantom
+
+# name: case name, setup: function of the phantom returning the arguments, func: function timed with the arguments
+Case=namedtuple('Case', ['name', 'setup', 'func'])
+
+def scaled_pet(phantom):
+  # PET scaled as in get_suvr.py, where the values of the histogram are around 1
+  pet=phantom['pet']
+  return pet/get_scaling_values(pet[phantom['c1']>0.9])
+
+def gm_values(phantom):
+  return get_ref.get_values_in_mask(scaled_pet(phantom), get_ref.probmap2mask(phantom['c1'], 0.9)).astype(np.float64)
+
+def histogram(phantom):
+  return get_ref.data2dist(gm_values(phantom), get_ref.bin_width)
+
+def setup_dsc(phantom):
+  x, y=histogram(phantom)
+  am, bm, cm=get_ref.monomodal_curve_fitting(x, y)
+  return x, y, get_ref.get_gaussian(am, bm, cm)
+
+def setup_overview(phantom):
+  # 30 slices of the T1W image along the axial and coronal axes (the slices of tq_report.get_overview_slices
+  # at 1mm, spread over the whole volume for the smaller phantoms)
+  t1w=phantom['t1w']
+  n=tq_report.OVERVIEW_X*tq_report.OVERVIEW_Y
+  axi=t1w[:, :, np.linspace(0, t1w.shape[2]-1, n).astype(int)]
+  cor=t1w[:, np.linspace(t1w.shape[1]-1, 0, n).astype(int), :]
+  return axi, cor
+
+def tiling_both(axi, cor):
+  return tq_report.tiling(axi, 'axi'), tq_report.tiling(cor, 'cor')
+
+def setup_qa_header(phantom):
+  outline=(phantom['c1']>0.5).astype(np.float32)
+  return phantom['t1w'], phantom['pet'], outline
+
+def setup_qa_dyn(phantom):
+  outline=(phantom['c1']>0.5).astype(np.float32)
+  return phantom['dyn'], qa_view.get_display_indexes(outline), np.abs(np.diag(phantom['affine']))[:3]
+
+def setup_centroid(phantom):
+  return (nib.Nifti1Image(phantom['t1w'], phantom['affine']),)
+
+CASES=[
+  Case('get_ref.data2dist', lambda p: (gm_values(p), get_ref.bin_width), get_ref.data2dist),
+  Case('get_ref.calc_dsc', setup_dsc, get_ref.calc_dsc),
+  Case('get_ref.bimodal_fit', histogram, get_ref.multistart_bimodal_curve_fitting),
+  Case('get_ref.monomodal_fit', histogram, get_ref.monomodal_curve_fitting),
+  Case('get_ref.get_erodedmap', lambda p: (get_ref.probmap2mask(p['c1'], 0.9),), get_ref.get_erodedmap),
+  Case('get_ref.get_values_in_mask', lambda p: (scaled_pet(p), get_ref.probmap2mask(p['c1'], 0.9)), get_ref.get_values_in_mask),
+  Case('qa_view.get_mat_t1w_pet', setup_qa_header, qa_view.get_mat_t1w_pet),
+  Case('qa_view.get_mat_dyn_all', setup_qa_dyn, qa_view.get_mat_dyn_all),
+  Case('tq_report.tiling', setup_overview, tiling_both),
+  Case('cen2cen.compute_centroid', setup_centroid, cen2cen.compute_centroid),
+]
+
+def measure(func, args, repeats):
+  # Returns (wall times of the repeats, peak memory allocated during one call in MB)
+  walls=[]
+  for i in range(repeats):
+    start=time.perf_counter()
+    func(*args)
+    walls.append(time.perf_counter()-start)
+  tracemalloc.start()
+  try:
+    func(*args)
+    _, peak=tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return walls, peak/1024/1024
+
+def run_cases(sizes=('small', 'medium'), repeats=5, pattern='', cases=CASES, n_frames=6, seed=0):
+  records=[]
+  for size in sizes:
+    shape=SIZES[size] if isinstance(size, str) else tuple(size)
+    phantom=make_phantom(shape, n_frames=n_frames, seed=seed)
+    for case in cases:
+      if pattern not in case.name:
+        continue
+      args=case.setup(phantom)
+      walls, peak=measure(case.func, args, repeats)
+      records.append(OrderedDict([('case', case.name), ('size', size if isinstance(size, str) else 'x'.join(map(str, shape))),
+                                  ('shape', list(shape)), ('repeats', repeats), ('wall_min_s', min(walls)),
+                                  ('wall_mean_s', float(np.mean(walls))), ('peak_mb', peak)]))
+  return records
+
+def get_environment():
+  return OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('python', platform.python_version()),
+                      ('numpy', np.__version__), ('nibabel', nib.__version__), ('machine', platform.machine()),
+                      ('processor', platform.processor()), ('cpus', os.cpu_count())])
+
+def save_results(records, fname):
+  with open(fname, 'w', encoding='UTF-8') as f:
+    json.dump(OrderedDict([('environment', get_environment()), ('results', records)]), f, indent=1)
+  return
+
+def load_results(fname):
+  with open(fname, encoding='UTF-8') as f:
+    return json.load(f)['results']
+
+def compare(records, baseline, tolerance=1.25):
+  # Ratio of the wall time to the baseline of the same case and size (None if not in the baseline)
+  base={(r['case'], r['size']): r for r in baseline}
+  ratios=[]
+  for r in records:
+    b=base.get((r['case'], r['size']))
+    ratios.append(None if b is None or b['wall_min_s']<=0 else r['wall_min_s']/b['wall_min_s'])
+  slower=[r for r, ratio in zip(records, ratios) if ratio is not None and ratio>tolerance]
+  return ratios, slower
+
+def format_records(records, ratios=None):
+  lines=['\t'.join(['case', 'size', 'wall_min_ms', 'wall_mean_ms', 'peak_mb']+(['ratio'] if ratios is not None else []))]
+  for i, r in enumerate(records):
+    cells=[r['case'], r['size'], '{:.3f}'.format(r['wall_min_s']*1000), '{:.3f}'.format(r['wall_mean_s']*1000), '{:.1f}'.format(r['peak_mb'])]
+    if ratios is not None:
+      cells.append('NA' if ratios[i] is None else '{:.2f}'.format(ratios[i]))
+    lines.append('\t'.join(cells))
+  return '\n'.join(lines)+'\n'
+
+if __name__ == '__main__':
+  parser=argparse.ArgumentParser(description='Benchmark the python hot paths of TAME-Q on synthetic phantoms.')
+  parser.add_argument('-s', dest='sizes', default='small,medium')
+  parser.add_argument('-r', dest='repeats', type=int, default=5)
+  parser.add_argument('-k', dest='pattern', default='')
+  parser.add_argument('-o', dest='output', default='benchmark_'+time.strftime('%Y%m%d_%H%M')+'.json')
+  parser.add_argument('--baseline', default=None)
+  parser.add_argument('--tolerance', type=float, default=1.25)
+  args=parser.parse_args()
+
+  for size in args.sizes.split(','):
+    if size not in SIZES:
+      parser.error('unknown size '+size+' (choose from '+', '.join(SIZES)+')')
+  records=run_cases(args.sizes.split(','), args.repeats, args.pattern)
+  save_results(records, args.output)
+  if args.baseline is None:
+    sys.stdout.write(format_records(records))
+    exit()
+  ratios, slower=compare(records, load_results(args.baseline), args.tolerance)
+  sys.stdout.write(format_records(records, ratios))
+  for r in slower:
+    sys.stderr.write('benchmark.py: '+r['case']+' ('+r['size']+') is slower than the baseline\n')
+  exit(1 if slower else 0)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+# Make the TAME-Q python scripts importable from the tests.
+
+import os, sys
+import numpy as np
+import nibabel as nib
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python'))
+
+def make_subject(directory, ID, seed, shape=(40, 44, 30)):
+  # Mean PET with a bimodal histogram, GM probability map (c1) and brain mask of a subject
+  rng=np.random.default_rng(seed)
+  affine=np.diag([2.0, 2.0, 2.0, 1.0])
+  brainmask=np.zeros(shape)
+  brainmask[3:-3, 3:-3, 3:-3]=1
+  probmap=np.zeros(shape)
+  probmap[5:-5, 5:-5, 5:-5]=0.85+0.15*rng.random((shape[0]-10, shape[1]-10, shape[2]-10))
+  n=shape[0]*shape[1]*shape[2]
+  values=np.r_[rng.normal(4.0, 0.6, n*2//3), rng.normal(6.4, 1.2, n-n*2//3)]
+  pet=rng.permutation(values).reshape(shape)
+  pet[pet<0]=0
+  paths=[str(directory/(ID+'_pmpbb3_dyn_mean.nii')), str(directory/('c1'+ID+'_t1w_r.nii')), str(directory/(ID+'_t1w_brain_mask_r.nii'))]
+  nib.save(nib.Nifti1Image(pet.astype(np.float32), affine), paths[0])
+  nib.save(nib.Nifti1Image(probmap.astype(np.float32), affine), paths[1])
+  nib.save(nib.Nifti1Image(brainmask.astype(np.uint8), affine), paths[2])
+  return paths
+
+@pytest.fixture
+def suvr_subject():
+  # make_subject(directory, ID, seed, shape=(40, 44, 30)) for the tests which need the images of a subject,
+  # returns the paths of the PET, the GM probability map and the brain mask
+  return make_subject
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q phantom.py
+### Objectives:
+# Generator of deterministic synthetic inputs for the tests and benchmarks, without FSL, SPM or FreeSurfer.
+# A head phantom is made of nested ellipsoids (CSF, cortical GM, WM, and a brainstem and cerebellum below them),
+# from which the following images are derived:
+#   - T1W image with the tissue contrast of a T1-weighted image
+#   - GM/WM probability maps (c1, c2) smoothed at the tissue borders
+#   - static PET image (SUV) whose GM values follow a bimodal distribution (off-target and specific binding)
+#   - dynamic PET with N frames of the static PET, noise and small translations
+#   - wmparc-style labels (cortical 1001-1035/2001-2035, WM 3001-3035/4001-4035, cerebellum 8/47)
+#     and bsseg-style labels (brainstem 173-175, 178)
+# The same seed and shape give the same images.
+
+### Usage:
+# from phantom import make_phantom
+# phantom=make_phantom((96, 112, 96), n_frames=6, seed=0)
+# phantom['t1w'], phantom['pet'], phantom['c1'], phantom['wmparc'], ...
+
+### License:
+# This script is distributed under the GNU General Public License version 3.
+# See LICENSE file for details.
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+# Sizes of the MNI152 1mm (182, 218, 182) and 2mm templates, and smaller ones for quick runs
+SIZES={
+  'small': (48, 56, 48),
+  'medium': (91, 109, 91),
+  'large': (182, 218, 182),
+}
+
+# Tissue classes
+BACKGROUND, CSF, GM, WM, BRAINSTEM, CEREBELLUM=range(6)
+
+# Bimodal GM values: (weight, mean, sd) of the off-target and specific components
+GM_MODES=((0.7, 1.0, 0.12), (0.3, 1.6, 0.25))
+WM_MODE=(1.2, 0.1)
+
+def get_grid(shape):
+  # Coordinates normalized to [-1, 1] along each axis
+  return np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij', sparse=True)
+
+def ellipsoid(grid, center, radii):
+  return sum([((g-c)/r)**2 for g, c, r in zip(grid, center, radii)])<=1
+
+def make_tissues(shape):
+  grid=get_grid(shape)
+  tissues=np.zeros(shape, dtype=np.uint8)
+  tissues[ellipsoid(grid, (0, 0, 0.05), (0.85, 0.85, 0.8))]=CSF
+  tissues[ellipsoid(grid, (0, 0, 0.08), (0.78, 0.8, 0.72))]=GM
+  tissues[ellipsoid(grid, (0, 0, 0.12), (0.6, 0.64, 0.52))]=WM
+  tissues[ellipsoid(grid, (0, -0.55, -0.5), (0.45, 0.25, 0.22))]=CEREBELLUM
+  tissues[ellipsoid(grid, (0, -0.2, -0.45), (0.12, 0.12, 0.35))]=BRAINSTEM
+  return tissues
+
+def make_t1w(tissues, rng):
+  contrast=np.array([0, 300, 600, 900, 800, 650], dtype=np.float32)
+  t1w=contrast[tissues]+rng.normal(0, 20, tissues.shape).astype(np.float32)
+  t1w[tissues==BACKGROUND]=0
+  return t1w
+
+def make_probmaps(tissues):
+  # GM (c1) and WM (c2) probabilities, smoothed so that the borders are partial volumes
+  c1=gaussian_filter(np.isin(tissues, [GM, CEREBELLUM]).astype(np.float32), 0.8)
+  c2=gaussian_filter(np.isin(tissues, [WM, BRAINSTEM]).astype(np.float32), 0.8)
+  return c1, c2
+
+def bimodal_values(n, rng, modes=GM_MODES):
+  weights=np.array([mode[0] for mode in modes])
+  component=rng.choice(len(modes), size=n, p=weights/weights.sum())
+  means=np.array([mode[1] for mode in modes])[component]
+  sds=np.array([mode[2] for mode in modes])[component]
+  return np.abs(rng.normal(means, sds)).astype(np.float32)
+
+def make_pet(tissues, rng, scale=10000):
+  pet=np.zeros(tissues.shape, dtype=np.float32)
+  gm=np.isin(tissues, [GM, CEREBELLUM])
+  pet[gm]=bimodal_values(int(gm.sum()), rng)
+  wm=np.isin(tissues, [WM, BRAINSTEM])
+  pet[wm]=np.abs(rng.normal(WM_MODE[0], WM_MODE[1], int(wm.sum())))
+  pet[tissues==CSF]=0.3
+  return pet*scale
+
+def make_dynamic(pet, n_frames, rng):
+  # Frames with noise and translations of up to one voxel
+  frames=[]
+  for i in range(n_frames):
+    shift=tuple(rng.integers(-1, 2, 3))
+    frame=np.roll(pet, shift, axis=(0, 1, 2))*(0.8+0.4*i/max(n_frames-1, 1))
+    frames.append(frame+rng.normal(0, 0.02*pet.max(), pet.shape).astype(np.float32))
+  return np.stack(frames, axis=3)
+
+def make_wmparc(tissues):
+  # Cortical and WM labels by the angle around the vertical axis in each hemisphere
+  grid=get_grid(tissues.shape)
+  x, y=grid[0], grid[1]
+  sector=(((np.arctan2(y, np.abs(x))+np.pi/2)/np.pi)*34.999).astype(np.int32)+1
+  left=np.broadcast_to(x<0, tissues.shape)
+  sector=np.broadcast_to(sector, tissues.shape)
+  labels=np.zeros(tissues.shape, dtype=np.int32)
+  gm=tissues==GM
+  wm=tissues==WM
+  labels[gm]=np.where(left[gm], 1000, 2000)+sector[gm]
+  labels[wm]=np.where(left[wm], 3000, 4000)+sector[wm]
+  cer=tissues==CEREBELLUM
+  labels[cer]=np.where(left[cer], 8, 47)
+  labels[tissues==BRAINSTEM]=16
+  return labels
+
+def make_bsseg(tissues):
+  # Medulla, pons, midbrain and SCP from the bottom of the brainstem
+  labels=np.zeros(tissues.shape, dtype=np.int32)
+  z=np.broadcast_to(np.arange(tissues.shape[2]), tissues.shape)
+  bs=tissues==BRAINSTEM
+  if not bs.any():
+    return labels
+  zmin, zmax=z[bs].min(), z[bs].max()
+  part=np.minimum(((z[bs]-zmin)*4)//max(zmax-zmin+1, 1), 3)
+  labels[bs]=np.array([175, 174, 173, 178])[part]
+  return labels
+
+def make_phantom(shape=SIZES['small'], n_frames=6, seed=0):
+  # Returns {name: array} and the affine of a voxel size fitting the MNI152 field of view
+  rng=np.random.default_rng(seed)
+  tissues=make_tissues(shape)
+  c1, c2=make_probmaps(tissues)
+  pet=make_pet(tissues, rng)
+  voxel=[fov/n for fov, n in zip((182, 218, 182), shape)]
+  affine=np.diag(voxel+[1.0])
+  affine[:3, 3]=[-90, -126, -72]
+  return {
+    'tissues': tissues,
+    't1w': make_t1w(tissues, rng),
+    'c1': c1,
+    'c2': c2,
+    'pet': pet,
+    'dyn': make_dynamic(pet, n_frames, rng) if n_frames>0 else None,
+    'wmparc': make_wmparc(tissues),
+    'bsseg': make_bsseg(tissues),
+    'affine': affine,
+  }
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_atlas_cache.py
+### Objectives:
+# Tests for the resampling of label volumes into the PET space and the shared cache of atlas_cache.py.
+# The resampled labels are compared with the nearest voxel of each PET voxel computed one voxel at a time.
+
+### Usage:
+# python -m pytest test/test_atlas_cache.py
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+
+import atlas_cache
+
+# Shape of the 2mm PET image of suvr_subject (conftest.py)
+PET_SHAPE=(30, 34, 30)
+
+def make_labels(directory, ID='S01'):
+  # 1mm label volumes in a conformed-like LIA space, overlapping the 2mm PET image of suvr_subject
+  rng=np.random.default_rng(0)
+  mri=directory/'subjects'/ID/'mri'
+  os.makedirs(str(mri))
+  conformed=np.array([[-1, 0, 0, 64], [0, 0, 1, 0], [0, -1, 0, 64], [0, 0, 0, 1]], dtype=float)
+  wmparc=rng.choice([0, 8, 47, 1001, 2035, 5001], size=(64, 64, 64)).astype(np.int32)
+  nib.save(nib.MGHImage(wmparc, conformed), str(mri/'wmparc.mgz'))
+  bsseg=np.zeros((64, 64, 64), dtype=np.int32)
+  bsseg[28:36, 20:40, 28:36]=rng.choice([173, 174, 175, 178], size=(8, 20, 8))
+  nib.save(nib.MGHImage(bsseg, conformed), str(mri/'brainstemSsLabels.v13.FSvoxelSpace.mgz'))
+  return wmparc, conformed
+
+def test_nearest_neighbour(tmp_path, suvr_subject):
+  wmparc, conformed=make_labels(tmp_path)
+  pet=nib.load(suvr_subject(tmp_path, 'S01', 0, shape=PET_SHAPE)[0])
+  out=atlas_cache.resample_labels(wmparc, conformed, pet.shape, pet.affine)
+  M=np.linalg.inv(conformed)@pet.affine
+  for ijk in [(0, 0, 0), (15, 17, 15), (3, 30, 9), (29, 33, 29), (10, 2, 25)]:
+    src=M@np.r_[ijk, 1]
+    idx=np.floor(np.round(src[:3], 6)+0.5).astype(int)
+    expected=wmparc[tuple(idx)] if np.all(idx>=0) and np.all(idx<64) else 0
+    assert out[ijk]==expected
+
+def test_outputs_share_entries(tmp_path, monkeypatch, suvr_subject):
+  make_labels(tmp_path)
+  suvr_subject(tmp_path, 'S01', 0, shape=PET_SHAPE)
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('TQ_ATLAS_CACHE', str(tmp_path/'cache'))
+  builds=[]
+  build=atlas_cache.build
+  monkeypatch.setattr(atlas_cache, 'build', lambda source, template: builds.append(source) or build(source, template))
+
+  output=atlas_cache.resample_atlas('S01', 'wmparc')
+  img=nib.load(output)
+  assert output=='S01_wmparc_r.nii.gz' and img.get_data_dtype()==np.int16
+  np.testing.assert_array_equal(img.affine, nib.load('S01_pmpbb3_dyn_mean.nii').affine)
+  assert set(np.unique(img.get_fdata()).tolist())<={0, 8, 47, 1001, 2035, 5001}
+
+  # Removed by the cache of the stages and copied again without resampling
+  os.remove(output)
+  atlas_cache.resample_atlas('S01', 'wmparc')
+  assert atlas_cache.resample_atlas('S01', 'bsseg')=='S01_bsseg_r.nii.gz'
+  assert len(builds)==2
+  assert sorted([noutputs for key, size, noutputs in atlas_cache.list_entries()])==[1, 1]
+
+  # Writing to an output in place does not change the entry
+  entry=os.path.join(str(tmp_path/'cache'), atlas_cache.list_entries()[0][0]+'.nii.gz')
+  before=open(entry, 'rb').read()
+  for output in ['S01_wmparc_r.nii.gz', 'S01_bsseg_r.nii.gz']:
+    with open(output, 'r+b') as f:
+      f.write(b'\0'*16)
+  assert open(entry, 'rb').read()==before
+  atlas_cache.resample_atlas('S01', 'wmparc')
+  atlas_cache.resample_atlas('S01', 'bsseg')
+
+  # Entries without outputs are removed by clean
+  os.remove('S01_bsseg_r.nii.gz')
+  assert len(atlas_cache.clean())==1 and len(atlas_cache.list_entries())==1
+
+def test_missing_source(tmp_path, monkeypatch, suvr_subject):
+  make_labels(tmp_path)
+  suvr_subject(tmp_path, 'S01', 0, shape=PET_SHAPE)
+  monkeypatch.chdir(tmp_path)
+  os.remove(str(tmp_path/'subjects'/'S01'/'mri'/'brainstemSsLabels.v13.FSvoxelSpace.mgz'))
+  assert atlas_cache.resample_atlas('S01', 'bsseg', cachedir=str(tmp_path/'cache')) is None
+
+def resample_in_process(directory):
+  os.chdir(directory)
+  return atlas_cache.resample_atlas('S01', 'wmparc', cachedir='cache')
+
+def test_concurrent_stages(tmp_path, suvr_subject):
+  make_labels(tmp_path)
+  suvr_subject(tmp_path, 'S01', 0, shape=PET_SHAPE)
+  with ProcessPoolExecutor(max_workers=4) as executor:
+    outputs=list(executor.map(resample_in_process, [str(tmp_path)]*8))
+  assert outputs==['S01_wmparc_r.nii.gz']*8
+  assert len(atlas_cache.list_entries(str(tmp_path/'cache')))==1
+  assert [f for f in os.listdir(str(tmp_path)) if '.tmp' in f]==[]
+  nib.load(str(tmp_path/'S01_wmparc_r.nii.gz')).get_fdata()
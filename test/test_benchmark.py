@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_benchmark.py
+### Objectives:
+# Tests for the synthetic phantoms of phantom.py and the benchmark runner of benchmark.py on a small phantom.
+
+### Usage:
+# python -m pytest test/test_benchmark.py
+
+import numpy as np
+
+import get_ref
+import benchmark
+from phantom import make_phantom
+
+SHAPE=(32, 38, 32)
+
+def test_phantom_is_deterministic():
+  a, b=make_phantom(SHAPE, n_frames=3, seed=1), make_phantom(SHAPE, n_frames=3, seed=1)
+  for key in ['t1w', 'pet', 'c1', 'dyn', 'wmparc', 'bsseg']:
+    np.testing.assert_array_equal(a[key], b[key])
+  assert a['dyn'].shape==SHAPE+(3,)
+  labels=np.unique(a['wmparc'])
+  assert {8, 47, 16}<=set(labels.tolist()) and labels.max()<=4035
+  assert set(np.unique(a['bsseg']).tolist())<={0, 173, 174, 175, 178}
+
+def test_gm_values_are_bimodal():
+  x, y=benchmark.histogram(make_phantom((48, 56, 48)))
+  popt, rss, start, nstarts=get_ref.multistart_bimodal_curve_fitting(x, y)
+  # Two separated components
+  assert popt[4]-popt[1]>max(popt[2], popt[5])
+
+def test_run_and_compare(tmp_path):
+  records=benchmark.run_cases([SHAPE], repeats=1, n_frames=2)
+  assert [r['case'] for r in records]==[case.name for case in benchmark.CASES]
+  assert all([r['wall_min_s']>0 and r['peak_mb']>=0 for r in records])
+
+  benchmark.save_results(records, str(tmp_path/'baseline.json'))
+  baseline=benchmark.load_results(str(tmp_path/'baseline.json'))
+  slow=[dict(r, wall_min_s=r['wall_min_s']*2) for r in records]
+  ratios, slower=benchmark.compare(slow, baseline, tolerance=1.5)
+  assert ratios==[2.0]*len(records) and len(slower)==len(records)
+  ratios, slower=benchmark.compare(records, baseline[1:])
+  assert ratios[0] is None and slower==[]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_cen2cen.py
+### Objectives:
+# Tests for cen2cen.py.
+# The centroids of the marginal counts are compared with the mean of np.nonzero, and the outputs with
+# the images saved by nibabel with the translated affine (cen2cen.py of earlier versions).
+
+### Usage:
+# python -m pytest test/test_cen2cen.py
+
+import os, sys, subprocess
+import numpy as np
+import nibabel as nib
+
+import cen2cen
+
+SCRIPT=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'python', 'cen2cen.py')
+
+def make_images(directory):
+  rng=np.random.default_rng(0)
+  data=(rng.random((20, 22, 18))*1000).astype(np.int16)
+  data[:6]=0
+  data[:, 15:]=0
+  img=nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.5, 1.0]))
+  img.header.set_slope_inter(0.5, 0)
+  nib.save(img, str(directory/'S01_t1w.nii.gz'))
+  nib.save(img, str(directory/'S02_t1w.nii'))
+  target=np.zeros((30, 30, 30), dtype=np.float32)
+  target[12:, 5:9, 3:20]=rng.random((18, 4, 17))
+  nib.save(nib.Nifti1Image(target, np.diag([1.5, 1.5, 1.5, 1.0])), str(directory/'target.nii.gz'))
+
+def test_centroid_matches_nonzero(tmp_path):
+  make_images(tmp_path)
+  for name in ['S01_t1w.nii.gz', 'target.nii.gz']:
+    img=nib.load(str(tmp_path/name))
+    expected=nib.affines.apply_affine(img.affine, np.array(np.nonzero(img.get_fdata())).mean(axis=1))
+    np.testing.assert_allclose(cen2cen.compute_centroid(img), expected, rtol=0, atol=1e-10)
+
+def test_output_keeps_data_block(tmp_path):
+  make_images(tmp_path)
+  target_centroid=cen2cen.compute_centroid(nib.load(str(tmp_path/'target.nii.gz')))
+  for name, output in [('S01_t1w.nii.gz', 'a.nii.gz'), ('S02_t1w.nii', 'b.nii'), ('S02_t1w.nii', 'c.nii.gz')]:
+    img=nib.load(str(tmp_path/name))
+    translation=cen2cen.align(img, target_centroid, str(tmp_path/output))
+    out=nib.load(str(tmp_path/output))
+    # Same stored values and scaling, and the centroid on the target
+    assert out.get_data_dtype()==np.int16 and out.dataobj.slope==0.5
+    np.testing.assert_array_equal(out.dataobj.get_unscaled(), img.dataobj.get_unscaled())
+    np.testing.assert_allclose(cen2cen.compute_centroid(out), target_centroid, atol=1e-4)
+
+    # Same header as the image saved by nibabel with the translated affine
+    affine=img.affine.copy()
+    affine[:3, 3]+=translation
+    nib.save(nib.Nifti1Image(img.get_fdata(), affine, header=img.header), str(tmp_path/('old_'+output)))
+    old=nib.load(str(tmp_path/('old_'+output)))
+    np.testing.assert_array_equal(out.affine, old.affine)
+    for key in ['sform_code', 'qform_code', 'pixdim']:
+      np.testing.assert_array_equal(out.header[key], old.header[key])
+
+def test_batch(tmp_path, monkeypatch):
+  make_images(tmp_path)
+  calls=[]
+  compute_centroid=cen2cen.compute_centroid
+  monkeypatch.setattr(cen2cen, 'compute_centroid', lambda img: calls.append(img.get_filename()) or compute_centroid(img))
+  inputs=[str(tmp_path/'S01_t1w.nii.gz'), str(tmp_path/'S02_t1w.nii'), str(tmp_path/'missing.nii')]
+  translations=cen2cen.run_batch(inputs, str(tmp_path/'target.nii.gz'))
+  assert translations[2] is None
+  assert calls.count(str(tmp_path/'target.nii.gz'))==1
+  assert os.path.exists(str(tmp_path/'S01_t1w_cen.nii.gz')) and os.path.exists(str(tmp_path/'S02_t1w_cen.nii'))
+
+  # Same output from the command line of one input
+  subprocess.check_call([sys.executable, SCRIPT, inputs[1], str(tmp_path/'target.nii.gz'), str(tmp_path/'cli.nii')])
+  assert (tmp_path/'cli.nii').read_bytes()==(tmp_path/'S02_t1w_cen.nii').read_bytes()
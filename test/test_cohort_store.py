@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_cohort_store.py
+### Objectives:
+# Tests for the cohort store of cohort_store.py.
+# The exported tables are compared with the paste of the tables of all subjects (roi_stats.py of earlier versions),
+# and the incremental synchronization is checked.
+
+### Usage:
+# python -m pytest test/test_cohort_store.py
+
+import os, glob
+import numpy as np
+
+import cohort_store
+import roi_stats
+
+REGIONS=[('Lt-Cerebellum-Cortex', 'wmparc', 8), ('Midbrain', 'bsseg', 173), ('Lt-wm-bankssts', 'wmparc', 1001)]
+
+def paste_tables(regions, name):
+  # save_cohort_table of earlier versions
+  columns=[['Region'.ljust(30)]+[region[0] for region in regions]]
+  for path in sorted(glob.glob('*_pmpbb3_'+name+'.tsv')):
+    with open(path, encoding='UTF-8') as f:
+      columns.append(f.read().splitlines())
+  return ''.join(['\t'.join([column[i] if i<len(column) else '' for column in columns])+'\n' for i in range(len(regions)+1)])
+
+def write_subjects(IDs, seed):
+  rng=np.random.default_rng(seed)
+  for ID in IDs:
+    values=rng.normal(1.2, 0.3, len(REGIONS))
+    values[rng.random(len(REGIONS))<0.2]=np.nan
+    roi_stats.save_subject_table(ID, values, 'mean', ID+'_pmpbb3_suvr_wmparc_mean.tsv')
+    roi_stats.save_subject_table(ID, rng.integers(0, 3*10**6, len(REGIONS)), 'count', ID+'_pmpbb3_suvr_wmparc_count.tsv')
+
+def test_export_matches_paste(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  # S1 and S10: the order of the file names is not the order of the IDs
+  write_subjects(['S2', 'S10', 'S1'], 0)
+  # A short table is padded with empty cells
+  with open('S3_pmpbb3_suvr_wmparc_mean.tsv', 'w') as f:
+    f.write('S3\n1.500000\n')
+  for name, stat in [('suvr_wmparc_mean', 'mean'), ('suvr_wmparc_count', 'count')]:
+    roi_stats.save_cohort_table(REGIONS, name, name+'_test.tsv', stat)
+    assert open(name+'_test.tsv').read()==paste_tables(REGIONS, name)
+
+def test_incremental_sync(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  write_subjects(['S01', 'S02', 'S03'], 1)
+  assert len(cohort_store.sync('suvr_wmparc_mean', REGIONS))==3
+  assert cohort_store.sync('suvr_wmparc_mean', REGIONS)==[]
+
+  # Only the modified table is read again, and the removed table is dropped
+  write_subjects(['S02'], 2)
+  os.utime('S01_pmpbb3_suvr_wmparc_mean.tsv', ns=(1, 1))
+  os.remove('S03_pmpbb3_suvr_wmparc_mean.tsv')
+  assert cohort_store.sync('suvr_wmparc_mean', REGIONS)==['S02_pmpbb3_suvr_wmparc_mean.tsv']
+  store=cohort_store.load_store('suvr_wmparc_mean', REGIONS)
+  assert store['ID'].tolist()==['S01', 'S02']
+  roi_stats.save_cohort_table(REGIONS, 'suvr_wmparc_mean', 'test.tsv')
+  assert open('test.tsv').read()==paste_tables(REGIONS, 'suvr_wmparc_mean')
+
+  # Another region table starts a new store
+  assert len(cohort_store.sync('suvr_wmparc_mean', REGIONS[:2]))==2
+
+def test_process_subject_upserts(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('TQ_VOXEL_CACHE', 'none')
+  import nibabel as nib
+  rng=np.random.default_rng(3)
+  for name in ['wmparc', 'bsseg']:
+    nib.save(nib.Nifti1Image(rng.choice([0, 8, 173, 1001], size=(8, 8, 8)).astype(np.float32), np.eye(4)), 'S01_'+name+'_r.nii.gz')
+  nib.save(nib.Nifti1Image(rng.normal(1.0, 0.2, size=(8, 8, 8)).astype(np.float32), np.eye(4)), 'S01_pmpbb3_suvr.nii.gz')
+  roi_stats.process_subject('S01', REGIONS, [('_pmpbb3_suvr', 'suvr_wmparc_mean')])
+  # The table just written is not read again
+  assert cohort_store.sync('suvr_wmparc_mean', REGIONS)==[]
+  cohort_store.export_table('suvr_wmparc_mean', REGIONS, 'long.tsv', long=True)
+  lines=open('long.tsv').read().splitlines()
+  assert lines[0].split('\t')==['ID', 'table', 'Region', 'atlas', 'label', 'value']
+  assert lines[2].split('\t')[:5]==['S01', 'suvr_wmparc_mean', 'Midbrain', 'bsseg', '173']
+  assert len(lines)==1+len(REGIONS)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_get_ref.py
+### Objectives:
+# Tests for get_ref.py and get_ref_batch.py.
+# The vectorized histogram and Dice implementations are compared with the original loop-based ones
+# on synthetic bimodal data.
+
+### Usage:
+# python -m pytest test/test_get_ref.py
+
+import numpy as np
+import pytest
+
+import get_ref
+import get_ref_batch
+
+# Original implementations of get_ref.py (TAME-Q 1.1.0)
+def data2dist_loop(data, w):
+  x=np.array([i*w for i in range(int(1+np.max(data)//w))])
+  y=np.zeros(x.size)
+  for d in data:
+    y[int(d//w)]+=1
+    
+  i=0
+  while y[i]<1:
+    i+=1
+  j=int(np.max(data)//w)
+  while y[j]<1:
+    j-=1
+  x+=w/2
+  return x[i:j+1], y[i:j+1]
+
+def calc_dsc_loop(x, y, gm):
+  return 2*np.sum([np.min([gm(xi), yi]) for xi, yi in zip(x, y)])/(np.sum([gm(xi) for xi in x])+np.sum(y))
+
+def get_erodedmap_loop(img):
+  a, b, c=img.shape
+  img=np.pad(img, (1,))
+  out=np.ones(img.size).reshape(img.shape)
+  out[1:-1, 1:-1, 1:-1]=img[1:-1, 1:-1, 1:-1]
+  
+  for i in range(1, a+1):
+    for j in range(1, b+1):
+      for k in range(1, c+1):
+        out[i, j, k]=np.min([img[i, j, k], img[i-1, j, k], img[i+1, j, k], img[i, j-1, k], img[i, j+1, k]])
+        
+  return out[1:-1, 1:-1, 1:-1]
+
+def bimodal_values(seed, n=20000, mu1=1.0, mu2=1.6, sd1=0.15, sd2=0.3, ratio=0.7):
+  rng=np.random.default_rng(seed)
+  n1=int(n*ratio)
+  values=np.r_[rng.normal(mu1, sd1, n1), rng.normal(mu2, sd2, n-n1)]
+  return values[values>0]
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('w', [0.01, 0.025, 0.05])
+def test_data2dist_matches_loop(seed, w):
+  values=bimodal_values(seed)
+  x, y=get_ref.data2dist(values, w)
+  x_ref, y_ref=data2dist_loop(values, w)
+  np.testing.assert_array_equal(x, x_ref)
+  np.testing.assert_array_equal(y, y_ref)
+
+def test_data2dist_float32_values():
+  values=bimodal_values(3).astype(np.float32)
+  x, y=get_ref.data2dist(values, get_ref.bin_width)
+  x_ref, y_ref=data2dist_loop(values, get_ref.bin_width)
+  np.testing.assert_array_equal(x, x_ref)
+  np.testing.assert_array_equal(y, y_ref)
+
+def test_data2dist_negative_values():
+  # Negative voxel values wrap around to the upper bins in the original indexing
+  values=np.r_[bimodal_values(4, n=2000), -0.01, -0.02]
+  x, y=get_ref.data2dist(values, get_ref.bin_width)
+  x_ref, y_ref=data2dist_loop(values, get_ref.bin_width)
+  np.testing.assert_array_equal(x, x_ref)
+  np.testing.assert_array_equal(y, y_ref)
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_calc_dsc_matches_loop(seed):
+  values=bimodal_values(seed)
+  x, y=get_ref.data2dist(values, get_ref.bin_width)
+  am, bm, cm=get_ref.monomodal_curve_fitting(x, y)
+  gm=get_ref.get_gaussian(am, bm, cm)
+  assert get_ref.calc_dsc(x, y, gm)==calc_dsc_loop(x, y, gm)
+
+def test_estimate_reference_matches_run_subject(tmp_path, suvr_subject):
+  pet_path, c1_path, msk_path=suvr_subject(tmp_path, 'A001', 0)
+  pet, msk=get_ref.load_img([pet_path, msk_path])
+  result=get_ref.estimate_reference(pet, msk)
+  assert result is not None
+  assert result.voxnum==int(np.sum(msk))
+  assert get_ref.calc_FWHM(result.params[1], result.params[2])==(result.FWHM_min, result.FWHM_max)
+  
+  refval=get_ref.run_subject('A001', pet_path, msk_path, str(tmp_path))
+  assert refval==result.refval
+  assert (tmp_path/'A001_histogram.jpeg').exists()
+  assert (tmp_path/'A001_reference.nii').exists()
+
+def test_run_batch(tmp_path, suvr_subject):
+  rows=[]
+  for i, ID in enumerate(['A001', 'A002', 'A003']):
+    pet_path, c1_path, msk_path=suvr_subject(tmp_path, ID, i)
+    rows.append((ID, pet_path, msk_path))
+  rows.append(('A004', str(tmp_path/'missing.nii.gz'), rows[0][2]))
+  
+  refvals=get_ref_batch.run_batch(rows, str(tmp_path), max_workers=2)
+  assert refvals[3] is None
+  for (ID, pet_path, msk_path), refval in zip(rows[:3], refvals[:3]):
+    pet, msk=get_ref.load_img([pet_path, msk_path])
+    assert refval==get_ref.estimate_reference(pet, msk).refval
+  
+  lines=(tmp_path/'histogram_parameters.txt').read_text().splitlines()
+  assert sorted([line.split('\t')[0] for line in lines])==['A001', 'A002', 'A003']
+  assert all([len(line.split('\t'))==13 for line in lines])
+
+def test_jac_bi_matches_finite_difference():
+  x=np.linspace(0.3, 3.0, 80)
+  params=np.array([120.0, 1.0, 0.15, 60.0, 1.6, 0.3])
+  jac=get_ref.jac_bi(x, *params)
+  for k in range(6):
+    h=1e-6*max(1.0, abs(params[k]))
+    dp=np.zeros(6)
+    dp[k]=h
+    numerical=(get_ref.func_bi(x, *(params+dp))-get_ref.func_bi(x, *(params-dp)))/(2*h)
+    np.testing.assert_allclose(jac[:, k], numerical, rtol=1e-5, atol=1e-6)
+
+def test_get_bimodal_starts_are_unique():
+  x, y=get_ref.data2dist(bimodal_values(0), get_ref.bin_width)
+  starts, list_param_bounds=get_ref.get_bimodal_starts(x, y)
+  assert len(starts)<=4
+  assert all([starts[i]!=starts[j] for i in range(len(starts)) for j in range(i)])
+  assert len(list_param_bounds)==2
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_multistart_bimodal_curve_fitting_chooses_best(seed):
+  x, y=get_ref.data2dist(bimodal_values(seed), get_ref.bin_width)
+  popt, rss, start, nstarts=get_ref.multistart_bimodal_curve_fitting(x, y)
+  starts, list_param_bounds=get_ref.get_bimodal_starts(x, y)
+  for params in starts:
+    fit=get_ref.try_bimodal_curve_fitting(x, y, params, list_param_bounds[0])
+    if fit is not None:
+      assert rss<=fit[1]
+  # The lower component is found close to the simulated one
+  assert popt[1]==pytest.approx(1.0, abs=0.05)
+  assert popt[1]<popt[4]
+  
+  # Evaluation in a process pool gives the same fit
+  popt_p, rss_p, start_p, nstarts_p=get_ref.multistart_bimodal_curve_fitting(x, y, max_workers=4)
+  np.testing.assert_array_equal(popt, popt_p)
+  assert start==start_p
+
+def test_get_erodedmap_matches_loop():
+  rng=np.random.default_rng(0)
+  img=rng.random((12, 10, 6))
+  np.testing.assert_array_equal(get_ref.get_erodedmap(img), get_erodedmap_loop(img))
+
+def test_get_reference_mask():
+  rng=np.random.default_rng(1)
+  probmap=rng.random((20, 18, 8))
+  brainmask=np.zeros(probmap.shape)
+  brainmask[2:-2, 2:-2, :]=1
+  msk=get_ref.get_reference_mask(probmap, brainmask, 0.5)
+  
+  thr=probmap*brainmask
+  thr[thr<0.5]=0
+  expected=get_erodedmap_loop((thr>0).astype(np.float64))
+  assert msk.dtype==np.uint8
+  np.testing.assert_array_equal(msk, expected)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_get_ref_sweep.py
+### Objectives:
+# Tests for the parameter sweep of get_ref_sweep.py.
+# Each row of the sweep is compared with get_ref.estimate_reference run with the same parameters.
+
+### Usage:
+# python -m pytest test/test_get_ref_sweep.py
+
+import itertools
+import numpy as np
+
+import get_ref
+import get_suvr
+import get_ref_sweep
+
+def test_sweep_matches_estimate_reference(tmp_path, monkeypatch, suvr_subject):
+  monkeypatch.chdir(tmp_path)
+  suvr_subject(tmp_path, 'A001', 0)
+  suvr_subject(tmp_path, 'A002', 1)
+  grid=get_ref_sweep.get_default_grid()
+  grid.update([('msk_thr', [0.9, 0.95]), ('bin_width', [0.025, 0.05]), ('histcutoff', [0.5, 2.0]),
+               ('dsc_thr', [0.5, 0.936]), ('fwhm_area', [0.5, 1.0]), ('weighting', [True, False])])
+
+  # The bimodal fitting is done once for each (subject, mask threshold, bin width)
+  calls=[]
+  fit=get_ref.multistart_bimodal_curve_fitting
+  monkeypatch.setattr(get_ref, 'multistart_bimodal_curve_fitting', lambda *args: calls.append(1) or fit(*args))
+  rows=get_ref_sweep.run_sweep(['A001', 'A002', 'A003'], 'c1', grid, max_workers=1)
+  assert len(calls)==2*2*2
+  assert len(rows)==2*64
+  assert len(set([row['selected'] for row in rows]))==2
+  monkeypatch.setattr(get_ref, 'multistart_bimodal_curve_fitting', fit)
+
+  for ID in ['A001', 'A002']:
+    img_pet, img_probmap, brainmask, probmap, pet=get_suvr.load_subject(ID, 'c1')
+    expected=[]
+    for msk_thr, bin_width, histcutoff, dsc_thr, fwhm_area, weighting in itertools.product(*grid.values()):
+      msk=get_ref.get_reference_mask(probmap, brainmask, msk_thr)
+      pet_mod=get_suvr.modulate(pet, msk).astype(np.float64)
+      result=get_ref.estimate_reference(pet_mod, msk, dsc_thr, bin_width, fwhm_area, histcutoff, weighting)
+      expected.append((result.refval, result.refnum, result.dsc, result.voxnum))
+    assert [(row['refval'], row['refnum'], row['dsc'], row['voxnum']) for row in rows if row['ID']==ID]==expected
+
+def test_table():
+  rows=[dict(ID='A001', tissue='c1', msk_thr=0.9, bin_width=0.025, histcutoff=0.5, dsc_thr=0.936, fwhm_area=1.0,
+             weighting=True, voxnum=100, dsc=-1, selected='bimodal', FWHM_min=1.0, FWHM_max=2.0, refnum=50, refval=1.5)]
+  lines=get_ref_sweep.format_table(rows).splitlines()
+  assert lines[0].split('\t')==get_ref_sweep.COLUMNS
+  assert lines[1].split('\t')[:3]==['A001', 'c1', '0.9']
+  assert get_ref_sweep.parse_values('1,false', 'weighting')==[True, False]
+  assert get_ref_sweep.parse_values('0.01,0.025', 'bin_width')==[0.01, 0.025]
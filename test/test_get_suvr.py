@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_get_suvr.py
+### Objectives:
+# Tests for the in-memory SUVR stage of get_suvr.py.
+# The fused stage is compared with get_ref.py run on the intermediate images (modulated PET and eroded mask).
+
+### Usage:
+# python -m pytest test/test_get_suvr.py
+
+import os
+import numpy as np
+import nibabel as nib
+
+import get_ref
+import get_suvr
+
+def test_get_scaling_truncates_like_bc():
+  pet=np.full((4, 4, 4), 3.1415926)
+  msk=np.ones((4, 4, 4))
+  # echo "scale=5; 3.141593/2" | bc -> 1.57079
+  assert get_suvr.get_scaling(pet, msk)==1.57079
+
+def test_process_subject_matches_file_based_sequence(tmp_path, monkeypatch, suvr_subject):
+  monkeypatch.chdir(tmp_path)
+  suvr_subject(tmp_path, 'A001', 0)
+  os.mkdir('fused')
+  os.mkdir('files')
+  
+  refval=get_suvr.process_subject('A001', 'c1', '_pmpbb3_suvr', 'fused', keep_mod=True)
+  assert refval>0
+  
+  # File-based sequence using the intermediate images
+  refval_files=get_ref.run_subject('A001', 'A001_pmpbb3_dyn_mean_mod.nii.gz', 'c1A001_t1w_r_eroded.nii.gz', 'files')
+  assert refval==refval_files
+  
+  suvr=nib.load('A001_pmpbb3_suvr.nii.gz')
+  assert suvr.get_data_dtype()==np.float32
+  mod=nib.load('A001_pmpbb3_dyn_mean_mod.nii.gz').get_fdata(dtype=np.float32)
+  np.testing.assert_array_equal(suvr.get_fdata(dtype=np.float32), mod/np.float32(refval))
+  
+  for fname in ['A001_reference.nii', 'A001_histogram.jpeg']:
+    assert os.path.exists(os.path.join('fused', fname))
+  np.testing.assert_array_equal(nib.load('fused/A001_reference.nii').get_fdata(), nib.load('files/A001_reference.nii').get_fdata())
+  assert open('fused/histogram_parameters.txt').read()==open('files/histogram_parameters.txt').read()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_merge_atlas.py
+### Objectives:
+# Tests for merge_atlas.py.
+# The lookup-table remap is compared with a literal translation of the fslmaths chain of tq_53_merge_wmparc.sh.
+
+### Usage:
+# python -m pytest test/test_merge_atlas.py
+
+import numpy as np
+import nibabel as nib
+
+import merge_atlas
+
+def fslmaths_chain(f, bsseg):
+  # fslmaths ${f} -thr 1000 -rem 1000 -thr lthr -uthr uthr -sub sub -thr 0 tmp4sub
+  def tmp4sub(lthr, uthr, sub):
+    t=np.where(f>=1000, f, 0)
+    t=np.fmod(t, 1000)
+    t=np.where((t>=lthr) & (t<=uthr), t, 0)
+    t=t-sub
+    return np.where(t>=0, t, 0)
+  merged=f-tmp4sub(27, 27, 3)
+  for lthr, uthr, sub in [(19, 20, 18), (14, 14, 12), (32, 32, 12), (10, 10, 2), (23, 23, 2), (26, 26, 2)]:
+    merged=merged-tmp4sub(lthr, uthr, sub)
+  brainstem=np.where(f==16, f, 0)
+  wobrainstem=merged-brainstem
+  inwmparc=np.where((bsseg<=176) & (brainstem!=0), bsseg, 0)
+  return wobrainstem+inwmparc
+
+def make_labels(rng, shape=(16, 18, 14)):
+  cortex=np.r_[1:36]
+  labels=np.r_[0, 2, 7, 8, 16, 41, 47, 251, 1000+cortex, 2000+cortex, 3000+cortex, 4000+cortex, 5001, 5002]
+  wmparc=rng.choice(labels, size=shape).astype(np.float32)
+  bsseg=rng.choice([0, 173, 174, 175, 178, 179], size=shape).astype(np.float32)
+  return wmparc, bsseg
+
+def test_merge_labels_matches_fslmaths_chain():
+  rng=np.random.default_rng(0)
+  wmparc, bsseg=make_labels(rng)
+  cortical, substitute=merge_atlas.load_merge_spec('merged')
+  merged=merge_atlas.merge_labels(wmparc, cortical, substitute, {'bsseg': bsseg})
+  np.testing.assert_array_equal(merged, fslmaths_chain(wmparc, bsseg))
+
+def test_process_file(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rng=np.random.default_rng(1)
+  wmparc, bsseg=make_labels(rng)
+  nib.save(nib.Nifti1Image(wmparc.astype(np.int32), np.eye(4)), 'S01_wmparc_r.nii.gz')
+  nib.save(nib.Nifti1Image(bsseg.astype(np.int32), np.eye(4)), 'S01_bsseg_r.nii.gz')
+
+  cortical, substitute=merge_atlas.load_merge_spec('merged')
+  assert merge_atlas.process_file('S01_wmparc_r.nii.gz', cortical, substitute)=='S01_merged_r.nii.gz'
+  img=nib.load('S01_merged_r.nii.gz')
+  assert img.get_data_dtype()==np.int32
+  np.testing.assert_array_equal(np.asanyarray(img.dataobj), fslmaths_chain(wmparc, bsseg))
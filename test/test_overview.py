@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_overview.py
+### Objectives:
+# Tests for the overviews of overview.py and tq_report.py. The vectorized tiling is compared with the loop of
+# overlay_view.py, and the affine transform is run with a flirt which copies its input.
+
+### Usage:
+# python -m pytest test/test_overview.py
+
+import os
+import numpy as np
+import nibabel as nib
+
+import tq_report
+import overview
+
+def tiling_original(mat, view, X=6, Y=5):
+  if view=='axi':
+    s, t=mat.shape[1], mat.shape[0]
+  else:
+    s, t=mat.shape[0], mat.shape[2]
+  out=np.zeros((s*X, t*Y))
+  for i in range(X):
+    for j in range(Y):
+      if view=='axi':
+        out[i*s:(i+1)*s, j*t:(j+1)*t]=mat[:, ::-1, i*Y+j].T
+      else:
+        out[i*s:(i+1)*s, j*t:(j+1)*t]=mat[:, i*Y+j, ::-1].T
+  return out
+
+def test_tiling_matches_loop():
+  img=np.random.default_rng(0).random((91, 109, 91)).astype(np.float32)
+  for view, X, Y, start, interval in [('axi', 6, 5, 20, 2), ('cor', 6, 5, 10, 3), ('axi', 3, 4, 0, 7), ('cor', 2, 2, 0, 1)]:
+    mat=tq_report.get_overview_slices(img, view, X, Y, start, interval)
+    assert mat.shape[2 if view=='axi' else 1]==X*Y
+    np.testing.assert_array_equal(tq_report.tiling(mat, view, X, Y), tiling_original(mat, view, X, Y))
+  # Missing slices are blank
+  out=tq_report.tiling(img[:, :, :3], 'axi', 2, 2)
+  assert out.shape==(218, 182) and not out[109:, 91:].any()
+
+def write_flirt(directory):
+  # flirt writing the input image to -out and an identity matrix to -omat
+  flirt=directory/'bin'/'flirt'
+  os.makedirs(str(flirt.parent))
+  flirt.write_text('#!/usr/bin/env python3\n'
+                   'import sys, shutil, numpy as np, nibabel as nib\n'
+                   'args=sys.argv[1:]\n'
+                   'opts={args[i]: args[i+1] for i in range(len(args)-1) if args[i].startswith("-")}\n'
+                   'if "-omat" in opts:\n'
+                   '  np.savetxt(opts["-omat"], np.eye(4))\n'
+                   'nib.save(nib.load(opts["-in"]), opts["-out"])\n')
+  os.chmod(str(flirt), 0o755)
+  return str(flirt.parent)
+
+def test_transform_and_render(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('PATH', write_flirt(tmp_path)+os.pathsep+os.environ['PATH'])
+  rng=np.random.default_rng(0)
+  nib.save(nib.Nifti1Image(rng.random((40, 48, 40)).astype(np.float32), np.eye(4)), 'S01_t1w_r.nii')
+  nib.save(nib.Nifti1Image(rng.random((40, 48, 40)).astype(np.float32)*3, np.eye(4)), 'S01_pmpbb3_suvr.nii.gz')
+
+  assert overview.affine_transform('S01', ref='S01_t1w_r.nii')
+  assert not overview.affine_transform('S01', ref='S01_t1w_r.nii')
+  assert sorted(os.listdir('.'))==['S01_pmpbb3_suvr.nii.gz', 'S01_pmpbb3_suvr_l.nii.gz', 'S01_t1w_r.nii', 'S01_t1w_r_l.nii.gz', 'bin']
+
+  overview.render('S01', '1', '2', X=2, Y=3, slices={'axi': (4, 5), 'cor': (6, 7)}, dpi=20)
+  for view in overview.VIEWS:
+    for name in ['S01_overview_'+view+'_t1.png', 'S01_overview_'+view+'_1_2.png']:
+      assert os.path.getsize(name)>0
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_precision.py
+### Objectives:
+# Verification of the float32 processing of tq_dtype.py.
+# The SUVR images, reference images and SUVR tables of synthetic subjects processed with TQ_DTYPE=float32
+# are compared with those processed with TQ_DTYPE=float64.
+
+### Usage:
+# python -m pytest test/test_precision.py
+
+import os
+import numpy as np
+import nibabel as nib
+import pytest
+
+import tq_dtype
+import get_suvr
+import roi_stats
+import compare_tables
+
+IDS=['A001', 'A002']
+REGIONS=[('Lt-Cerebellum-Cortex', 'wmparc', 8), ('Lt-wm-bankssts', 'wmparc', 1001), ('Rt-Cerebellum-Cortex', 'wmparc', 47)]
+
+def run(directory, dtype, monkeypatch):
+  # get_suvr.py and roi_stats.py for the subjects in directory
+  monkeypatch.chdir(directory)
+  monkeypatch.setenv('TQ_DTYPE', dtype)
+  os.mkdir('fused')
+  refvals=[get_suvr.process_subject(ID, 'c1', '_pmpbb3_suvr', 'fused') for ID in IDS]
+  for ID in IDS:
+    roi_stats.process_subject(ID, REGIONS, [('_pmpbb3_suvr', 'suvr_wmparc_mean')], roi_stats.STATS)
+  for stat in roi_stats.STATS:
+    name=roi_stats.stat_name('suvr_wmparc_mean', stat)
+    roi_stats.save_cohort_table(REGIONS, name, name+'_test.tsv', stat)
+  return refvals
+
+def test_comparisons_are_exact():
+  rng=np.random.default_rng(0)
+  data=np.r_[np.float32(0.9), np.nextafter(np.float32(0.9), np.float32(0)), rng.random(1000)].astype(np.float32)
+  for thr in [0.9, 0.5, 0.25, 0.1]:
+    double=data.astype(np.float64)
+    np.testing.assert_array_equal(tq_dtype.ge(data, thr), double>=thr)
+    np.testing.assert_array_equal(tq_dtype.gt(data, thr), double>thr)
+    np.testing.assert_array_equal(tq_dtype.le(data, thr), double<=thr)
+    np.testing.assert_array_equal(tq_dtype.lt(data, thr), double<thr)
+
+def test_dtype_setting(monkeypatch):
+  monkeypatch.delenv('TQ_DTYPE', raising=False)
+  assert tq_dtype.get_dtype()==np.float32
+  monkeypatch.setenv('TQ_DTYPE', 'float64')
+  assert tq_dtype.get_dtype()==np.float64
+  monkeypatch.setenv('TQ_DTYPE', 'float16')
+  with pytest.raises(ValueError):
+    tq_dtype.get_dtype()
+
+def test_float32_matches_float64(tmp_path, monkeypatch, suvr_subject):
+  rng=np.random.default_rng(3)
+  labels=[rng.choice([0, 8, 47, 1001], size=(40, 44, 30)).astype(np.float32) for ID in IDS]
+  for dtype in ['float64', 'float32']:
+    os.mkdir(tmp_path/dtype)
+    for i, ID in enumerate(IDS):
+      suvr_subject(tmp_path/dtype, ID, i)
+      nib.save(nib.Nifti1Image(labels[i], np.diag([2.0, 2.0, 2.0, 1.0])), str(tmp_path/dtype/(ID+'_wmparc_r.nii.gz')))
+  refvals64=run(tmp_path/'float64', 'float64', monkeypatch)
+  refvals32=run(tmp_path/'float32', 'float32', monkeypatch)
+
+  # The scaled PET values differ by the rounding to float32 only, and the fittings are done in float64
+  assert refvals32==pytest.approx(refvals64, rel=1e-6)
+  for ID in IDS:
+    suvr64=nib.load(str(tmp_path/'float64'/(ID+'_pmpbb3_suvr.nii.gz')))
+    suvr32=nib.load(str(tmp_path/'float32'/(ID+'_pmpbb3_suvr.nii.gz')))
+    assert suvr64.get_data_dtype()==np.float64 and suvr32.get_data_dtype()==np.float32
+    np.testing.assert_allclose(suvr32.get_fdata(), suvr64.get_fdata(), rtol=1e-6, atol=1e-7)
+    ref64=nib.load(str(tmp_path/'float64'/'fused'/(ID+'_reference.nii')))
+    ref32=nib.load(str(tmp_path/'float32'/'fused'/(ID+'_reference.nii')))
+    assert ref32.get_data_dtype()==np.float32
+    np.testing.assert_allclose(ref32.get_fdata(), ref64.get_fdata(), rtol=1e-6, atol=1e-7)
+
+  results=compare_tables.compare_directories(str(tmp_path/'float64'), str(tmp_path/'float32'), '*.tsv', atol=1e-5, rtol=1e-5)
+  assert len(results)==len(IDS)*len(roi_stats.STATS)+len(roi_stats.STATS)
+  assert all([ok for name, n, diff, rel, ok in results]), results
+
+def test_compare_tables_detects_differences(tmp_path):
+  for name, value in [('a', '1.5'), ('b', '1.6')]:
+    os.mkdir(tmp_path/name)
+    (tmp_path/name/'S01_pmpbb3_suvr_mean.tsv').write_text('S01\n'+value+'\nnan\n')
+  name, n, diff, rel, ok=compare_tables.compare_directories(str(tmp_path/'a'), str(tmp_path/'b'))[0]
+  assert n==2 and diff==pytest.approx(0.1) and not ok
+  assert compare_tables.compare_directories(str(tmp_path/'a'), str(tmp_path/'b'), atol=0.2)[0][-1]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_qa_view.py
+### Objectives:
+# Tests for the batched slice resampling and the reused header panels of qa_view.py.
+# The batched mosaics are compared with the slice-by-slice adjust_size/adjust_size_pixdim calls.
+
+### Usage:
+# python -m pytest test/test_qa_view.py
+
+import os
+import numpy as np
+import nibabel as nib
+import matplotlib
+matplotlib.use('Agg')
+
+import qa_view
+
+def make_volume(rng, shape):
+  img=np.zeros(shape)
+  img[4:-4, 5:-5, 3:-3]=rng.random((shape[0]-8, shape[1]-10, shape[2]-6)+shape[3:])
+  return img
+
+def test_mosaics_match_slice_by_slice():
+  rng=np.random.default_rng(0)
+  img=make_volume(rng, (40, 48, 30))
+  outline=(img>0.8).astype(float)
+  idxes=qa_view.get_display_indexes(outline)
+
+  mat_t1w, mat_pet, mat_outline=qa_view.get_mat_t1w_pet(img, img*2, outline)
+  expected=np.c_[tuple([qa_view.adjust_size(img[:, ::-1, i].transpose(1, 0)) for i in idxes])]
+  expected_outline=np.c_[tuple([qa_view.adjust_size(outline[:, ::-1, i].transpose(1, 0), interp=0) for i in idxes])]
+  np.testing.assert_array_equal(mat_t1w, expected)
+  np.testing.assert_array_equal(mat_outline, expected_outline)
+
+  l=np.array([2.0, 2.5, 3.0])
+  mat_ref, mat_ref_outline, _=qa_view.get_mat_ref(img, outline, l)
+  expected=np.c_[tuple([qa_view.adjust_size_pixdim(img[:, ::-1, i].transpose(1, 0), [l[1], l[0]]) for i in idxes])]
+  np.testing.assert_array_equal(mat_ref, expected)
+
+def test_dynamic_mosaics_match_frame_by_frame():
+  rng=np.random.default_rng(1)
+  img_dyn=make_volume(rng, (36, 40, 24, 7))
+  l=np.array([2.0, 2.0, 2.5])
+  idxes=[5, 8, 11, 14, 17]
+  mats=qa_view.get_mat_dyn_all(img_dyn, idxes, l)
+  assert mats.shape[0]==7
+  for f in range(7):
+    expected=np.c_[tuple([qa_view.adjust_size_pixdim(img_dyn[:, ::-1, i, f].transpose(1, 0), [l[1], l[0]]) for i in idxes])]
+    np.testing.assert_array_equal(mats[f], expected)
+
+def test_reused_header_renders_same_page():
+  rng=np.random.default_rng(2)
+  l=np.array([2.0, 2.0, 2.0])
+  mat=rng.random((50, 250))
+  mats_dyn=[rng.random((50, 250)) for i in range(6)]
+
+  def render(fig):
+    fig.set_dpi(30)
+    fig.canvas.draw()
+    return np.asarray(fig.canvas.buffer_rgba()).copy()
+
+  fig=qa_view.get_qareport_process1(mat, mat, mat, 'S01', l)
+  n_axes, n_texts=len(fig.axes), len(fig.texts)
+  qa_view.get_qareport_process2(fig, mat, mats_dyn[:4], l, 0, 6)
+  qa_view.remove_artists(fig, n_axes, n_texts)
+  qa_view.get_qareport_process2(fig, mat, mats_dyn[4:], l, 4, 6)
+  reused=render(fig)
+
+  fig=qa_view.get_qareport_process1(mat, mat, mat, 'S01', l)
+  qa_view.get_qareport_process2(fig, mat, mats_dyn[4:], l, 4, 6)
+  np.testing.assert_array_equal(reused, render(fig))
+
+def test_read_slices_matches_padded_crop(tmp_path):
+  rng=np.random.default_rng(3)
+  for shape, dtype, slope in [((30, 34, 20, 9), np.int16, 0.01), ((30, 34, 20, 9), np.float32, 1), ((30, 34, 20), np.float32, 1)]:
+    img=nib.Nifti1Image((rng.random(shape)*1000).astype(dtype), np.eye(4))
+    img.header.set_slope_inter(slope, 0)
+    nib.save(img, str(tmp_path/'dyn.nii'))
+    img=nib.load(str(tmp_path/'dyn.nii'))
+
+    # float32 for the scaled int16 and float32 images
+    padded=np.asarray(img.dataobj).astype(np.float32)
+    if padded.ndim==3:
+      padded=padded.reshape(padded.shape+(1,))
+    padded=np.pad(padded, pad_width=((1, 1), (1, 1), (1, 1), (0, 0)), mode='constant')
+    for center, size in [((16, 18, 11), (20, 24, 14)), ((3, 30, 2), (16, 16, 16)), ((16, 18, 11), (60, 60, 60))]:
+      (x0, x1), (y0, y1), (z0, z1)=qa_view.get_crop_ranges(center, size, padded.shape[:3])
+      cropped=padded[x0:x1, y0:y1, z0:z1, :]
+      idxes=[0, 2, 4, z1-z0-1]
+      zs=[z0+i for i in idxes]
+      out=qa_view.read_slices(img.dataobj, [(x0, x1), (y0, y1)], zs)
+      assert out.dtype==np.float32
+      np.testing.assert_array_equal(out, cropped[:, :, idxes, :])
+      if len(shape)>3:
+        np.testing.assert_array_equal(qa_view.read_slices(img.dataobj, [(x0, x1), (y0, y1)], zs, (4, 8)), cropped[:, :, idxes, 4:8])
+
+def test_render_qa(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('TQ_FIG_DPI', '10')
+  rng=np.random.default_rng(4)
+  affine=np.diag([2.0, 2.0, 2.0, 1.0])
+  for name, shape in [('S01_t1w_r.nii', (40, 48, 30)), ('S01_t1w_brain_outline_r.nii', (40, 48, 30)),
+                      ('S01_t1w_brain_outline4pet.nii', (30, 30, 24)), ('S01_pmpbb3_dyn_mean.nii', (30, 30, 24)),
+                      ('S01_pmpbb3_dyn_align.nii', (30, 30, 24, 6)), ('S01_pmpbb3_dyn_f0000.nii', (30, 30, 24))]:
+    data=make_volume(rng, shape)
+    if 'outline' in name:
+      data=(data>0.8).astype(np.float32)
+    nib.save(nib.Nifti1Image(data.astype(np.float32), affine), name)
+  qa_view.render_qa('S01', 'S01_t1w_r.nii', 'S01_pmpbb3_dyn_mean.nii', 'S01_pmpbb3_dyn_align.nii', 'S01_pmpbb3_dyn_f0000.nii')
+  assert sorted([f for f in os.listdir('.') if f.endswith('.png')])==['S01_qaoutline_1.png', 'S01_qaoutline_2.png', 'S01_qareport_1.png', 'S01_qareport_2.png']
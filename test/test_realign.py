@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_realign.py
+### Objectives:
+# Tests for realign.py.
+# Frames of an analytic phantom are moved by known rigid transforms, with a change of contrast and noise,
+# and the estimated transforms are compared with the known ones (and with FLIRT when FSL is available).
+
+### Usage:
+# python -m pytest test/test_realign.py
+
+import shutil, subprocess
+import numpy as np
+import nibabel as nib
+import pytest
+
+import realign
+
+SHAPE=(40, 44, 32)
+PIXDIMS=np.array([2.0, 2.0, 2.5])
+TRUTH=[np.zeros(6), np.array([0.03, -0.02, 0.05, 2.0, -1.5, 3.0]), np.array([-0.05, 0.04, -0.02, -3.0, 2.0, 1.0])]
+
+def phantom(points, rng):
+  # Head-like ellipsoid with Gaussian blobs, evaluated at points (3, N) in mm
+  centre=(np.array(SHAPE)-1)*PIXDIMS/2
+  radius=np.array([34.0, 38.0, 34.0])
+  blobs=centre+rng.uniform(-1, 1, (40, 3))*radius*0.7
+  amps, sds=rng.uniform(0.5, 2, 40), rng.uniform(3, 8, 40)
+  d=np.sqrt((((points-centre[:, np.newaxis])/radius[:, np.newaxis])**2).sum(axis=0))
+  values=1/(1+np.exp((d-1)*30))
+  for b, a, s in zip(blobs, amps, sds):
+    values+=a*np.exp(-((points-b[:, np.newaxis])**2).sum(axis=0)/(2*s*s))
+  return values
+
+def make_frames(seed=0):
+  # Frame k is the phantom moved by TRUTH[k] (frame -> reference), its contrast being scaled by 1+0.3k
+  points=np.mgrid[tuple([slice(0, n) for n in SHAPE])].reshape((3, -1)).astype(np.float64)*PIXDIMS[:, np.newaxis]
+  centre=(np.array(SHAPE)-1)*PIXDIMS/2
+  frames=[]
+  for k, params in enumerate(TRUTH):
+    mat=realign.params2mat(params, centre)
+    values=phantom(mat[:3, :3].dot(points)+mat[:3, 3:], np.random.default_rng(seed))
+    frames.append(values.reshape(SHAPE)*(1+0.3*k)+np.random.default_rng(seed+k+1).normal(0, 0.02, SHAPE))
+  return np.stack(frames, axis=3), centre
+
+def check_mat(mat, params, centre):
+  # Same angles and same displacement of the centre of the reference
+  truth=realign.params2mat(params, centre)
+  np.testing.assert_allclose(realign.rotmat2euler(mat[:3, :3]), params[:3], atol=2e-3)
+  c=centre+np.array([5.0, -5.0, 3.0])
+  np.testing.assert_allclose(mat[:3, :3].dot(c)+mat[:3, 3], truth[:3, :3].dot(c)+truth[:3, 3], atol=0.1)
+
+def test_euler_angles_round_trip():
+  rng=np.random.default_rng(0)
+  for i in range(20):
+    angles=rng.uniform(-0.5, 0.5, 3)
+    rotmat=realign.construct_rotmat_euler(angles)
+    np.testing.assert_allclose(rotmat.dot(rotmat.T), np.eye(3), atol=1e-12)
+    np.testing.assert_allclose(realign.rotmat2euler(rotmat), angles, atol=1e-12)
+
+def test_reorient2std():
+  rng=np.random.default_rng(1)
+  data=rng.random((6, 7, 5))
+  std=nib.Nifti1Image(data, np.diag([-2.0, 2.0, 2.5, 1.0]))
+  # The same image stored in RAS and with swapped axes
+  ras=nib.Nifti1Image(data[::-1], std.affine.dot(nib.orientations.inv_ornt_aff([[0, -1], [1, 1], [2, 1]], data.shape)))
+  swapped=nib.Nifti1Image(data.transpose(1, 0, 2), std.affine[:, [1, 0, 2, 3]])
+  for img in [std, ras, swapped]:
+    out=realign.reorient2std(img)
+    np.testing.assert_array_equal(np.asanyarray(out.dataobj), data)
+    np.testing.assert_allclose(out.affine, std.affine)
+
+def test_recovers_known_motion():
+  data, centre=make_frames()
+  aligned, params, costs, mats=realign.realign_frames(data, PIXDIMS, max_workers=2)
+  for k in range(len(TRUTH)):
+    check_mat(mats[k], TRUTH[k], centre)
+  np.testing.assert_array_equal(aligned[..., 0], data[..., 0].astype(np.float32))
+  assert realign.get_rmax(mats)==pytest.approx(0.05, abs=2e-3)
+
+  # The realigned frames are closer to the reference than the moved ones
+  inside=data[..., 0]>0.5
+  for k in range(1, len(TRUTH)):
+    before=np.corrcoef(data[..., 0][inside], data[..., k][inside])[0, 1]
+    after=np.corrcoef(data[..., 0][inside], aligned[..., k][inside])[0, 1]
+    assert after>0.99 and after>before
+
+def test_run_outputs(tmp_path):
+  data, centre=make_frames(1)
+  nib.save(nib.Nifti1Image(data.astype(np.float32), np.diag(list(-PIXDIMS[:1])+list(PIXDIMS[1:])+[1.0])), str(tmp_path/'S01_pmpbb3_dyn.nii'))
+  prefix=str(tmp_path/'S01_pmpbb3_dyn')
+  rmax=realign.run(prefix+'.nii', prefix, max_workers=1)
+  assert rmax==pytest.approx(0.05, abs=2e-3)
+  assert nib.load(prefix+'_align.nii').shape==SHAPE+(3,)
+  mean=nib.load(prefix+'_align_mean.nii').get_fdata()
+  np.testing.assert_allclose(mean, nib.load(prefix+'_align.nii').get_fdata().mean(axis=3), rtol=1e-5)
+  np.testing.assert_array_equal(nib.load(prefix+'_f0000.nii').get_fdata(), data[..., 0].astype(np.float32))
+  rows=[line.split('\t') for line in open(prefix+'_align_params.tsv').read().splitlines()]
+  assert rows[0][:4]==['frame', 'Rx', 'Ry', 'Rz'] and len(rows)==4
+
+@pytest.mark.skipif(shutil.which('flirt') is None, reason='FSL is not available')
+def test_same_motion_as_flirt(tmp_path):
+  data, centre=make_frames(2)
+  affine=np.diag(list(-PIXDIMS[:1])+list(PIXDIMS[1:])+[1.0])
+  nib.save(nib.Nifti1Image(data[..., 0].astype(np.float32), affine), str(tmp_path/'ref.nii.gz'))
+  aligned, params, costs, mats=realign.realign_frames(data, PIXDIMS, max_workers=1)
+  for k in range(1, len(TRUTH)):
+    nib.save(nib.Nifti1Image(data[..., k].astype(np.float32), affine), str(tmp_path/'frame.nii.gz'))
+    subprocess.check_call(['flirt', '-dof', '6', '-in', str(tmp_path/'frame.nii.gz'), '-ref', str(tmp_path/'ref.nii.gz'),
+                           '-cost', 'normmi', '-searchcost', 'normmi', '-omat', str(tmp_path/'frame.mat')])
+    flirt_mat=np.loadtxt(str(tmp_path/'frame.mat'))
+    np.testing.assert_allclose(realign.rotmat2euler(mats[k][:3, :3]), realign.rotmat2euler(flirt_mat[:3, :3]), atol=5e-3)
+    np.testing.assert_allclose(mats[k][:3, 3], flirt_mat[:3, 3], atol=0.5)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_reg_qc.py
+### Objectives:
+# Tests for the registration QC of reg_qc.py. The angles are compared with the outputs of avscale for fixed
+# FLIRT matrices and with the rotations of realign.py, and the rows are read back by tq_qc.py.
+
+### Usage:
+# python -m pytest test/test_reg_qc.py
+
+import numpy as np
+import nibabel as nib
+
+import realign
+import reg_qc
+import tq_qc
+
+def test_angles_of_affine_matrices():
+  rng=np.random.default_rng(0)
+  angles=rng.uniform(-0.6, 0.6, (20, 3))
+  mats=np.tile(np.eye(4), (20, 1, 1))
+  for i in range(20):
+    # rotation x scales x skews as avscale
+    skew=np.eye(3)
+    skew[0, 1:]=rng.uniform(-0.1, 0.1, 2)
+    skew[1, 2]=rng.uniform(-0.1, 0.1)
+    mats[i, :3, :3]=realign.construct_rotmat_euler(angles[i])@np.diag(rng.uniform(0.8, 1.2, 3))@skew
+    mats[i, :3, 3]=rng.uniform(-10, 10, 3)
+  np.testing.assert_allclose(reg_qc.euler_angles(reg_qc.rotation_matrices(mats)), angles, atol=1e-10)
+  rigid=np.array([realign.construct_rotmat_euler(a) for a in angles])
+  np.testing.assert_allclose(reg_qc.euler_angles(rigid), [realign.rotmat2euler(R) for R in rigid], atol=1e-12)
+
+# FLIRT matrices (6, 9 and 12 DOF) and the "Rotation Angles (x,y,z) [rads]" printed by avscale --allparams.
+# The matrices are built as avscale decomposes them (rotation x skew x scale, with the rotation
+# Rx x Ry x Rz of construct_rotmat_euler of FSL) and written with the 6 decimals of a .mat file.
+AVSCALE_CASES=[
+  ([[0.999128, 0.034551, 0.023454, 1.5],
+    [-0.034847, 0.999316, 0.012341, -2.25],
+    [-0.023011, -0.013148, 0.999649, 3.0],
+    [0, 0, 0, 1]], [0.012345, -0.023456, 0.034567]),
+  ([[1.086289, 0.046947, -0.152427, -12.0],
+    [-0.086498, 0.928490, -0.200367, 4.5],
+    [0.149982, 0.195454, 0.988443, 20.0],
+    [0, 0, 0, 1]], [-0.2, 0.15, 0.05]),
+  ([[0.803185, -0.192415, 0.413299, 7.25],
+    [0.112366, 1.008369, 0.413730, -3.5],
+    [-0.390216, -0.226770, 1.052864, -15.75],
+    [0, 0, 0, 1]], [0.3, -0.4, -0.25]),
+]
+
+def test_angles_match_avscale(tmp_path):
+  fnames=[]
+  for i, (mat, angles) in enumerate(AVSCALE_CASES):
+    fnames.append(str(tmp_path/'{:d}.mat'.format(i)))
+    np.savetxt(fnames[-1], mat, fmt='%.6f')
+  # avscale prints 6 decimals
+  np.testing.assert_allclose(reg_qc.get_angles(fnames), [angles for mat, angles in AVSCALE_CASES], atol=5e-6)
+
+def test_dice_is_truncated():
+  a=np.zeros((4, 4, 4))
+  b=np.zeros((4, 4, 4))
+  a[0, 0, :3]=1
+  b[0, 0, 1:]=2.5
+  # 2*2/(3+3)=0.6666...
+  assert reg_qc.calc_dice(a, b)==0.666
+  assert reg_qc.calc_dice(a, a)==1.0 and reg_qc.calc_dice(a*0, b*0)==0.0
+
+def test_decide(monkeypatch):
+  rotations=np.array([[0.1, -0.5, 0.2, 0.3], [0.1, -1.2, 0.2, 0.3], [0.1, 0.1, 0.1, 0.1]])
+  dice=np.array([0.95, 0.95, np.nan])
+  assert reg_qc.decide(rotations, dice).tolist()==[True, False, False]
+  monkeypatch.setenv('TQ_ROT_THR', '1.5')
+  monkeypatch.setenv('TQ_DICE_THR', '0.96')
+  assert reg_qc.decide(rotations, dice).tolist()==[False, False, False]
+  assert reg_qc.decide(rotations, dice+0.02).tolist()==[True, True, False]
+
+def test_pet_row_is_read_by_tq_qc(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  mask=np.zeros((8, 8, 8), dtype=np.uint8)
+  mask[2:6, 2:6, 2:6]=1
+  nib.save(nib.Nifti1Image(mask, np.eye(4)), 'a.nii')
+  nib.save(nib.Nifti1Image(mask, np.eye(4)), 'b.nii.gz')
+  mat=np.eye(4)
+  mat[:3, :3]=realign.construct_rotmat_euler([0.1, -0.2, 0.3])*1.05
+  np.savetxt('S01_PET2MNI.mat', mat)
+  for i, a in enumerate([0.01, 0.4, -0.7]):
+    np.savetxt('S01_f{:d}_align.mat'.format(i), np.r_[np.c_[realign.construct_rotmat_euler([a, 0, 0]), np.zeros(3)], [[0, 0, 0, 1]]])
+  (tmp_path/'coregistration_results_pet.csv').write_text('ID,Rmax_frame,Rx_mean,Ry_mean,Rz_mean,Dice,QC\n')
+  frames=sorted([str(f) for f in tmp_path.glob('S01_f*_align.mat')])
+  rmax, angles, dice, state=reg_qc.qc_pet('S01', 'S01_PET2MNI.mat', 'a.nii', 'b.nii.gz', 'coregistration_results_pet.csv', frames=frames)
+  assert abs(rmax-0.4)<1e-10 and dice==1.0 and state=='OK'
+  np.testing.assert_allclose(angles, [0.1, -0.2, 0.3], atol=1e-10)
+  reg_qc.qc_pet('S02', 'S01_PET2MNI.mat', 'a.nii', 'b.nii.gz', 'coregistration_results_pet.csv', rmax=1.2)
+  lines=(tmp_path/'coregistration_results_pet.csv').read_text().splitlines()
+  assert lines[1]=='S01,0.400000,0.100000,-0.200000,0.300000,1.000,OK' and lines[2].endswith(',CHECK')
+
+  for ID in ['S01', 'S02']:
+    (tmp_path/(ID+'_t1w_r.nii')).write_text('')
+    (tmp_path/(ID+'_pmpbb3_dyn_mean.nii')).write_text('')
+  assert tq_qc.get_status_10(['S01', 'S02'])==['OK', 'CHECK']
+
+def test_rows_are_replaced(tmp_path, monkeypatch):
+  # The header is written to a new file, and a rerun replaces the row of the subject
+  monkeypatch.chdir(tmp_path)
+  mask=np.zeros((8, 8, 8), dtype=np.uint8)
+  mask[2:6, 2:6, 2:6]=1
+  nib.save(nib.Nifti1Image(mask, np.eye(4)), 'a.nii')
+  np.savetxt('S01_PET2MNI.mat', np.eye(4))
+  for ID, rmax in [('S01', 0.2), ('S02', 0.1), ('S01', np.nan)]:
+    reg_qc.qc_pet(ID, 'S01_PET2MNI.mat', 'a.nii', 'a.nii', 'qc.csv', rmax=rmax)
+  lines=(tmp_path/'qc.csv').read_text().splitlines()
+  assert lines[0]==','.join(reg_qc.HEADER_PET)
+  assert len(lines)==3 and lines[1].startswith('S02,')
+  # Rmax_frame is NA when the realignment failed
+  assert lines[2].startswith('S01,NA,') and lines[2].endswith(',1.000,CHECK')
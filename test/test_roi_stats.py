@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_roi_stats.py
+### Objectives:
+# Tests for the grouped ROI statistics of roi_stats.py.
+# The grouped reduction is compared with a per-label loop equivalent to fslstats -K ... -M.
+
+### Usage:
+# python -m pytest test/test_roi_stats.py
+
+import numpy as np
+import nibabel as nib
+
+import roi_stats
+
+def per_label_stats(labels, img, label_ids):
+  out={'mean': [], 'count': [], 'sd': [], 'median': []}
+  for label in label_ids:
+    v=img[(labels==label) & (img!=0)].astype(np.float64)
+    # A label which is not in the label volume is missing
+    empty=roi_stats.MISSING if np.sum(labels==label)==0 else np.nan
+    out['count'].append(len(v))
+    out['mean'].append(v.mean() if len(v)>0 else empty)
+    out['sd'].append(v.std(ddof=1) if len(v)>1 else empty)
+    out['median'].append(np.median(v) if len(v)>0 else empty)
+  return {stat: np.array(values) for stat, values in out.items()}
+
+def test_group_stats_matches_per_label_loop():
+  rng=np.random.default_rng(0)
+  labels=rng.choice([0, 7, 8, 16, 1001, 1035, 2001, 4035], size=(20, 22, 18))
+  img=rng.normal(1.2, 0.3, size=labels.shape).astype(np.float32)
+  img[rng.random(labels.shape)<0.1]=0
+  # 9999 does not exist in the label volume
+  label_ids=[8, 7, 1001, 16, 4035, 2001, 1035, 9999]
+
+  result=roi_stats.group_stats(labels, img, label_ids, roi_stats.STATS)
+  expected=per_label_stats(labels, img, label_ids)
+  for stat in roi_stats.STATS:
+    np.testing.assert_allclose(result[stat], expected[stat], rtol=1e-10, equal_nan=True)
+
+def test_region_tables_are_unique():
+  for table in ['wmparc', 'merged']:
+    regions=roi_stats.load_region_table(table)
+    assert len(regions)>0
+    assert len(set([(atlas, label) for name, atlas, label in regions]))==len(regions)
+
+def test_process_subject_writes_tables(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rng=np.random.default_rng(1)
+  affine=np.eye(4)
+  labels=rng.choice([0, 8, 47, 1001], size=(10, 10, 10)).astype(np.float32)
+  bsseg=rng.choice([0, 173, 174], size=(10, 10, 10)).astype(np.float32)
+  suvr=rng.normal(1.0, 0.2, size=(10, 10, 10)).astype(np.float32)
+  nib.save(nib.Nifti1Image(labels, affine), 'S01_wmparc_r.nii.gz')
+  nib.save(nib.Nifti1Image(bsseg, affine), 'S01_bsseg_r.nii.gz')
+  nib.save(nib.Nifti1Image(suvr, affine), 'S01_pmpbb3_suvr.nii.gz')
+
+  # 1035 is not in the label volume
+  regions=[('Lt-Cerebellum-Cortex', 'wmparc', 8), ('Midbrain', 'bsseg', 173), ('Lt-wm-bankssts', 'wmparc', 1001),
+           ('Lt-wm-insula', 'wmparc', 1035)]
+  roi_stats.process_subject('S01', regions, [('_pmpbb3_suvr', 'suvr_wmparc_mean')], ['mean', 'count'])
+  roi_stats.save_cohort_table(regions, 'suvr_wmparc_mean', 'suvr_wmparc_mean_test.tsv')
+
+  lines=open('S01_pmpbb3_suvr_wmparc_mean.tsv').read().splitlines()
+  assert lines[0]=='S01'
+  assert lines[2]=='{:.6f}'.format(suvr[bsseg==173].astype(np.float64).mean())
+  counts=open('S01_pmpbb3_suvr_wmparc_count.tsv').read().splitlines()
+  assert int(counts[1])==int(np.sum(labels==8))
+  table=open('suvr_wmparc_mean_test.tsv').read().splitlines()
+  assert table[0]=='Region'.ljust(30)+'\tS01'
+  assert table[3].startswith('Lt-wm-bankssts\t')
+  # Missing labels are written as fslstats -K printed them
+  assert lines[4]=='missing label: 35'
+  assert table[4]=='Lt-wm-insula\tmissing label: 35'
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_tq_cache.py
+### Objectives:
+# Tests for the stage cache of tq_cache.py and its use by tq_scheduler.py.
+
+### Usage:
+# python -m pytest test/test_tq_cache.py
+
+import os, sys
+
+import get_ref
+import tq_cache
+import tq_scheduler
+from tq_scheduler import Stage
+
+SPEC={
+  'a': dict(inputs=['{ID}_in'], outputs=['{ID}_a'], clean=['{ID}_a'], code=[], params=None),
+  'b': dict(inputs=['{ID}_a'], outputs=['{ID}_b'], clean=['{ID}_b'], code=[], params='get_ref'),
+  'c': dict(inputs=['{ID}_in'], outputs=['{ID}_c'], clean=['{ID}_c'], code=[], params=['get_ref', 'TQ_DTYPE']),
+}
+
+def copy(src, dst):
+  # Command copying {ID}_[src] to {ID}_[dst] and logging the run
+  code='import sys; ID=sys.argv[1]; open(ID+"_{}", "w").write(open(ID+"_{}").read()); open("runs.txt", "a").write(ID+" {}\\n")'.format(dst, src, dst)
+  return [sys.executable, '-c', code, '{ID}']
+
+STAGES=[
+  Stage('a', [copy('in', 'a')], [], 1, 1, 1, None),
+  Stage('b', [copy('a', 'b')], ['a'], 1, 1, 1, None),
+]
+
+def run(IDs):
+  if os.path.exists('runs.txt'):
+    os.remove('runs.txt')
+  tq_scheduler.run_tasks(IDs, STAGES, [], max_cpus=2, max_mem=2, cache_file=tq_cache.MANIFEST, cache_spec=SPEC)
+  return sorted(open('runs.txt').read().splitlines()) if os.path.exists('runs.txt') else []
+
+def test_record_and_is_fresh(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  open('S01_in', 'w').write('1')
+  open('S01_a', 'w').write('1')
+  manifest=tq_cache.load_manifest()
+  assert not tq_cache.is_fresh(manifest, 'S01', 'a', SPEC['a'])
+  tq_cache.record(manifest, 'S01', 'a', SPEC['a'])
+  assert tq_cache.is_fresh(manifest, 'S01', 'a', SPEC['a'])
+
+  # The same size and time stamp are not hashed again
+  path='S01_in'
+  size, mtime, digest=manifest['files'][path]
+  assert tq_cache.hash_file(path, manifest['files'])==digest
+
+  open('S01_in', 'w').write('2')
+  assert not tq_cache.is_fresh(manifest, 'S01', 'a', SPEC['a'])
+
+def test_rerun_only_changed(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  for ID in ['S01', 'S02']:
+    open(ID+'_in', 'w').write(ID)
+  assert run(['S01', 'S02'])==['S01 a', 'S01 b', 'S02 a', 'S02 b']
+  assert run(['S01', 'S02'])==[]
+
+  # New subject
+  open('S03_in', 'w').write('S03')
+  assert run(['S01', 'S02', 'S03'])==['S03 a', 'S03 b']
+
+  # Changed input of a subject
+  open('S01_in', 'w').write('S01 new')
+  assert run(['S01', 'S02', 'S03'])==['S01 a', 'S01 b']
+
+  # Changed parameter of get_ref only reruns the stage using it
+  monkeypatch.setattr(get_ref, 'bin_width', get_ref.bin_width*2)
+  assert run(['S01', 'S02', 'S03'])==['S01 b', 'S02 b', 'S03 b']
+
+def test_missing_output_is_reprocessed(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  open('S01_in', 'w').write('S01')
+  run(['S01'])
+  os.remove('S01_b')
+  assert run(['S01'])==['S01 b']
+
+def test_environment_parameters(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.delenv('TQ_DTYPE', raising=False)
+  open('S01_in', 'w').write('1')
+  open('S01_c', 'w').write('1')
+  manifest=tq_cache.load_manifest()
+  entry=tq_cache.record(manifest, 'S01', 'c', SPEC['c'])
+  assert entry['params']['TQ_DTYPE']=='' and entry['params']['bin_width']==get_ref.bin_width
+  assert tq_cache.is_fresh(manifest, 'S01', 'c', SPEC['c'])
+  monkeypatch.setenv('TQ_DTYPE', 'float64')
+  assert not tq_cache.is_fresh(manifest, 'S01', 'c', SPEC['c'])
+  for stage in ['tq_10', 'tq_30', 'tq_31', 'tq_50']:
+    assert tq_cache.CACHE_SPEC[stage]['params']
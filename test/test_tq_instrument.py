@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_tq_instrument.py
+### Objectives:
+# Tests for the resource recording and the run report of tq_instrument.py.
+
+### Usage:
+# python -m pytest test/test_tq_instrument.py
+
+import os, sys
+import numpy as np
+import pytest
+
+import tq_instrument
+
+def test_nothing_recorded_without_tq_metrics(tmp_path, monkeypatch):
+  monkeypatch.delenv('TQ_METRICS', raising=False)
+  monkeypatch.chdir(tmp_path)
+  with tq_instrument.timed('step', ID='S01'):
+    pass
+  assert os.listdir(tmp_path)==[]
+
+def test_timed_and_run(tmp_path, monkeypatch):
+  metrics=str(tmp_path/'metrics.jsonl')
+  monkeypatch.setenv('TQ_METRICS', metrics)
+  with tq_instrument.timed('python.step', ID='S01'):
+    np.ones((256, 256, 64)).sum()
+  with pytest.raises(ValueError):
+    with tq_instrument.timed('python.error', ID='S02'):
+      raise ValueError()
+  assert tq_instrument.run([sys.executable, '-c', 'import sys; sys.exit(3)'], 'command', ID='S01', stage='tq_99')==3
+
+  records=tq_instrument.load_records(metrics)
+  assert [r['step'] for r in records]==['python.step', 'python.error', 'command']
+  assert records[0]['ID']=='S01' and records[0]['status']=='ok' and records[0]['maxrss_mb']>0
+  assert records[1]['status']=='ValueError'
+  assert records[2]['stage']=='tq_99' and records[2]['status']=='exit 3'
+  for r in records:
+    assert r['wall_s']>=0 and r['cpu_s']>=0
+
+def test_summary():
+  records=[
+    dict(step='tq_40_recon-all', ID='S01', wall_s=100.0, cpu_s=90.0, maxrss_mb=900, read_mb=1.0, write_mb=2.0, status='ok'),
+    dict(step='tq_40_recon-all', ID='S02', wall_s=300.0, cpu_s=250.0, maxrss_mb=1200, read_mb=1.0, write_mb=2.0, status='exit 1'),
+    dict(step='get_ref.fit', ID='S01', wall_s=1.5, cpu_s=1.4, maxrss_mb=200, read_mb=0.0, write_mb=0.0, status='ok'),
+  ]
+  rows=tq_instrument.summarize(records)
+  assert rows['tq_40_recon-all']['n']==2 and rows['tq_40_recon-all']['slowest']=='S02'
+  assert rows['tq_40_recon-all']['failed']==1 and rows['tq_40_recon-all']['rss']==1200
+  lines=tq_instrument.format_summary(rows).splitlines()
+  assert lines[1].split('\t')[:3]==['tq_40_recon-all', '2', '400.0']
+  assert lines[2].startswith('get_ref.fit\t1\t')
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_tq_qc.py
+### Objectives:
+# Tests for tq_qc.py with the result files of a synthetic cohort.
+# The status of tq_10 is compared with the thresholds of the bc loop of tq-all.sh, and outliers
+# of the reference values and Dice coefficients are flagged.
+
+### Usage:
+# python -m pytest test/test_tq_qc.py
+
+import os
+import numpy as np
+
+import tq_qc
+import tq_scheduler
+
+def make_cohort(directory, n=12):
+  rng=np.random.default_rng(0)
+  IDs=['S{:02d}'.format(i) for i in range(n)]
+  pet=['ID,Rmax_frame,Rx_mean,Ry_mean,Rz_mean,Dice']
+  t1w=['ID,Rx,Ry,Rz,Dice']
+  for i, ID in enumerate(IDs):
+    rot=rng.uniform(-0.5, 0.5, 4)
+    dice=rng.uniform(0.95, 0.96)
+    if ID=='S01':
+      rot[2]=-1.2
+    if ID=='S02':
+      dice=0.90
+    pet.append(','.join([ID]+['{:.4f}'.format(r) for r in rot]+['{:.3f}'.format(dice)[1:]]))
+    t1w.append(','.join([ID]+['{:.4f}'.format(r) for r in rng.uniform(-5, 5, 3)]+['.{:d}'.format(rng.integers(950, 960))]))
+  (directory/'coregistration_results_pet.csv').write_text('\n'.join(pet)+'\n')
+  (directory/'coregistration_results_t1w.csv').write_text('\n'.join(t1w)+'\n')
+  for tissue, d in tq_qc.HISTOGRAM_DIRECTORIES:
+    os.mkdir(directory/d)
+    lines=['\t'.join(['ID', 'probability map', 'voxel num', 'a1', 'b1', 'c1', 'a2', 'b2', 'c2', 'FWHM_min', 'FWHM_max', 'refnum', 'refval'])]
+    for ID in IDs:
+      refval=rng.normal(1000, 20)
+      if ID=='S03' and tissue=='GM':
+        # An earlier run superseded by the last row
+        lines.append('\t'.join([ID, 'c1', '50000']+['0']*6+['900', '1100', '20000', '5000']))
+      if ID=='S04' and tissue=='GM':
+        refval=1500
+      lines.append('\t'.join([ID, 'c1', '50000']+['0']*6+['900', str(1100+rng.normal(0, 10)), '20000', str(refval)]))
+    (directory/d/'histogram_parameters.txt').write_text('\n'.join(lines)+'\n')
+  for ID in IDs:
+    if ID!='S05':
+      (directory/(ID+'_t1w_r.nii')).write_text('')
+      (directory/(ID+'_pmpbb3_dyn_mean.nii')).write_text('')
+  return IDs
+
+def test_status_matches_thresholds(tmp_path, monkeypatch):
+  IDs=make_cohort(tmp_path)
+  status=tq_qc.get_status_10(IDs+['S99'], directory=str(tmp_path))
+  assert status[1]=='CHECK' and status[2]=='CHECK' and status[5]=='NA' and status[-1]=='NA'
+  assert [state for i, state in enumerate(status[:-1]) if i not in [1, 2, 5]]==['OK']*(len(IDs)-3)
+  # The scheduler gives the same status
+  monkeypatch.chdir(tmp_path)
+  assert [tq_scheduler.check_tq_10(ID) for ID in IDs]==status[:-1]
+
+def test_report_flags_outliers(tmp_path):
+  IDs=make_cohort(tmp_path)
+  qc=tq_qc.run_report(timestamp='test', directory=str(tmp_path))
+  assert list(qc)==IDs
+  assert qc['S04']=='CHECK' and qc['S05']=='NA' and qc['S00']=='OK'
+
+  with open(str(tmp_path/'QC_Report_test.tsv')) as f:
+    rows=[line.rstrip('\n').split('\t') for line in f]
+  header=rows[0]
+  report={row[0]: dict(zip(header, row)) for row in rows[1:]}
+  assert report['S04']['flagged']=='refval_GM'
+  assert 'Dice_pet' in report['S02']['flagged'].split(',')
+  # Last row of S03
+  assert float(report['S03']['refval_GM'])!=5000
+
+  with open(str(tmp_path/'QC_Summary_test.tsv')) as f:
+    summary={line.split('\t')[0]: line.rstrip('\n').split('\t') for line in f}
+  assert summary['refval_GM'][-1]=='S04'
+  # S05 failed tq_10 and is left out of the statistics
+  assert summary['refval_GM'][1]==str(len(IDs)-1)
+
+def test_robust_z_vectorized():
+  values=np.array([[1.0, 5.0], [2.0, 5.0], [3.0, 5.0], [100.0, 6.0], [np.nan, 5.0]])
+  n, median, mad, scale=tq_qc.robust_stats(values)
+  assert n.tolist()==[4, 5] and median.tolist()==[2.5, 5.0] and mad.tolist()==[1.0, 0.0]
+  z=tq_qc.robust_z(values, median, scale)
+  assert z[3, 0]==(100-2.5)/1.4826 and z[3, 1]==np.inf and z[0, 1]==0 and np.isnan(z[4, 0])
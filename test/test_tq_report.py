@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_tq_report.py
+### Objectives:
+# Tests for the figure backend of tq_report.py.
+# The overview drawn on one reused figure is compared with the two figures of the original overlay_view.py,
+# and the deferred histograms and the cohort rendering are checked on synthetic data.
+
+### Usage:
+# python -m pytest test/test_tq_report.py
+
+import os
+import numpy as np
+import nibabel as nib
+
+import tq_report
+from tq_report import plt
+import get_ref
+
+def draw_overview_original(mat_t1w, mat_pet, thr, uthr, ID, out_t1, out_pet, dpi):
+  # overlay_view.py of TAME-Q 1.1.0 (with the resolution of the test)
+  fig=plt.figure(figsize=(8.27, 11.69), dpi=dpi, facecolor='white')
+  ax=fig.add_axes((0.03, 0.13, 0.94, 0.8))
+  ax.imshow(mat_t1w, cmap='gray')
+  ax.axes.xaxis.set_visible(False)
+  ax.axes.yaxis.set_visible(False)
+  fig.text(0.6, 0.09, ID, size=20)
+  fig.savefig(out_t1)
+  plt.close(fig)
+
+  fig=plt.figure(figsize=(8.27, 11.69), dpi=dpi, facecolor='white')
+  ax=fig.add_axes((0.03, 0.13, 0.94, 0.8))
+  ax.imshow(mat_t1w, cmap='gray')
+  msk=ax.imshow(mat_pet, cmap='jet', alpha=0.4)
+  msk.set_clim(thr, uthr)
+  ax.axes.xaxis.set_visible(False)
+  ax.axes.yaxis.set_visible(False)
+  cax=fig.add_axes((0.11, 0.09, 0.4, 0.03))
+  fig.colorbar(msk, orientation='horizontal', cax=cax)
+  fig.text(0.6, 0.09, ID, size=20)
+  fig.savefig(out_pet)
+  plt.close(fig)
+
+def test_backend_and_settings(monkeypatch):
+  assert plt.get_backend().lower()=='agg'
+  monkeypatch.delenv('TQ_FIG_DPI', raising=False)
+  monkeypatch.delenv('TQ_FIG_FORMAT', raising=False)
+  assert tq_report.get_dpi(600)==600 and tq_report.get_fname('S01_t1.png')=='S01_t1.png'
+  monkeypatch.setenv('TQ_FIG_DPI', '150')
+  monkeypatch.setenv('TQ_FIG_FORMAT', 'jpeg')
+  assert tq_report.get_dpi(600)==150 and tq_report.get_fname('S01_t1.png')=='S01_t1.jpeg'
+
+def test_reused_overview_matches_original(tmp_path, monkeypatch):
+  monkeypatch.setenv('TQ_FIG_DPI', '20')
+  rng=np.random.default_rng(0)
+  mat_t1w, mat_pet=rng.random((60, 50)), rng.random((60, 50))*3
+  draw_overview_original(mat_t1w, mat_pet, 1, 2, 'S01', str(tmp_path/'t1.png'), str(tmp_path/'pet.png'), 20)
+  for i in range(2):
+    tq_report.draw_overview(mat_t1w, mat_pet, 1, 2, 'S01', str(tmp_path/'t1_r.png'), str(tmp_path/'pet_r.png'))
+    for name in ['t1', 'pet']:
+      np.testing.assert_array_equal(plt.imread(str(tmp_path/(name+'.png'))), plt.imread(str(tmp_path/(name+'_r.png'))))
+
+def test_deferred_histogram(tmp_path, monkeypatch):
+  monkeypatch.delenv('TQ_FIG_FORMAT', raising=False)
+  rng=np.random.default_rng(1)
+  values=np.r_[rng.normal(1.0, 0.15, 14000), rng.normal(1.6, 0.3, 6000)]
+  pet=np.abs(values).reshape(20, 20, 50)
+  result=get_ref.estimate_reference(pet, np.ones(pet.shape))
+  a1, b1, c1, a2, b2, c2=result.params
+  am, bm, cm=result.params_mono
+  os.mkdir(tmp_path/'direct')
+  get_ref.save_figure(result.x, result.y, a1, b1, c1, a2, b2, c2, am, bm, cm, result.dsc, result.refnum, result.refval, result.dsc_thr, 'S01', str(tmp_path/'direct'))
+
+  tq_report.save_histogram_data('S01', result, str(tmp_path))
+  for i in range(2):
+    tq_report.render_histogram('S01', str(tmp_path/'S01_histogram.npz'), str(tmp_path))
+    np.testing.assert_array_equal(plt.imread(str(tmp_path/'direct'/'S01_histogram.jpeg')), plt.imread(str(tmp_path/'S01_histogram.jpeg')))
+
+def test_render_all(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('TQ_FIG_DPI', '10')
+  rng=np.random.default_rng(2)
+  for ID in ['S01', 'S02']:
+    nib.save(nib.Nifti1Image(rng.random((140, 180, 140)).astype(np.float32), np.eye(4)), ID+'_t1w_r_l.nii.gz')
+    nib.save(nib.Nifti1Image(rng.random((140, 180, 140)).astype(np.float32)*3, np.eye(4)), ID+'_pmpbb3_suvr_l.nii.gz')
+  rows=tq_report.get_tasks(['S01', 'S02', 'S03'])
+  assert [(row[0], row[1]) for row in rows]==[('S01', 'overview'), ('S02', 'overview')]
+
+  assert tq_report.render_all(['S01', 'S02', 'S03'], max_workers=2)==[]
+  for ID in ['S01', 'S02']:
+    for view in ['axi', 'cor']:
+      assert os.path.exists(ID+'_overview_'+view+'_t1.png') and os.path.exists(ID+'_overview_'+view+'_1_2.png')
+  assert not os.path.exists('S03_overview_axi_t1.png')
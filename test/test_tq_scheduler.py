@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_tq_scheduler.py
+### Objectives:
+# Tests for the dependency-aware scheduler of tq_scheduler.py with small stages which only create files.
+
+### Usage:
+# python -m pytest test/test_tq_scheduler.py
+
+import os, sys, time
+
+import tq_scheduler
+from tq_scheduler import Stage
+
+def touch(name, delay=0.0, fail_id=None):
+  # Command creating {ID}_[name] after delay seconds (not created for fail_id)
+  code='import sys, time; time.sleep({}); ID=sys.argv[1]; '.format(delay)
+  code+='ID=="{}" or open(ID+"_{}", "w").close(); '.format(fail_id, name)
+  code+='open("order.txt", "a").write(ID+" {}\\n")'.format(name)
+  return [sys.executable, '-c', code, '{ID}']
+
+def made(name):
+  return lambda ID: tq_scheduler.status_of(os.path.exists(ID+'_'+name))
+
+def make_stages(fail_id=None, slow=0.0):
+  return [
+    Stage('a', [touch('a')], [], 1, 1, 1, made('a')),
+    Stage('b', [touch('b', fail_id=fail_id)], ['a'], 1, 1, 1, made('b')),
+    Stage('c', [touch('c', delay=slow)], ['a'], 1, 1, 10, made('c')),
+    Stage('d', [touch('d')], ['b', 'c'], 1, 1, 1, None),
+  ]
+
+def test_dependencies_and_status(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  IDs=['S01', 'S02', 'S03']
+  status=tq_scheduler.run_tasks(IDs, make_stages(fail_id='S02'), [], max_cpus=2, max_mem=4,
+                                status_file='Process_Status_test.csv')
+  assert status[('S01', 'b')]=='OK'
+  assert status[('S02', 'b')]=='NA'
+  assert status[('S02', 'c')]=='OK'
+  # d of S02 is not run because b failed
+  assert os.path.exists('S01_d') and os.path.exists('S03_d')
+  assert not os.path.exists('S02_d')
+
+  order=[line.split() for line in open('order.txt').read().splitlines()]
+  for ID in ['S01', 'S03']:
+    pos={name: order.index([ID, name]) for name in 'abcd'}
+    assert pos['a']<pos['b'] and pos['a']<pos['c'] and pos['b']<pos['d'] and pos['c']<pos['d']
+
+  lines=open('Process_Status_test.csv').read().splitlines()
+  assert lines[0]=='ID,a,b,c'
+  assert lines[2]=='S02,OK,NA,OK'
+
+def test_subjects_do_not_wait_for_each_other(tmp_path, monkeypatch):
+  # With two cores, the fast stages of one subject run while the slow stage of another is running
+  monkeypatch.chdir(tmp_path)
+  stages=make_stages(slow=0.0)
+  stages[2]=Stage('c', [[sys.executable, '-c',
+    'import sys, time; ID=sys.argv[1]; time.sleep(1.5 if ID=="S01" else 0); open(ID+"_c", "w").close(); open("order.txt", "a").write(ID+" c\\n")',
+    '{ID}']], ['a'], 1, 1, 10, made('c'))
+  start=time.time()
+  tq_scheduler.run_tasks(['S01', 'S02'], stages, [], max_cpus=2, max_mem=4)
+  order=[line.split() for line in open('order.txt').read().splitlines()]
+  assert order.index(['S02', 'd'])<order.index(['S01', 'c'])
+  assert time.time()-start<10
+
+def test_cohort_stage_runs_last(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  cohort=[Stage('tables', [[sys.executable, '-c', 'open("order.txt", "a").write("all tables\\n")']], ['d'], 1, 1, 1, None)]
+  tq_scheduler.run_tasks(['S01', 'S02'], make_stages(), cohort, max_cpus=3, max_mem=4)
+  order=open('order.txt').read().splitlines()
+  assert order[-1]=='all tables'
+  assert len(order)==9
+
+def test_failed_command_without_check(tmp_path, monkeypatch):
+  # A stage without a check fails when its command exits with non-zero status
+  monkeypatch.chdir(tmp_path)
+  stages=make_stages()
+  stages[3]=Stage('d', [[sys.executable, '-c', 'import sys; sys.exit(sys.argv[1]=="S02")', '{ID}']], ['b', 'c'], 1, 1, 1, None)
+  stages.append(Stage('e', [touch('e')], ['d'], 1, 1, 1, made('e')))
+  status=tq_scheduler.run_tasks(['S01', 'S02'], stages, [], max_cpus=2, max_mem=4)
+  assert status[('S01', 'e')]=='OK' and status[('S02', 'e')]=='NA'
+  assert not os.path.exists('S02_e')
+
+def test_pool_is_limited_by_cores(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  workers=[]
+  executor=tq_scheduler.ThreadPoolExecutor
+  def limited(max_workers):
+    workers.append(max_workers)
+    return executor(max_workers=max_workers)
+  monkeypatch.setattr(tq_scheduler, 'ThreadPoolExecutor', limited)
+  tq_scheduler.run_tasks(['S01', 'S02', 'S03'], make_stages(), [], max_cpus=2, max_mem=4)
+  assert workers==[2]
+
+def test_priorities_follow_longest_path():
+  priorities=tq_scheduler.get_priorities(tq_scheduler.STAGES)
+  assert priorities['tq_40']>priorities['tq_20']
+  assert priorities['tq_10']==max(priorities.values())
+
+def test_relocate_failed(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  os.makedirs('histogram_GMref')
+  os.makedirs(os.path.join('subjects', 'S01', 'mri'))
+  for f in ['S01_t1w.nii', 'S01_pmpbb3_suvr.nii.gz', os.path.join('histogram_GMref', 'S01_hist.png'), 'S02_t1w.nii']:
+    open(f, 'w').close()
+  tq_scheduler.relocate_all_failed(['S01', 'S02'], {('S01', 'tq_41'): 'NA', ('S02', 'tq_41'): 'OK'})
+  d=os.path.join('failed', 'tq_41', 'S01')
+  assert os.path.exists(os.path.join(d, 'S01_t1w.nii'))
+  assert os.path.exists(os.path.join(d, 'histogram_GMref', 'S01_hist.png'))
+  assert os.path.exists(os.path.join(d, 'subjects', 'S01', 'mri'))
+  assert os.path.exists('S02_t1w.nii')
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+### TAME-Q test_voxel_cache.py
+### Objectives:
+# Tests for the voxel cache of voxel_cache.py and its use by get_ref_sweep.py and roi_stats.py.
+# Cached analyses are compared with the same analyses on the volumes, and invalidation and LRU eviction are checked.
+
+### Usage:
+# python -m pytest test/test_voxel_cache.py
+
+import os, itertools
+import numpy as np
+import nibabel as nib
+import pytest
+
+import voxel_cache
+import get_suvr
+import get_ref_sweep
+import roi_stats
+
+def make_build(calls, value, n=1000):
+  def build():
+    calls.append(1)
+    img=np.arange(n, dtype=np.float64).reshape((10, 10, -1))+value
+    return voxel_cache.mask_arrays(img, img%3==0), img.shape
+  return build
+
+@pytest.fixture
+def clock(monkeypatch):
+  # Distinct access times for the LRU order
+  counter=itertools.count()
+  monkeypatch.setattr(voxel_cache.time, 'time', lambda: float(next(counter)))
+
+def test_mask_arrays_round_trip():
+  rng=np.random.default_rng(0)
+  img=rng.random((6, 7, 5))
+  msk=rng.random(img.shape)>0.5
+  arrays=voxel_cache.mask_arrays(img, msk)
+  assert arrays['values'].dtype==np.float32 and arrays['index'].dtype==np.int32
+  np.testing.assert_array_equal(arrays['values'], img.astype(np.float32)[msk])
+  np.testing.assert_array_equal(voxel_cache.to_volume(arrays['values'], arrays['index'], img.shape), np.where(msk, img.astype(np.float32), 0))
+
+def test_precision_of_values(monkeypatch):
+  monkeypatch.delenv('TQ_DTYPE', raising=False)
+  img=np.random.default_rng(0).random((4, 4, 4))
+  spec=voxel_cache.get_spec('test', 1, 0.9)
+  assert spec=='test:v1:float32:0.9'
+  monkeypatch.setenv('TQ_DTYPE', 'float64')
+  # Entries of another precision are not shared
+  assert voxel_cache.get_spec('test', 1, 0.9)=='test:v1:float64:0.9'
+  values=voxel_cache.mask_arrays(img, img>0.5)['values']
+  assert values.dtype==np.float64
+  np.testing.assert_array_equal(values, img[img>0.5])
+
+def test_hit_and_invalidation(tmp_path, clock):
+  cachedir=str(tmp_path/'cache')
+  (tmp_path/'a.nii').write_bytes(b'a')
+  (tmp_path/'b.nii').write_bytes(b'b')
+  paths=[str(tmp_path/'a.nii'), str(tmp_path/'b.nii')]
+  calls=[]
+  first=voxel_cache.get_samples('S01', paths, 'spec', make_build(calls, 0), cachedir)
+  second=voxel_cache.get_samples('S01', paths, 'spec', make_build(calls, 0), cachedir)
+  assert len(calls)==1 and not first.hit and second.hit
+  assert isinstance(second.arrays['values'], np.memmap) and second.shape==first.shape
+  for name in ['values', 'index']:
+    np.testing.assert_array_equal(second.arrays[name], first.arrays[name])
+
+  # Another mask specification or another input is another entry
+  voxel_cache.get_samples('S01', paths, 'other', make_build(calls, 0), cachedir)
+  assert len(calls)==2
+  (tmp_path/'b.nii').write_bytes(b'c')
+  os.utime(str(tmp_path/'b.nii'), ns=(1, 1))
+  third=voxel_cache.get_samples('S01', paths, 'spec', make_build(calls, 1), cachedir)
+  assert len(calls)==3 and not third.hit
+  assert len(voxel_cache.prune(cachedir))==2
+  assert len(voxel_cache.load_index(cachedir)['entries'])==1
+  assert voxel_cache.clean(cachedir, ['S02'])==[] and len(voxel_cache.clean(cachedir))==1
+  assert [name for name in os.listdir(cachedir) if name.endswith('.npy')]==[]
+
+def test_lru_eviction(tmp_path, clock):
+  cachedir=str(tmp_path/'cache')
+  calls=[]
+  (tmp_path/'a.nii').write_bytes(b'a')
+  paths=[str(tmp_path/'a.nii')]
+  voxel_cache.get_samples('S01', paths, '0', make_build(calls, 0), cachedir)
+  nbytes=voxel_cache.load_index(cachedir)['entries'].popitem()[1]['bytes']
+  max_bytes=3*nbytes
+  for spec in ['1', '2']:
+    voxel_cache.get_samples('S01', paths, spec, make_build(calls, 0), cachedir, max_bytes)
+  # 0 is used again, so 1 is the least recently used entry when 3 is added
+  assert voxel_cache.get_samples('S01', paths, '0', make_build(calls, 0), cachedir, max_bytes).hit
+  voxel_cache.get_samples('S01', paths, '3', make_build(calls, 0), cachedir, max_bytes)
+  specs=sorted([entry['spec'] for entry in voxel_cache.load_index(cachedir)['entries'].values()])
+  assert specs==['0', '2', '3'] and len(calls)==4
+  # Larger than the cache: not stored
+  assert not voxel_cache.get_samples('S01', paths, '4', make_build(calls, 0, 10**5), cachedir, max_bytes).hit
+  assert len(voxel_cache.load_index(cachedir)['entries'])==3
+
+def test_disabled(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setenv('TQ_VOXEL_CACHE', 'none')
+  calls=[]
+  for i in range(2):
+    assert not voxel_cache.get_samples('S01', [], 'spec', make_build(calls, 0)).hit
+  assert len(calls)==2 and not os.path.exists(voxel_cache.CACHEDIR)
+
+def test_sweep_reads_cache(tmp_path, monkeypatch, suvr_subject):
+  monkeypatch.chdir(tmp_path)
+  suvr_subject(tmp_path, 'A001', 0)
+  grid=get_ref_sweep.get_default_grid()
+  grid.update([('msk_thr', [0.9, 0.95]), ('bin_width', [0.025, 0.05])])
+  rows=get_ref_sweep.run_sweep(['A001'], 'c1', grid, max_workers=1)
+
+  # The second sweep does not load the images
+  def load_subject(ID, tissue):
+    raise AssertionError('loaded '+ID)
+  monkeypatch.setattr(get_suvr, 'load_subject', load_subject)
+  assert get_ref_sweep.sweep_subject('A001', 'c1', grid)==rows
+
+def test_roi_stats_reads_cache(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rng=np.random.default_rng(1)
+  labels=rng.choice([0, 8, 47, 1001], size=(10, 10, 10)).astype(np.float32)
+  suvr=rng.normal(1.0, 0.2, size=(10, 10, 10)).astype(np.float32)
+  nib.save(nib.Nifti1Image(labels, np.eye(4)), 'S01_wmparc_r.nii.gz')
+  nib.save(nib.Nifti1Image(suvr, np.eye(4)), 'S01_pmpbb3_suvr.nii.gz')
+  regions=[('Lt-Cerebellum-Cortex', 'wmparc', 8), ('Lt-wm-bankssts', 'wmparc', 1001), ('Rt-Cerebellum-Cortex', 'wmparc', 47)]
+  expected=roi_stats.region_stats({'wmparc': roi_stats.load_labels('S01_wmparc_r.nii.gz')}, [suvr], regions, roi_stats.STATS)
+  results=roi_stats.process_subject('S01', regions, [('_pmpbb3_suvr', 'suvr_wmparc_mean')], roi_stats.STATS)
+
+  monkeypatch.setattr(roi_stats, 'load_image', None)
+  monkeypatch.setattr(roi_stats, 'load_labels', None)
+  for result in [results, roi_stats.process_subject('S01', regions, [('_pmpbb3_suvr', 'suvr_wmparc_mean')], roi_stats.STATS)]:
+    for stat in roi_stats.STATS:
+      np.testing.assert_array_equal(result[0][stat], expected[0][stat])
@@ -2,6 +2,15 @@
 
 #set -x
 
+# Usage: tq-all.sh [--parallel]
+#   By default, each stage is run for all subjects before the next stage.
+#   With --parallel, the stages of each subject are run by src/python/tq_scheduler.py
+#   as soon as the prerequisites of the subject are finished.
+PARALLEL=0
+if [[ "$1" == "--parallel" ]]; then
+  PARALLEL=1
+fi
+
 # Load environment variable
 TAMEQDIR=$(cd $(dirname "$(realpath "$0")") ; pwd)
 source ${TAMEQDIR}/config.env
@@ -67,28 +76,38 @@ done
 
 ### Start TAME-Q Preprocess
 timestamp=$(date +%Y%m%d_%H%M)
+
+# Wall time, CPU time, peak memory and I/O of each stage and python step are recorded in ${TQ_METRICS}
+# and summarized in Run_Report_${timestamp}.tsv (see src/python/tq_instrument.py)
+export TQ_METRICS=${TQ_METRICS:-${PWD}/tq_metrics_${timestamp}.jsonl}
+function run_stage() {
+  python ${TAMEQDIR}/src/python/tq_instrument.py run $(basename ${1%.sh}) -- "$@"
+}
+function run_report() {
+  echo "Resource usage of each step (${TQ_METRICS}):"
+  python ${TAMEQDIR}/src/python/tq_instrument.py report ${TQ_METRICS} Run_Report_${timestamp}.tsv | column -t -s $'\t'
+}
+
+if [[ ${PARALLEL} = 1 ]]; then
+  python ${TAMEQDIR}/src/python/tq_scheduler.py --timestamp ${timestamp} ${IDs[@]}
+  run_report
+  exit
+fi
+
+# The histograms and QA reports are rendered at Step 6 with the overviews
+export TQ_DEFER_FIGURES=1
+
 PROCESS_RESULT=Process_Status_${timestamp}.csv
 echo "ID" > ${PROCESS_RESULT}
 for ID in ${IDs[@]}; do echo ${ID} >> ${PROCESS_RESULT}; done
 
 # Step 1. Realignment and Coregistration
-${TAMEQDIR}/src/bash/tq_10_realign.sh
-status_10=()
-for ID in ${IDs[@]}; do
-Rmax=$(cat coregistration_results_pet.csv | grep ${ID}, | awk -F , '{print $2}' | sed 's/^-//g')
-Rx=$(cat coregistration_results_pet.csv | grep ${ID}, | awk -F , '{print $3}' | sed 's/^-//g')
-Ry=$(cat coregistration_results_pet.csv | grep ${ID}, | awk -F , '{print $4}' | sed 's/^-//g')
-Rz=$(cat coregistration_results_pet.csv | grep ${ID}, | awk -F , '{print $5}' | sed 's/^-//g')
-Dice=0$(cat coregistration_results_pet.csv | grep ${ID}, | awk -F , '{print $6}')
-  
-  if [[ -e ${ID}_t1w_r.nii ]] && [[ -e ${ID}_pmpbb3_dyn_mean.nii ]]; then
-    if (( $(echo "$Rmax < 1" | bc -l) )) && (( $(echo "$Rx < 1" | bc -l) )) && (( $(echo "$Ry < 1" | bc -l) )) && (( $(echo "$Rz < 1" | bc -l) )) && (( $(echo "$Dice > 0.94" | bc -l) )); then
-      status_10+=("OK")
-    else
-      status_10+=("CHECK")
-    fi
-  else
-    status_10+=("NA")
+run_stage ${TAMEQDIR}/src/bash/tq_10_realign.sh
+# The thresholds of all subjects are checked at once by tq_qc.py
+status_10=($(python ${TAMEQDIR}/src/python/tq_qc.py status ${IDs[@]}))
+for i in ${!IDs[@]}; do
+  ID=${IDs[$i]}
+  if [[ ${status_10[$i]} = NA ]]; then
     mkdir -p failed/tq_10/${ID}
     mv *${ID}* failed/tq_10/${ID}/
   fi
@@ -101,7 +120,8 @@ paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_1} > process_result_tmp.csv && m
 rm ${PROCESS_RESULT_1}
 
 # Step 2. Segmentation
-${TAMEQDIR}/src/bash/tq_20_segmentation.sh
+# The images are segmented by TQ_SEG_JOBS concurrent instances (see tq_20_segmentation.sh -j)
+run_stage ${TAMEQDIR}/src/bash/tq_20_segmentation.sh
 status_20=()
 for ID in ${IDs[@]}; do
   if [[ -e c1${ID}_t1w_r.nii ]] && [[ -e c2${ID}_t1w_r.nii ]]; then
@@ -123,7 +143,7 @@ rm ${PROCESS_RESULT_2}
 
 # Step 3. Semi-Quantification
 # Gray Matter Reference
-${TAMEQDIR}/src/bash/tq_30_suvr_im.sh
+run_stage ${TAMEQDIR}/src/bash/tq_30_suvr_im.sh
 status_30=()
 for ID in ${IDs[@]}; do
   if [[ -e ${ID}_pmpbb3_suvr.nii.gz ]]; then
@@ -145,7 +165,7 @@ paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_3} > process_result_tmp.csv && m
 rm ${PROCESS_RESULT_3}
 
 # White Matter Reference
-${TAMEQDIR}/src/bash/tq_31_suvr_wm.sh
+run_stage ${TAMEQDIR}/src/bash/tq_31_suvr_wm.sh
 status_31=()
 for ID in ${IDs[@]}; do
   if [[ -e ${ID}_pmpbb3_suvr_wm.nii.gz ]]; then
@@ -169,7 +189,7 @@ paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_4} > process_result_tmp.csv && m
 rm ${PROCESS_RESULT_4}
 
 # Step 4. FreeSurfer Segmentation
-${TAMEQDIR}/src/bash/tq_40_recon-all.sh
+run_stage ${TAMEQDIR}/src/bash/tq_40_recon-all.sh
 
 status_40=()
 for ID in ${IDs[@]}; do
@@ -195,7 +215,7 @@ for flag in ${status_40[@]}; do echo ${flag} >> ${PROCESS_RESULT_5} ; done
 paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_5} > process_result_tmp.csv && mv process_result_tmp.csv ${PROCESS_RESULT}
 rm ${PROCESS_RESULT_5}
 
-${TAMEQDIR}/src/bash/tq_41_segmentBS.sh
+run_stage ${TAMEQDIR}/src/bash/tq_41_segmentBS.sh
 status_41=()
 for ID in ${IDs[@]}; do
   if [[ $(find subjects/${ID}/mri -name "brainstemSsLabels*mgz" | wc -l) > 0 ]]; then
@@ -221,7 +241,7 @@ paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_6} > process_result_tmp.csv && m
 rm ${PROCESS_RESULT_6}
 
 # Cerebellum Reference
-${TAMEQDIR}/src/bash/tq_42_suvr_cer.sh
+run_stage ${TAMEQDIR}/src/bash/tq_42_suvr_cer.sh
 status_42=()
 for ID in ${IDs[@]}; do
   if [[ -e ${ID}_pmpbb3_suvr_cer.nii.gz ]]; then
@@ -247,16 +267,20 @@ paste -d "," ${PROCESS_RESULT} ${PROCESS_RESULT_7} > process_result_tmp.csv && m
 rm ${PROCESS_RESULT_7}
 
 # Step 5. Get Table Data
-${TAMEQDIR}/src/bash/tq_50_gen_table_wmparc_gm.sh
-${TAMEQDIR}/src/bash/tq_51_gen_table_wmparc_wm.sh
-${TAMEQDIR}/src/bash/tq_52_gen_table_wmparc_cer.sh
-${TAMEQDIR}/src/bash/tq_53_merge_wmparc.sh
-${TAMEQDIR}/src/bash/tq_54_gen_table_merged_gm.sh
-${TAMEQDIR}/src/bash/tq_55_gen_table_merged_wm.sh
-${TAMEQDIR}/src/bash/tq_56_gen_table_merged_cer.sh
+# The tables of the gray matter, white matter and cerebellar references are generated in one pass
+run_stage ${TAMEQDIR}/src/bash/tq_50_gen_table_wmparc_gm.sh -a
+run_stage ${TAMEQDIR}/src/bash/tq_53_merge_wmparc.sh
+run_stage ${TAMEQDIR}/src/bash/tq_54_gen_table_merged_gm.sh -a
 
 # Step 6. Get Overview
+# The affine transforms are done for each subject, and the overviews, histograms and QA reports
+# of all subjects are rendered in parallel by tq_report.py
 for ID in ${IDs[@]}; do
-  ${TAMEQDIR}/src/bash/tq_60_overview_axi.sh -i ${ID} -a 1 -b 2
-  ${TAMEQDIR}/src/bash/tq_61_overview_cor.sh -i ${ID} -a 1 -b 2
+  run_stage ${TAMEQDIR}/src/bash/tq_60_overview_axi.sh -i ${ID} -a 1 -b 2 -n
 done
+run_stage ${TAMEQDIR}/src/python/tq_report.py -a 1 -b 2 ${IDs[@]}
+
+# Step 7. QC of the cohort (QC_Report_${timestamp}.tsv and QC_Summary_${timestamp}.tsv)
+run_stage ${TAMEQDIR}/src/python/tq_qc.py report --timestamp ${timestamp} ${IDs[@]}
+
+run_report